@@ -0,0 +1,956 @@
+import os
+import time
+import signal
+import socket
+import asyncio
+import tempfile
+import threading
+import numpy as np
+from collections import deque
+from . import data_decoding_lib as ddl
+
+###Acquisition Pipeline###
+#
+# The serial port is read by a reader thread that only moves bytes into a bounded buffer, a second thread drains the
+# buffer and does the slow work (framing, decoding, printing, writing files) so a slow disk or console can't stall the UART
+#
+# Policies for when the consumer falls behind and the buffer is full:
+# block       -> the reader waits for room (the device/OS buffer absorbs the backlog)
+# drop-oldest -> the oldest buffered bytes are thrown away (the packet framer resynchronizes on the next valid packet)
+# spill       -> new bytes go to a spill file on disk until the consumer has caught up, nothing is lost or reordered
+#
+
+queue_policies = ('block', 'drop-oldest', 'spill')
+
+
+class byte_ring_buffer :
+    #bounded fifo of byte chunks shared by the reader and consumer threads
+
+    def __init__(self, max_bytes, policy='block', spill_fn=None) :
+        # Input: int max_bytes (bytes held in memory before the policy applies), String policy (see queue_policies),
+        # String spill_fn (spill file for the 'spill' policy)
+        if policy not in queue_policies :
+            raise ValueError('Unknown queue policy ' + str(policy))
+        if policy == 'spill' and spill_fn is None :
+            raise ValueError('The spill policy needs a spill file')
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.spill_fn = spill_fn
+        self.q = deque()
+        self.depth = 0 #bytes currently held in memory
+        self.high_water = 0 #largest depth seen
+        self.dropped = 0 #bytes thrown away by drop-oldest
+        self.spilled = 0 #bytes written to the spill file
+        self.spill_high_water = 0 #largest spill backlog seen
+        self.closed = False
+        self.cv = threading.Condition()
+        self.sf = None #spill file, opened on first use
+        self.sw = 0 #spill write offset
+        self.sr = 0 #spill read offset
+
+    def put(self, data) :
+        # Function Definition: Adds bytes read from the serial port, applies the policy if the buffer is full
+        # Input: bytes data
+        # Output: None
+        with self.cv :
+            if self.policy == 'spill' and (self.sw > self.sr or self.depth + len(data) > self.max_bytes) :
+                self.spill_helper(data) #once spilling, everything goes to disk until the consumer catches up so order is kept
+                self.cv.notify_all()
+                return
+            if self.policy == 'block' :
+                while self.depth > 0 and self.depth + len(data) > self.max_bytes and not self.closed :
+                    self.cv.wait()
+            elif self.policy == 'drop-oldest' :
+                while len(self.q) > 0 and self.depth + len(data) > self.max_bytes :
+                    old = self.q.popleft()
+                    self.depth = self.depth - len(old)
+                    self.dropped = self.dropped + len(old)
+            self.q.append(data)
+            self.depth = self.depth + len(data)
+            self.high_water = max(self.high_water, self.depth)
+            self.cv.notify_all()
+
+    def get(self, timeout=None) :
+        # Function Definition: Takes the oldest bytes out of the buffer, memory first and then the spill file
+        # Input: float timeout (seconds to wait for data, None waits until data arrives or the buffer is closed)
+        # Output: bytes, None if there was nothing to get
+        with self.cv :
+            if len(self.q) == 0 and self.sw == self.sr and not self.closed :
+                self.cv.wait(timeout)
+            if len(self.q) > 0 :
+                data = self.q.popleft()
+                self.depth = self.depth - len(data)
+                self.cv.notify_all()
+                return data
+            if self.sw > self.sr :
+                self.sf.seek(self.sr)
+                data = self.sf.read(min(self.sw - self.sr, self.max_bytes))
+                self.sr = self.sr + len(data)
+                if self.sr == self.sw : #caught up, back to memory
+                    self.sf.truncate(0)
+                    self.sr = 0
+                    self.sw = 0
+                return data
+            return None
+
+    def spill_helper(self, data) :
+        # Function Definition: Appends bytes to the spill file
+        if self.sf is None :
+            self.sf = open(self.spill_fn, 'w+b')
+        self.sf.seek(self.sw)
+        self.sf.write(data)
+        self.sf.flush()
+        self.sw = self.sw + len(data)
+        self.spilled = self.spilled + len(data)
+        self.spill_high_water = max(self.spill_high_water, self.sw - self.sr)
+
+    def empty(self) :
+        with self.cv :
+            return len(self.q) == 0 and self.sw == self.sr
+
+    def close(self) :
+        # Function Definition: Wakes up every waiting thread, no more data will be put
+        with self.cv :
+            self.closed = True
+            self.cv.notify_all()
+
+    def remove_spill(self) :
+        # Function Definition: Closes and deletes the spill file
+        if self.sf is not None :
+            self.sf.close()
+            self.sf = None
+            os.remove(self.spill_fn)
+
+    def stats(self) :
+        # Output: dict with the current depth, high-water marks and how many bytes were dropped or spilled
+        with self.cv :
+            return {'depth': self.depth, 'chunks': len(self.q), 'high_water': self.high_water, 'max_bytes': self.max_bytes,
+                    'dropped': self.dropped, 'spilled': self.spilled, 'spill_backlog': self.sw - self.sr,
+                    'spill_high_water': self.spill_high_water}
+
+
+class acquisition_pipeline :
+    #reader thread filling a byte_ring_buffer from the serial port and a consumer thread draining it
+
+    def __init__(self, ser, consumer, max_bytes=1 << 24, policy='block', spill_fn=None, max_timeouts=3) :
+        # Input: Serial object, function consumer (called with each chunk of bytes on the consumer thread, returns True when the
+        # measurement is finished), int max_bytes/String policy/String spill_fn (see byte_ring_buffer),
+        # int max_timeouts (consecutive empty serial reads before giving up)
+        self.ser = ser
+        self.consumer = consumer
+        self.buffer = byte_ring_buffer(max_bytes, policy, spill_fn)
+        self.max_timeouts = max_timeouts
+        self.stop_event = threading.Event() #tells the reader to stop
+        self.finished = threading.Event() #set once the consumer is done
+        self.timed_out = False
+        self.completed = False #the consumer reported the end of the measurement
+        self.error = None #exception raised on either thread
+        self.bytes_read = 0
+        self.reads = 0
+        self.reader_thread = threading.Thread(target=self.reader, name='quad-mag-reader', daemon=True)
+        self.consumer_thread = threading.Thread(target=self.drain, name='quad-mag-consumer', daemon=True)
+
+    def start(self) :
+        self.reader_thread.start()
+        self.consumer_thread.start()
+        return self
+
+    def reader(self) :
+        # Function Definition: Reader thread, only reads the serial port and fills the buffer
+        timeouts = 0
+        try :
+            while not self.stop_event.is_set() :
+                data = self.ser.read(max(1, self.ser.in_waiting))
+                if len(data) == 0 :
+                    timeouts = timeouts + 1
+                    if timeouts >= self.max_timeouts :
+                        self.timed_out = True
+                        break
+                    continue
+                timeouts = 0
+                self.reads = self.reads + 1
+                self.bytes_read = self.bytes_read + len(data)
+                self.buffer.put(data)
+        except Exception as e :
+            self.error = e
+        self.buffer.close()
+
+    def drain(self) :
+        # Function Definition: Consumer thread, hands buffered bytes to the consumer until it is done or the reader stops
+        try :
+            while 1 :
+                data = self.buffer.get(0.5)
+                if data is None :
+                    if self.buffer.closed and self.buffer.empty() :
+                        break
+                    continue
+                if self.consumer(data) :
+                    self.completed = True
+                    break
+        except Exception as e :
+            self.error = e
+        self.stop_event.set()
+        self.buffer.close()
+        self.finished.set()
+
+    def stop(self) :
+        # Function Definition: Stops reading, the consumer still drains what was already buffered
+        self.stop_event.set()
+
+    def join(self, timeout=None) :
+        self.reader_thread.join(timeout)
+        self.consumer_thread.join(timeout)
+        if self.buffer.policy == 'spill' :
+            self.buffer.remove_spill()
+
+    def stats(self) :
+        # Output: dict of buffer stats (see byte_ring_buffer.stats) plus the reader counters
+        st = self.buffer.stats()
+        st['bytes_read'] = self.bytes_read
+        st['reads'] = self.reads
+        return st
+
+###End Acquisition Pipeline###
+
+
+###Asyncio Client###
+#
+# Same command set as data_commands_lib but as coroutines, the serial port is put in non-blocking mode and only read when the
+# event loop says it is readable, so command round trips, a streaming measurement and a stop request can be interleaved with
+# other work (live stats, file output) on one event loop eg.
+#
+#   async with async_quad_mag_client(ser) as qm :
+#       await qm.set_mag_config(800, 1)
+#       async for flag, packets in qm.stream(10) :
+#           ...
+#
+
+class async_serial_transport :
+    #non-blocking wrapper around a Serial object, waits on the event loop instead of blocking in read()
+
+    def __init__(self, ser, poll_interval=0.002) :
+        # Input: Serial object, float poll_interval (seconds between reads when the port can't be watched by the event loop)
+        self.ser = ser
+        self.ser.timeout = 0
+        self.poll_interval = poll_interval
+        self.loop = None
+        self.fd = None #file descriptor watched by the event loop, None falls back to polling
+        self.bytes_read = 0
+
+    def start(self) :
+        # Function Definition: Checks whether the event loop can watch the port, Windows ports and the proactor loop can't
+        self.loop = asyncio.get_running_loop()
+        try :
+            fd = self.ser.fileno()
+            self.loop.add_reader(fd, lambda : None)
+            self.loop.remove_reader(fd)
+            self.fd = fd
+        except (AttributeError, NotImplementedError, OSError, ValueError) :
+            self.fd = None
+
+    async def read(self) :
+        # Function Definition: Waits until bytes are available and returns everything that is waiting
+        # Output: bytes
+        while 1 :
+            data = self.ser.read(max(1, self.ser.in_waiting))
+            if len(data) > 0 :
+                self.bytes_read = self.bytes_read + len(data)
+                return data
+            if self.fd is None :
+                await asyncio.sleep(self.poll_interval)
+                continue
+            readable = self.loop.create_future()
+            self.loop.add_reader(self.fd, lambda : readable.done() or readable.set_result(None))
+            try :
+                await readable
+            finally :
+                self.loop.remove_reader(self.fd) #the reader is level triggered, only watch while waiting
+
+    def write(self, data) :
+        # Function Definition: Writes a command, commands are 10 bytes so this never waits on the port for long
+        self.ser.write(data)
+
+
+class async_quad_mag_client :
+    #asyncio client for the quad-mag command protocol, a reader task frames everything the port sends and routes config
+    #responses/completion flags to the command coroutines and data packets to the measurement coroutines
+
+    def __init__(self, ser, timeout=3, max_blocks=256, poll_interval=0.002) :
+        # Input: Serial object, float timeout (seconds to wait for a response, same as the blocking commands),
+        # int max_blocks (packet blocks held for the consumer, blocks that arrive while it is full are dropped and counted so the
+        # reader never stops framing the completions and config responses behind them), float poll_interval (see async_serial_transport)
+        self.transport = async_serial_transport(ser, poll_interval)
+        self.framer = ddl.packet_framer(config=True)
+        self.timeout = timeout
+        self.max_blocks = max_blocks
+        self.responses = None #[flag, hex] config responses and '0a' completions
+        self.blocks = None #[flag, packets] data blocks, None marks the end of a measurement
+        self.lock = None #one command round trip at a time
+        self.reader_task = None
+        self.streaming = False
+        self.timed_out = False
+        self.packets = 0
+        self.dropped = 0 #packets dropped because the consumer fell max_blocks behind
+        self.error = None #exception that ended the reader task
+
+    async def start(self) :
+        self.responses = asyncio.Queue()
+        self.blocks = asyncio.Queue(self.max_blocks)
+        self.lock = asyncio.Lock()
+        self.transport.start()
+        self.reader_task = asyncio.create_task(self.reader())
+        return self
+
+    async def close(self) :
+        if self.reader_task is not None :
+            self.reader_task.cancel()
+            try :
+                await self.reader_task
+            except asyncio.CancelledError :
+                pass
+            self.reader_task = None
+
+    async def __aenter__(self) :
+        return await self.start()
+
+    async def __aexit__(self, *exc) :
+        await self.close()
+
+    async def reader(self) :
+        # Function Definition: Reader task, frames the incoming bytes and routes every packet to its queue, it never waits on a
+        # consumer so a stop's completion always gets through while a stream is running
+        try :
+            while 1 :
+                self.framer.feed(await self.transport.read())
+                for flag, packets in self.framer.next_blocks() :
+                    if flag in ddl.config_lengths :
+                        self.responses.put_nowait([flag, packets.tobytes().hex()])
+                    elif flag == '0a' :
+                        self.responses.put_nowait([flag, "COMPLETE"])
+                        if self.streaming :
+                            self.streaming = False
+                            self.end_blocks_helper()
+                    else :
+                        self.packets = self.packets + len(packets)
+                        try :
+                            self.blocks.put_nowait([flag, packets])
+                        except asyncio.QueueFull :
+                            self.dropped = self.dropped + len(packets)
+        except asyncio.CancelledError :
+            raise
+        except Exception as e : #the port failed, wake up whoever is waiting instead of letting them time out
+            self.error = e
+            self.responses.put_nowait(['error', str(e)])
+            self.end_blocks_helper()
+
+    def end_blocks_helper(self) :
+        # Function Definition: Queues the end marker of a measurement, dropping the oldest block if the queue is full
+        while 1 :
+            try :
+                self.blocks.put_nowait(None)
+                return
+            except asyncio.QueueFull :
+                bl = self.blocks.get_nowait()
+                self.dropped = self.dropped + (len(bl[1]) if bl is not None else 0)
+
+    def error_helper(self) :
+        # Function Definition: Raises the exception that ended the reader task, if there was one
+        if self.error is not None :
+            raise IOError('Quad-mag reader stopped: ' + str(self.error)) from self.error
+
+    async def command_helper(self, command) :
+        # Function Definition: Sends a command and waits for its responses up to the completion flag
+        # Input: bytes command
+        # Output: List of [packet flag, String hex response], missing the '0a' if the quad-mag timed out
+        async with self.lock :
+            self.error_helper()
+            while not self.responses.empty() : #completions left over from a measurement that ended on its own
+                self.responses.get_nowait()
+            if not self.streaming : #the command's completion is the next '0a'
+                self.framer.stopping = True
+            self.transport.write(command)
+            rl = []
+            while 1 :
+                try :
+                    r = await asyncio.wait_for(self.responses.get(), self.timeout)
+                except asyncio.TimeoutError :
+                    if self.framer.complete_pending() :
+                        rl.append(['0a', "COMPLETE"])
+                    return rl
+                if r[0] == 'error' :
+                    self.error_helper()
+                rl.append(r)
+                if r[0] == '0a' :
+                    return rl
+
+    def config_helper(self, rl) :
+        # Output: String hex of the first config response, '' if there wasn't one
+        for r in rl :
+            if r[0] in ddl.config_lengths :
+                return r[1]
+        return ''
+
+    async def set_mag_config(self, cycle_count=800, oversamples=1, tmrc=0) :
+        # Function Definition: Sets the config of the magnetometers
+        # Input: int cycle count, int number of oversamples, int tmrc
+        # Output: String that holds the current mag config values, None if the config didn't update
+        command = b'\x01' + cycle_count.to_bytes(2, byteorder='big') + tmrc.to_bytes(1, byteorder='big')
+        command = command + oversamples.to_bytes(1, byteorder='big') + int(0).to_bytes(5, byteorder='big')
+        config = self.config_helper(await self.command_helper(command))
+        if config[0:8] != command[1:5].hex() :
+            print("Failed to correctly update config of magnetometers!")
+            print("New config: " + config[0:8])
+            print("What the config should be: " + command[1:5].hex())
+            return None
+        return config
+
+    async def set_imu_config(self, command=b'\x02\x0c\x02\x01\x01\x0c\x02\x01\x01\x00') :
+        # Function Definition: Sets the config of the imu
+        # Input: bytes command (see set_imu_config in data_commands_lib for the fields, defaults to the standard config)
+        # Output: String that holds the current imu config values, None if the config didn't update
+        config = self.config_helper(await self.command_helper(command))
+        if config != command[1:10].hex() :
+            print("Failed to correctly update imu config!")
+            print("New config: " + config)
+            print("What the config should be: " + command[1:10].hex())
+            return None
+        return config
+
+    async def get_mag_config(self) :
+        return self.config_helper(await self.command_helper(b'\x03' + int(0).to_bytes(9, byteorder='big')))
+
+    async def get_imu_config(self) :
+        return self.config_helper(await self.command_helper(b'\x04' + int(0).to_bytes(9, byteorder='big')))
+
+    async def stop_all_operations(self) :
+        # Function Definition: Stops all sensors, the completion also ends a running stream
+        # Output: bool whether the quad-mag confirmed the stop
+        self.framer.stopping = True
+        rl = await self.command_helper(b'\x08' + int(0).to_bytes(9, byteorder='big'))
+        return len(rl) > 0 and rl[-1][0] == '0a'
+
+    async def send_data(self) :
+        # Function Definition: Requests any data the quad-mag has available
+        # Output: [packet flag, numpy array of packets], None if nothing valid arrived
+        async with self.lock :
+            self.error_helper()
+            self.transport.write(b'\x07' + int(0).to_bytes(9, byteorder='big'))
+            try :
+                bl = await asyncio.wait_for(self.blocks.get(), self.timeout)
+            except asyncio.TimeoutError :
+                return None
+            if bl is None :
+                self.error_helper()
+            return bl
+
+    async def stream(self, measurement_length=0, mags_enabled=0b1111) :
+        # Function Definition: Starts a continuous measurement and yields packet blocks as they arrive, ends on the completion flag
+        # (the measurement length running out or stop_all_operations) or when the quad-mag stops sending
+        # Input: int measurement length in seconds (0 runs until stopped), int bit mask of the enabled mags
+        # Output: async generator of [packet flag, numpy array of packets (N, packet length)], wrap it in contextlib.aclosing() to
+        # end the stream right away when breaking out of it (python only closes a dropped async generator when it is collected)
+        if measurement_length == 0 :
+            measurement_length = 4294967295
+        command = b'\x06\x00\x00' + mags_enabled.to_bytes(1, byteorder='big') + measurement_length.to_bytes(6, byteorder='big')
+        mh = self.measurement_helper(command)
+        try :
+            async for bl in mh :
+                yield bl
+        finally :
+            await mh.aclose()
+
+    async def single_measurement(self, mags_enabled=0b1111) :
+        # Function Definition: Requests a single measurement
+        # Input: int bit mask of the enabled mags
+        # Output: dict packet flag -> dict of columns (see decode_packet_array_quad in data_decoding_lib)
+        command = b'\x05' + mags_enabled.to_bytes(1, byteorder='big') + int(0).to_bytes(8, byteorder='big')
+        command = command + mags_enabled.to_bytes(1, byteorder='big')
+        pg = {}
+        async for flag, packets in self.measurement_helper(command) :
+            if flag in ddl.packet_specs :
+                pg.setdefault(flag, []).append(ddl.decode_packet_array_quad(packets, flag))
+        return dict((flag, ddl.concat_columns_quad(dcl)) for flag, dcl in pg.items())
+
+    async def measurement_helper(self, command) :
+        # Function Definition: Sends a measurement command and yields data blocks until the end marker
+        async with self.lock :
+            self.error_helper()
+            while not self.blocks.empty() :
+                self.blocks.get_nowait()
+            self.streaming = True
+            self.timed_out = False
+            self.framer.stopping = False
+            self.transport.write(command)
+        try :
+            while 1 :
+                try :
+                    bl = await asyncio.wait_for(self.blocks.get(), self.timeout)
+                except asyncio.TimeoutError :
+                    self.timed_out = not self.framer.complete_pending()
+                    return
+                if bl is None :
+                    self.error_helper()
+                    return
+                yield bl
+        finally : #also when the consumer breaks out of the stream early
+            self.streaming = False
+
+###End Asyncio Client###
+
+
+###Multi-Board Acquisition###
+#
+# Every board gets its own reader thread and its own capture files, so a board whose port is waiting doesn't hold up the others
+# (the decode and row formatting still hold the GIL, the threads share one core for that work). Each read is stamped with the
+# shared host clock, the newest packet of a read was sent just before it was read so the smallest host - device time differences
+# track the device clock with the least latency. Only the smallest difference in each stretch of device time is kept, a line
+# through them gives every board's offset and drift and the merged index puts all packets on the host time base. Device times
+# are spooled to a temporary file so a long capture doesn't hold them in memory.
+#
+
+class board_capture :
+    #one board of a multi_board_acquisition
+
+    def __init__(self, ser, write, name, t0, max_timeouts=3, read_size=1 << 16, sync_points=4096, sync_width=0.25) :
+        # Input: Serial object, function write (called with packet flag, packets and decoded columns for every block),
+        # String name, float t0 (shared host clock start, time.perf_counter), int max_timeouts (consecutive empty reads
+        # before giving up), int read_size (initial read buffer size), int sync_points (most clock sync points kept),
+        # float sync_width (initial seconds of device time per sync point, doubles whenever sync_points would be exceeded)
+        self.ser = ser
+        self.write = write
+        self.name = name
+        self.t0 = t0
+        self.max_timeouts = max_timeouts
+        self.read_buffer = bytearray(read_size)
+        self.framer = ddl.packet_framer()
+        self.sync = [] #[host time, device time] of the read with the smallest difference in every sync_width of device time
+        self.sync_points = sync_points
+        self.sync_width = sync_width
+        self.times = tempfile.TemporaryFile() #device times (sec) of every packet, float64
+        self.packets = 0
+        self.bytes_read = 0
+        self.completed = False
+        self.timed_out = False
+        self.error = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.reader, name='quad-mag-' + name, daemon=True)
+
+    def reader(self) :
+        # Function Definition: Reads, frames, decodes and writes this board's packets until it reports completion
+        timeouts = 0
+        try :
+            while not self.stop_event.is_set() :
+                waiting = max(1, self.ser.in_waiting)
+                if waiting > len(self.read_buffer) :
+                    self.read_buffer.extend(bytes(waiting - len(self.read_buffer)))
+                read_view = memoryview(self.read_buffer)
+                read_count = self.ser.readinto(read_view[0:waiting])
+                ht = time.perf_counter() - self.t0
+                if read_count :
+                    self.framer.feed(read_view[0:read_count])
+                del read_view
+                if not read_count :
+                    if self.framer.complete_pending() :
+                        self.completed = True
+                        break
+                    timeouts = timeouts + 1
+                    if timeouts >= self.max_timeouts :
+                        self.timed_out = True
+                        break
+                    continue
+                timeouts = 0
+                self.bytes_read = self.bytes_read + read_count
+                dt = None
+                for flag, packets in self.framer.next_blocks() :
+                    if flag == '0a' :
+                        self.completed = True
+                        break
+                    dc = ddl.decode_packet_array_quad(packets, flag)
+                    self.write(flag, packets, dc)
+                    self.times.write(np.asarray(dc['t'], dtype=np.float64).tobytes())
+                    self.packets = self.packets + len(packets)
+                    dt = dc['t'][-1]
+                if dt is not None :
+                    self.sync_helper(ht, dt)
+                if self.completed :
+                    break
+        except Exception as e :
+            self.error = e
+
+    def sync_helper(self, ht, dt) :
+        # Function Definition: Adds a clock sync point, keeping the lower envelope of the host - device time differences
+        if len(self.sync) > 0 and self.sync[-1][1] // self.sync_width == dt // self.sync_width :
+            if ht - dt < self.sync[-1][0] - self.sync[-1][1] :
+                self.sync[-1] = [ht, dt]
+            return
+        self.sync.append([ht, dt])
+        if len(self.sync) > self.sync_points :
+            self.sync_width = self.sync_width * 2
+            sl = []
+            for sp in self.sync :
+                if len(sl) > 0 and sl[-1][1] // self.sync_width == sp[1] // self.sync_width :
+                    if sp[0] - sp[1] < sl[-1][0] - sl[-1][1] :
+                        sl[-1] = sp
+                else :
+                    sl.append(sp)
+            self.sync = sl
+
+    def device_times(self) :
+        # Output: float array device times (sec) of every packet read so far, read back from the spool file
+        self.times.flush()
+        self.times.seek(0)
+        ta = np.frombuffer(self.times.read(), dtype=np.float64)
+        self.times.seek(0, os.SEEK_END)
+        return ta
+
+
+def host_clock_fit(sync, segments=32, min_span=60) :
+    # Function Definition: Fits host time = device time + offset + drift * device time through the lower envelope of the
+    # host - device time differences (the reads with the least latency)
+    # Input: list of [host time, device time] (see board_capture.sync_helper), int segments (the envelope is the smallest
+    # difference in each segment),
+    # float min_span (seconds of device time needed before drift is fit, read latency jitter swamps it on short runs)
+    # Output: [offset (sec), drift (sec/sec)]
+    if len(sync) == 0 :
+        return [0.0, 0.0]
+    sa = np.asarray(sync, dtype=np.float64)
+    d = sa[:, 0] - sa[:, 1]
+    if len(sa) < 2*segments or sa[-1, 1] - sa[0, 1] < min_span :
+        return [float(d.min()), 0.0]
+    ix = np.array([sg[np.argmin(d[sg])] for sg in np.array_split(np.arange(len(d)), segments)])
+    drift, offset = np.polyfit(sa[ix, 1], d[ix], 1)
+    return [float(offset), float(drift)]
+
+
+class multi_board_acquisition :
+    #streams from several boards at once, one board_capture thread per serial port on a shared host clock
+
+    def __init__(self, sers, writes, names=None, max_timeouts=3) :
+        # Input: list of Serial objects, list of write functions (see board_capture), list of String names, int max_timeouts
+        if names is None :
+            names = ['board' + str(i+1) for i in range(len(sers))]
+        self.t0 = time.perf_counter()
+        self.start_time = time.time() #wall clock at host time 0
+        self.boards = [board_capture(ser, write, name, self.t0, max_timeouts) for ser, write, name in zip(sers, writes, names)]
+
+    def start(self) :
+        for bd in self.boards :
+            bd.thread.start()
+        return self
+
+    def alive(self) :
+        return any(bd.thread.is_alive() for bd in self.boards)
+
+    def stop(self) :
+        for bd in self.boards :
+            bd.stop_event.set()
+
+    def join(self, timeout=None) :
+        for bd in self.boards :
+            bd.thread.join(timeout)
+
+    def elapsed(self) :
+        return time.perf_counter() - self.t0
+
+    def merged_index(self) :
+        # Function Definition: Puts the packets of every board on the host time base
+        # Output: [float array host time (sec since start), int array board number, int array row in that board's capture],
+        # sorted by host time
+        hl, bl, rl = [], [], []
+        for i, bd in enumerate(self.boards) :
+            dt = bd.device_times()
+            offset, drift = host_clock_fit(bd.sync)
+            hl.append(dt + offset + drift*dt)
+            bl.append(np.full(len(dt), i, dtype=np.int64))
+            rl.append(np.arange(len(dt), dtype=np.int64))
+        ht = np.concatenate(hl) if len(hl) > 0 else np.zeros(0)
+        o = np.argsort(ht, kind='stable')
+        return [ht[o], np.concatenate(bl)[o] if len(bl) > 0 else np.zeros(0, dtype=np.int64),
+                np.concatenate(rl)[o] if len(rl) > 0 else np.zeros(0, dtype=np.int64)]
+
+    def write_merged_index(self, fn) :
+        # Function Definition: Writes the merged index as a csv, one line per packet
+        # Input: String file name
+        # Output: int number of packets indexed
+        ht, bn, rn = self.merged_index()
+        with open(fn, 'w') as fw :
+            fw.write("Host Start Time (unix sec)" + "".join(", " + bd.name + " Offset (sec), " + bd.name + " Drift" for bd in self.boards) + "\n")
+            fw.write(repr(self.start_time) + "".join(",%.9f,%.6e" % tuple(host_clock_fit(bd.sync)) for bd in self.boards) + "\n\n")
+            fw.write("Host Time (sec), Board, Row\n")
+            for i in range(0, len(ht), 1 << 16) :
+                fw.write("\n".join("%.6f,%d,%d" % r for r in zip(ht[i:i+(1 << 16)], bn[i:i+(1 << 16)], rn[i:i+(1 << 16)])))
+                fw.write("\n")
+        return len(ht)
+
+    def stats(self) :
+        # Output: dict board name -> packets, bytes read, clock offset/drift and how the board finished
+        st = {}
+        for bd in self.boards :
+            offset, drift = host_clock_fit(bd.sync)
+            st[bd.name] = {'packets': bd.packets, 'bytes_read': bd.bytes_read, 'offset': offset, 'drift': drift,
+                           'completed': bd.completed, 'timed_out': bd.timed_out, 'error': bd.error, 'skipped': bd.framer.skipped}
+        return st
+
+###End Multi-Board Acquisition###
+
+
+###Capture Writer###
+#
+# Write-behind wrapper around a capture file. Writes only append to a list in memory, the list reaches the file as one large
+# block once flush_bytes have collected or flush_interval seconds have passed, either on the writing thread or on a background
+# flush thread so the acquisition loop never waits on the disk. Every flush is timed so buffers can be sized from the worst case,
+# fsync_interval > 0 also forces the data to disk that often for long unattended captures.
+#
+
+class capture_writer :
+    #file-like (write/flush/close/fileno) so it drops in wherever a capture file object was used, written from one thread
+
+    def __init__(self, f, flush_bytes=1 << 20, flush_interval=1.0, fsync_interval=0, background=False) :
+        # Input: file object f (text or binary), int flush_bytes, float flush_interval (sec), float fsync_interval (sec, 0 never fsyncs
+        # until close), bool background (flush from a background thread, writers only block once 4*flush_bytes are waiting)
+        self.f = f
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.background = background
+        self.pending = deque() #appends and poplefts are thread safe so a write never takes a lock
+        self.queued = 0 #bytes ever written, only the writing thread changes it
+        self.taken = 0 #bytes ever taken for a flush, only changed under io_lock
+        self.last_flush = time.monotonic()
+        self.last_fsync = self.last_flush
+        self.flushes = 0
+        self.bytes_written = 0
+        self.flush_time = 0.0 #total seconds spent writing blocks
+        self.flush_max = 0.0 #slowest block write
+        self.fsyncs = 0
+        self.fsync_time = 0.0
+        self.fsync_max = 0.0
+        self.closed = False
+        self.error = None #exception raised on the flush thread, raised again on the next write
+        self.io_lock = threading.Lock() #keeps blocks in order when flush() and the flush thread race
+        self.cv = threading.Condition() #writers waiting for the flush thread to catch up
+        self.wake = threading.Event()
+        self.thread = None
+        if background :
+            self.thread = threading.Thread(target=self.flusher, name='quad-mag-writer', daemon=True)
+            self.thread.start()
+
+    def write(self, data) :
+        # Function Definition: Queues data for the file
+        # Input: String or bytes data (whatever the wrapped file takes)
+        # Output: int length of data
+        self.pending.append(data)
+        self.queued = self.queued + len(data)
+        if self.queued - self.taken >= self.flush_bytes :
+            if self.background :
+                self.backlog_helper()
+            else :
+                self.flush()
+        elif not self.background and time.monotonic() - self.last_flush >= self.flush_interval :
+            self.flush()
+        return len(data)
+
+    def backlog_helper(self) :
+        # Function Definition: Wakes the flush thread, waits for it if it has fallen too far behind
+        if self.error is not None :
+            raise self.error
+        self.wake.set()
+        if self.queued - self.taken >= 4*self.flush_bytes :
+            with self.cv :
+                while self.queued - self.taken >= 4*self.flush_bytes and self.error is None and self.thread.is_alive() :
+                    self.cv.wait(0.1)
+
+    def flush(self, fsync=False) :
+        # Function Definition: Writes everything queued to the file as one block, fsyncs if one is due or fsync is set
+        with self.io_lock :
+            pl = [self.pending.popleft() for i in range(len(self.pending))]
+            self.taken = self.taken + sum(len(d) for d in pl)
+            with self.cv :
+                self.cv.notify_all()
+            self.write_helper(pl, fsync)
+
+    def write_helper(self, pl, fsync) :
+        now = time.monotonic()
+        self.last_flush = now
+        if len(pl) > 0 :
+            block = pl[0][:0].join(pl)
+            st = time.perf_counter()
+            self.f.write(block)
+            self.f.flush()
+            dt = time.perf_counter() - st
+            self.flushes = self.flushes + 1
+            self.bytes_written = self.bytes_written + len(block)
+            self.flush_time = self.flush_time + dt
+            self.flush_max = max(self.flush_max, dt)
+        if fsync or (self.fsync_interval > 0 and now - self.last_fsync >= self.fsync_interval) :
+            self.last_fsync = now
+            st = time.perf_counter()
+            os.fsync(self.f.fileno())
+            dt = time.perf_counter() - st
+            self.fsyncs = self.fsyncs + 1
+            self.fsync_time = self.fsync_time + dt
+            self.fsync_max = max(self.fsync_max, dt)
+
+    def flusher(self) :
+        # Function Definition: Background flush thread, flushes on the size threshold or every flush_interval
+        while not self.closed :
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            if self.closed :
+                break
+            try :
+                self.flush()
+            except Exception as e :
+                self.error = e
+                break
+        with self.cv :
+            self.cv.notify_all()
+
+    def fileno(self) :
+        return self.f.fileno()
+
+    def close(self) :
+        # Function Definition: Stops the flush thread, writes what is left (fsynced if fsyncs were requested) and closes the file
+        if self.closed :
+            return
+        self.closed = True
+        if self.thread is not None :
+            self.wake.set()
+            self.thread.join()
+        self.flush(self.fsync_interval > 0)
+        self.f.close()
+
+    def stats(self) :
+        # Output: dict of bytes written, flush count and flush/fsync timings (sec)
+        return {'bytes_written': self.bytes_written, 'flushes': self.flushes, 'flush_time': self.flush_time,
+                'flush_mean': self.flush_time/self.flushes if self.flushes > 0 else 0.0, 'flush_max': self.flush_max,
+                'fsyncs': self.fsyncs, 'fsync_time': self.fsync_time, 'fsync_max': self.fsync_max, 'pending': self.queued - self.taken}
+
+###End Capture Writer###
+
+
+###Stop Control###
+#
+# Out-of-band ways to end a measurement that only set a flag, the acquisition loop checks stop_control.requested (a plain
+# attribute read) and sends the stop command itself so the quad-mag's completion ends the measurement normally:
+# SIGINT/SIGTERM -> Ctrl-C or kill, a second Ctrl-C raises KeyboardInterrupt as usual
+# control file   -> creating the file (eg. touch data_storage/stop) stops the measurement, the file is removed again
+# local socket   -> sending "stop" to 127.0.0.1:port (eg. echo stop | nc 127.0.0.1 port) answers "ok" and stops it
+# hotkey         -> optional keyboard hotkey (the keyboard package needs root on linux so it is never required)
+#
+
+class stop_control :
+
+    def __init__(self, signals=True, control_file=None, port=0, hotkey=None, poll_interval=0.2) :
+        # Input: bool signals (handle SIGINT/SIGTERM, only possible from the main thread), String control_file (None disables),
+        # int port (local tcp port, 0 disables), String hotkey (eg. 'q', None disables), float poll_interval (control file checks, sec)
+        self.signals = signals
+        self.control_file = control_file
+        self.port = port
+        self.hotkey = hotkey
+        self.poll_interval = poll_interval
+        self.requested = False #the cheap flag the acquisition loops check
+        self.reason = None
+        self.event = threading.Event()
+        self.closed = threading.Event()
+        self.previous_handlers = {}
+        self.sock = None
+        self.threads = []
+        self.hotkey_handle = None
+
+    def request(self, reason='request') :
+        # Function Definition: Asks the measurement to stop, safe to call from any thread or a signal handler
+        if not self.requested :
+            self.reason = reason
+        self.requested = True
+        self.event.set()
+
+    def start(self) :
+        # Function Definition: Installs the enabled stop sources
+        if self.signals and threading.current_thread() is threading.main_thread() :
+            for sg in (signal.SIGINT, signal.SIGTERM) :
+                self.previous_handlers[sg] = signal.signal(sg, self.signal_handler)
+        if self.control_file is not None :
+            if os.path.exists(self.control_file) : #left over from an earlier run
+                os.remove(self.control_file)
+            self.thread_helper(self.file_watcher, 'quad-mag-stop-file')
+        if self.port :
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(('127.0.0.1', self.port))
+            self.sock.listen(1)
+            self.sock.settimeout(self.poll_interval)
+            self.thread_helper(self.socket_listener, 'quad-mag-stop-socket')
+        if self.hotkey is not None :
+            try :
+                import keyboard
+                self.hotkey_handle = keyboard.add_hotkey(self.hotkey, self.request, args=('hotkey',))
+            except Exception as e : #no keyboard package or no permission to hook the keyboard
+                print("Stop hotkey '" + str(self.hotkey) + "' unavailable (" + str(e) + "), use Ctrl-C instead")
+        return self
+
+    def thread_helper(self, target, name) :
+        th = threading.Thread(target=target, name=name, daemon=True)
+        th.start()
+        self.threads.append(th)
+
+    def signal_handler(self, signum, frame) :
+        if self.requested and signum == signal.SIGINT : #second Ctrl-C, stop waiting for the quad-mag
+            raise KeyboardInterrupt
+        self.request(signal.Signals(signum).name)
+
+    def file_watcher(self) :
+        while not self.closed.wait(self.poll_interval) :
+            if os.path.exists(self.control_file) :
+                try :
+                    os.remove(self.control_file)
+                except OSError :
+                    pass
+                self.request('control file')
+
+    def socket_listener(self) :
+        while not self.closed.is_set() :
+            try :
+                cn, ad = self.sock.accept()
+            except socket.timeout :
+                continue
+            except OSError : #socket closed
+                break
+            with cn :
+                cn.settimeout(1)
+                try :
+                    cmd = cn.recv(64).decode('ascii', 'replace').strip().lower()
+                except OSError :
+                    continue
+                if cmd == 'stop' :
+                    self.request('socket')
+                    cn.sendall(b'ok\n')
+                elif cmd == 'status' :
+                    cn.sendall(b'stopping\n' if self.requested else b'running\n')
+                else :
+                    cn.sendall(b'unknown command\n')
+
+    def close(self) :
+        # Function Definition: Removes the stop sources and restores the previous signal handlers
+        self.closed.set()
+        for sg, hd in self.previous_handlers.items() :
+            signal.signal(sg, hd)
+        self.previous_handlers = {}
+        if self.sock is not None :
+            self.sock.close()
+            self.sock = None
+        for th in self.threads :
+            th.join()
+        self.threads = []
+        if self.hotkey_handle is not None :
+            import keyboard
+            keyboard.remove_hotkey(self.hotkey_handle)
+            self.hotkey_handle = None
+
+    def __enter__(self) :
+        return self.start()
+
+    def __exit__(self, *exc) :
+        self.close()
+
+###End Stop Control###
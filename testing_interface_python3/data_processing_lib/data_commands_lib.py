@@ -1,11 +1,12 @@
 from sys import byteorder
 import numpy as np
 import matplotlib.pyplot as plt
-import keyboard
 import time
 
 from . import data_plotting_lib as dpl
 from . import data_decoding_lib as ddl
+from . import data_manipulation_lib as dml
+from . import data_acquisition_lib as dal
 
 ###Various Command Flags###
 #
@@ -16,8 +17,32 @@ from . import data_decoding_lib as ddl
 # 2 -> stability test
 # 3 -> sensitivity Test
 # 4 -> linear frequency response test
+# b -> binary raw capture (_raw_data.bin)
+# k -> bulk acquisition (drain the serial buffer and decode every packet in it at once)
+# w -> threaded acquisition (reader thread fills a queue, a second thread decodes and writes)
 #
 
+bulk_read_size = 1 << 16 #initial size of the reusable serial read buffer used by bulk acquisition
+
+threaded_queue_bytes = 1 << 24 #bytes the threaded acquisition queue holds before threaded_queue_policy applies
+threaded_queue_policy = 'block' #what to do when the consumer falls behind -> 'block', 'drop-oldest' or 'spill' (see data_acquisition_lib)
+
+capture_flush_bytes = 1 << 20 #capture files are written in blocks of about this many bytes...
+capture_flush_interval = 1.0 #...or at least this often (sec)
+capture_fsync_interval = 0 #force captures to disk this often (sec), 0 only at the end of the measurement
+capture_background_flush = True #write the blocks from a background thread so the acquisition loop never waits on the disk
+
+live_stats_interval = 5 #print running statistics of continuous measurements this often (sec), 0 disables
+live_stats_export = 1 #also append them to a _live_stats.txt csv (and the noise densities to _live_psd.txt)
+live_psd_segment = 16 #seconds of samples per welch segment of the live noise density, 0 disables
+live_psd_band = None #[low, high] Hz band the live noise density is averaged over, None uses the first frequency above 1 Hz
+
+stop_control_file = 'data_storage/stop' #creating this file stops a running measurement, None disables
+stop_control_port = 0 #sending "stop" to this local tcp port stops a running measurement, 0 disables
+stop_hotkey = 'q' #optional hotkey, needs the keyboard package (and root on linux), None disables
+
+stop_command = b'\x08\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
 ###Command Functions###
 
 def set_mag_config(ser, flag):
@@ -320,6 +345,7 @@ def single_measurement(ser, flag):
     enabled_verbose = True if flag.find('v') != -1 else False
     enabled_debug = True if flag.find('d') != -1 else False
     enabled_plotting = True if flag.find('p') != -1 else False
+    enabled_binary = True if flag.find('b') != -1 else False
 
 
     write_file_name = ''
@@ -327,8 +353,11 @@ def single_measurement(ser, flag):
     while 1:
         write_file_name = input("\nWhat is the name of the file you want to write data to (don't include file extension, must be in a csv format)?\n")
         try:
-            write_file_raw = open((file_path + write_file_name + '_raw_data.txt'), 'w+')
-            write_file_processed = open((file_path + write_file_name + '_processed_data.txt'), 'w+')
+            if enabled_binary :
+                write_file_raw = capture_writer_helper(open((file_path + write_file_name + '_raw_data.bin'), 'wb+'))
+            else :
+                write_file_raw = capture_writer_helper(open((file_path + write_file_name + '_raw_data.txt'), 'w+'))
+            write_file_processed = capture_writer_helper(open((file_path + write_file_name + '_processed_data.txt'), 'w+'))
             break
         except FileExistsError:
             print("\nThat file could not be written to...try again\n")
@@ -360,17 +389,25 @@ def single_measurement(ser, flag):
 
     command = command + (mags_enabled).to_bytes(1, byteorder='big')
 
+    if enabled_binary :
+        ddl.write_raw_binary_header(write_file_raw, int(sensor_configs[0:4], 16), int(sensor_configs[6:8], 16),
+            packet_flag_helper(enabled_imu, enabled_temperature),
+            int(sensor_configs[12:14], 16) if enabled_imu else 0, int(sensor_configs[22:24], 16) if enabled_imu else 0)
+
     if enabled_imu :
-        write_file_raw.write(
-            "Mag Cycle Count, Mag Number of Oversamples, Accel Gain, Gyro Gain (readings are raw)\n")
+        if not enabled_binary :
+            write_file_raw.write(
+                "Mag Cycle Count, Mag Number of Oversamples, Accel Gain, Gyro Gain (readings are raw)\n")
         write_file_processed.write(
             "Mag Cycle Count, Mag Number of Oversamples, Accel Gain, Gyro Gain (readings are in lsb form)\n")
     else:
-        write_file_raw.write(
-            "Mag Cycle Count, Mag Number of Oversamples (readings are raw)\n")
+        if not enabled_binary :
+            write_file_raw.write(
+                "Mag Cycle Count, Mag Number of Oversamples (readings are raw)\n")
         write_file_processed.write("Mag Cycle Count, Mag Number of Oversamples (readings are in lsb form)\n")
 
-    write_file_raw.write(sensor_configs_csv + '\n\n')
+    if not enabled_binary :
+        write_file_raw.write(sensor_configs_csv + '\n\n')
     write_file_processed.write(str(int(sensor_configs_csv[0:4], 16)) + ',' + str(int(sensor_configs_csv[5:7], 16)) + '\n\n')
 
     if enabled_temperature  and enabled_imu :
@@ -395,29 +432,42 @@ def single_measurement(ser, flag):
     invalid_packet_count = 0
     invalid_packet_threshold = 10  #10% of expected measurements
     return_string = ""
+    packet_framer = ddl.packet_framer()
+    packet_framer.stopping = True # the '0a' right after the measurement ends it
+    resyncs_counted = 0
     while 1:
         
-        returned_bytes_string = get_response_helper(ser)
+        returned_bytes_string = get_response_framed_helper(ser, packet_framer)
+        # checksum failures and dropped/extra bytes both show up as framer resyncs
+        invalid_packet_count = invalid_packet_count + packet_framer.resyncs - resyncs_counted
+        resyncs_counted = packet_framer.resyncs
         # Stops the python program from attempting invalid string
         # operations....
         if returned_bytes_string[1] == "COMPLETE":
             return_string = "\nContinuous measurement completed successfully!"
             break
         elif invalid_packet_count > invalid_packet_threshold:
+            write_file_raw.close()
+            write_file_processed.close()
             return "\nToo many invalid packets received, continuous measurement did not complete successfully!"
         elif len(returned_bytes_string[1]) > 0:
             total_measurements = total_measurements + 1
             if enabled_verbose:
                 print(str(total_measurements) + "," + returned_bytes_string[1])
-            write_file_raw.write(returned_bytes_string[0] + "\n")
+            if enabled_binary :
+                write_file_raw.write(bytes.fromhex(returned_bytes_string[0]))
+            else :
+                write_file_raw.write(returned_bytes_string[0] + "\n")
             write_file_processed.write(returned_bytes_string[1] + "\n")
         else:
             invalid_packet_count = invalid_packet_count + 1
 
     print("\n******Finished a single measurement******\n")
     print("\nInvalid Packets Received: " + str(invalid_packet_count) + "\n")
+    print("\nBytes Skipped Resynchronizing: " + str(packet_framer.skipped) + "\n")
 
     write_file_raw.close()
+    write_file_processed.flush()
     
     if enabled_plotting:
         create_plots = input(
@@ -440,6 +490,9 @@ def continuous_measurement(ser, flag):
     enabled_verbose = True if flag.find('v') != -1 else False
     enabled_debug = True if flag.find('d') != -1 else False
     enabled_plotting = True if flag.find('p') != -1 else False
+    enabled_binary = True if flag.find('b') != -1 else False
+    enabled_bulk = True if flag.find('k') != -1 else False
+    enabled_threaded = True if flag.find('w') != -1 else False
 
 
     write_file_name = ''
@@ -447,8 +500,11 @@ def continuous_measurement(ser, flag):
     while 1:
         write_file_name = input("\nWhat is the name of the file you want to write data to (don't include file extension, must be in a csv format)?\n")
         try:
-            write_file_raw = open((file_path + write_file_name + '_raw_data.txt'), 'w+')
-            write_file_processed = open((file_path + write_file_name + '_processed_data.txt'), 'w+')
+            if enabled_binary :
+                write_file_raw = capture_writer_helper(open((file_path + write_file_name + '_raw_data.bin'), 'wb+'))
+            else :
+                write_file_raw = capture_writer_helper(open((file_path + write_file_name + '_raw_data.txt'), 'w+'))
+            write_file_processed = capture_writer_helper(open((file_path + write_file_name + '_processed_data.txt'), 'w+'))
             break
         except FileExistsError:
             print("\nThat file could not be written to...try again\n")
@@ -486,36 +542,15 @@ def continuous_measurement(ser, flag):
         "\nEnter how long to take measurements for in seconds (leave blank or enter 0 for custom period): ")
     if measurement_length == '' or measurement_length == '0' :
         measurement_length = 4294967295
-        command = command + (measurement_length).to_bytes(6, byteorder='big') #keyboard interrupt will cut off measurement
+        command = command + (measurement_length).to_bytes(6, byteorder='big') #stop control (Ctrl-C, control file, socket) will cut off measurement
     else :
         command = command + (int(measurement_length)).to_bytes(6, byteorder='big')
     
-    if enabled_imu :
-        write_file_raw.write(
-            "Mag Cycle Count, Mag Number of Oversamples, Accel Gain, Gyro Gain (readings are raw)\n")
-        write_file_processed.write(
-            "Mag Cycle Count, Mag Number of Oversamples, Accel Gain, Gyro Gain (readings are in lsb form)\n")
-    else:
-        write_file_raw.write(
-            "Mag Cycle Count, Mag Number of Oversamples (readings are raw)\n")
-        write_file_processed.write("Mag Cycle Count, Mag Number of Oversamples (readings are in lsb form)\n")
-
-    write_file_raw.write(sensor_configs_csv + '\n\n')
-    write_file_processed.write(str(int(sensor_configs_csv[0:4], 16)) + ',' + str(int(sensor_configs_csv[5:7], 16)) + '\n\n')
-
-    if enabled_temperature  and enabled_imu :
-        write_file_processed.write(
-            "Packet Flag, System Time (sec), B1-X , B1-Y, B1-Z, B2-X, B2-Y, B2-Z, B3-X, B3-Y, B3-Z, B4-X, B4-Y, B4-Z, Acc-X, Acc-Y, Acc-Z, Gyr-X, Gyr-Y, Gyr-Z, Temp\n")
-    elif not enabled_temperature and not enabled_imu :
-        write_file_processed.write(
-            "Packet Flag, System Time (sec), B1-X , B1-Y, B1-Z, B2-X, B2-Y, B2-Z, B3-X, B3-Y, B3-Z, B4-X, B4-Y, B4-Z\n")
-    elif enabled_imu :
-        write_file_processed.write(
-            "Packet Flag, System Time (sec), B1-X , B1-Y, B1-Z, B2-X, B2-Y, B2-Z, B3-X, B3-Y, B3-Z, B4-X, B4-Y, B4-Z, Acc-X, Acc-Y, Acc-Z, Gyr-X, Gyr-Y, Gyr-Z\n")
-    else:
-        write_file_processed.write(
-            "Packet Flag, System Time (sec), B1-X , B1-Y, B1-Z, B2-X, B2-Y, B2-Z, B3-X, B3-Y, B3-Z, B4-X, B4-Y, B4-Z, Temp\n")
+    write_headers_helper(write_file_raw, write_file_processed, sensor_configs, sensor_configs_csv, enabled_imu, enabled_temperature, enabled_binary)
 
+    measurement_stop = stop_control_helper()
+    stop_sent = False
+    live_stats = live_stats_open_helper(sensor_configs, file_path + write_file_name, sample_rate)
     ser.write(command)
 
     if enabled_debug:
@@ -527,45 +562,135 @@ def continuous_measurement(ser, flag):
     invalid_packet_threshold = int(float(expected_measurements) * 0.1)  #10% of expected measurements
     print_threshold = int(float(expected_measurements) * 0.05) #5% of expected measurements
     return_string = ""
-    while 1:
+    packet_framer = ddl.packet_framer()
+    read_buffer = bytearray(bulk_read_size)
+    resyncs_counted = 0
+
+    if enabled_threaded:
+        # Reader thread only fills the queue, framing/decoding/printing/writing happen on the consumer thread
+        measurement_counts = [0]
+        def consume_bytes(data):
+            packet_framer.feed(data)
+            for packet_flag, packets in packet_framer.next_blocks():
+                if packet_flag == '0a':
+                    return True
+                decoded_columns = ddl.decode_packet_array_quad(packets, packet_flag)
+                rows = write_packets_helper(write_file_raw, write_file_processed, packet_flag, packets, enabled_binary, decoded_columns)
+                live_stats_update_helper(live_stats, decoded_columns)
+                if enabled_verbose:
+                    for i, row in enumerate(rows):
+                        print(str(measurement_counts[0] + i + 1) + "," + row)
+                measurement_counts[0] = measurement_counts[0] + len(rows)
+            return False
+        pipeline = dal.acquisition_pipeline(ser, consume_bytes, threaded_queue_bytes, threaded_queue_policy,
+            file_path + write_file_name + '_spill.bin')
+        pipeline.start()
+        while not pipeline.finished.wait(0.2):
+            if enabled_verbose:
+                queue_stats = pipeline.stats()
+                print(str(measurement_counts[0]) + "/" + str(expected_measurements) + " measurements received, queue " +
+                      str(queue_stats['depth']) + " bytes (high-water " + str(queue_stats['high_water']) + ")")
+            if measurement_stop.requested and not stop_sent:
+                packet_framer.stopping = True
+                ser.write(stop_command) # the '0a' that confirms the stop ends the consumer thread
+                stop_sent = True
+        pipeline.join()
+        total_measurements = measurement_counts[0]
+        invalid_packet_count = packet_framer.resyncs
+        queue_stats = pipeline.stats()
+        print("\nQueue High-Water Mark (bytes): " + str(queue_stats['high_water']) + "\nBytes Dropped: " + str(queue_stats['dropped']) +
+              "\nBytes Spilled To Disk: " + str(queue_stats['spilled']) + "\n")
+        if pipeline.error is not None:
+            print("\nAcquisition error: " + str(pipeline.error) + "\n")
+        if pipeline.completed or packet_framer.complete_pending():
+            return_string = "\nContinuous measurement completed successfully!"
+        else:
+            return_string = "\nContinuous measurement ended before the quad-mag reported completion!"
+
+    while enabled_bulk and not enabled_threaded:
+
+        # Frame, validate, decode and write everything that arrived since the last read in one go
+        read_count, invalid_packets, written, finished = bulk_read_helper(ser, packet_framer, read_buffer, write_file_raw,
+                                                                          write_file_processed, enabled_binary, live_stats)
+        invalid_packet_count = invalid_packet_count + invalid_packets
+        for rows in written:
+            previous_measurements = total_measurements
+            total_measurements = total_measurements + len(rows)
+            if enabled_verbose:
+                for i, row in enumerate(rows):
+                    print(str(previous_measurements + i + 1) + "," + row)
+                if print_threshold > 0 and previous_measurements // print_threshold != total_measurements // print_threshold:
+                    print(str(total_measurements) + "/" +
+                          str(expected_measurements) + " measurements received")
+        if finished:
+            return_string = "\nContinuous measurement completed successfully!"
+            break
+        elif invalid_packet_count > invalid_packet_threshold:
+            measurement_stop.close()
+            live_stats_close_helper(live_stats)
+            write_file_raw.close()
+            write_file_processed.close()
+            return "\nToo many invalid packets received, continuous measurement did not complete successfully!"
+
+        if measurement_stop.requested and not stop_sent:
+            packet_framer.stopping = True
+            ser.write(stop_command) # the '0a' that confirms the stop ends the loop
+            stop_sent = True
+
+    while not enabled_bulk and not enabled_threaded:
 
         # Print roughly how many measurements have been taken periodically
         if enabled_verbose and total_measurements % print_threshold == 0:
             print(str(total_measurements) + "/" +
                   str(expected_measurements) + " measurements received")
         
-        returned_bytes_string = get_response_helper(ser)
+        returned_bytes_string = get_response_framed_helper(ser, packet_framer)
+        # checksum failures and dropped/extra bytes both show up as framer resyncs
+        invalid_packet_count = invalid_packet_count + packet_framer.resyncs - resyncs_counted
+        resyncs_counted = packet_framer.resyncs
         # Stops the python program from attempting invalid string
         # operations....
         if returned_bytes_string[1] == "COMPLETE":
             return_string = "\nContinuous measurement completed successfully!"
             break
         elif invalid_packet_count > invalid_packet_threshold:
+            measurement_stop.close()
+            live_stats_close_helper(live_stats)
+            write_file_raw.close()
+            write_file_processed.close()
             return "\nToo many invalid packets received, continuous measurement did not complete successfully!"
         elif len(returned_bytes_string[1]) > 0:
             total_measurements = total_measurements + 1
             if enabled_verbose:
                 print(str(total_measurements) + "," + returned_bytes_string[1])
-            write_file_raw.write(returned_bytes_string[0] + "\n")
+            if enabled_binary :
+                write_file_raw.write(bytes.fromhex(returned_bytes_string[0]))
+            else :
+                write_file_raw.write(returned_bytes_string[0] + "\n")
             write_file_processed.write(returned_bytes_string[1] + "\n")
-        else:
+            live_stats_packet_helper(live_stats, returned_bytes_string[0])
+        else: # timed out
             invalid_packet_count = invalid_packet_count + 1
 
-        try:  # Used try so that if user pressed other than the given key error will not be shown or do nothing
-            if keyboard.is_pressed('q'):  # if key 'q' is pressed 
-                stop_all_operations(ser, flag)
-                write_file_raw.close()
-                write_file_processed.close()
-                return '\nYou have manually forced this measurement session to end, continuous measurement completed successfully!'  # finishing the loop
-        except :
-            continue #aka do nothing
+        if measurement_stop.requested and not stop_sent:
+            packet_framer.stopping = True
+            ser.write(stop_command) # the '0a' that confirms the stop ends the loop
+            stop_sent = True
+
+    measurement_stop.close()
+    live_stats_close_helper(live_stats)
+    if stop_sent:
+        return_string = '\nYou have manually forced this measurement session to end (' + str(measurement_stop.reason) + '), continuous measurement completed successfully!'
 
     print("\n******Finished a continuous measurement******\n")
     print("\nExpected Measurements: " + str(expected_measurements))
     print("\nMissing Measurements: " + str(expected_measurements - total_measurements) + "\n")
     print("\nInvalid Packets Received: " + str(invalid_packet_count) + "\n")
+    print("\nBytes Skipped Resynchronizing: " + str(packet_framer.skipped) + "\n")
 
     write_file_raw.close()
+    write_file_processed.flush()
+    writer_stats_helper(write_file_raw)
     
     if enabled_plotting:
         create_plots = input(
@@ -578,6 +703,114 @@ def continuous_measurement(ser, flag):
     return return_string
 
 
+def multi_board_measurement(sers, flag):
+    # Function Definition: Requests continuous measurements from several quad-mags at once, every board is read on its own thread
+    # and written to its own files, a merged index puts the packets of all boards on the host clock
+    # Input: List of Serial Objects, Flag that contains options for function eg. verbose (v), debug (d)
+    # Output: String that tells the caller the measurements have been completed
+
+    enabled_imu = True if flag.find('i') != -1 else False
+    enabled_temperature = True if flag.find('t') != -1 else False
+    enabled_verbose = True if flag.find('v') != -1 else False
+    enabled_debug = True if flag.find('d') != -1 else False
+    enabled_binary = True if flag.find('b') != -1 else False
+
+    write_file_name = ''
+    file_path = 'data_storage/'
+    while 1:
+        write_file_name = input("\nWhat is the name of the file you want to write data to (don't include file extension, each board gets its own _board# files)?\n")
+        try:
+            write_files_raw = []
+            write_files_processed = []
+            for board in range(len(sers)):
+                board_file_name = file_path + write_file_name + '_board' + str(board + 1)
+                if enabled_binary :
+                    write_files_raw.append(capture_writer_helper(open(board_file_name + '_raw_data.bin', 'wb+')))
+                else :
+                    write_files_raw.append(capture_writer_helper(open(board_file_name + '_raw_data.txt', 'w+')))
+                write_files_processed.append(capture_writer_helper(open(board_file_name + '_processed_data.txt', 'w+')))
+            break
+        except FileExistsError:
+            print("\nThat file could not be written to...try again\n")
+
+    for board, ser in enumerate(sers):
+        print("\nConfiguring board " + str(board + 1))
+        sensor_configs = set_mag_config(ser, flag)
+        sensor_configs_csv = sensor_configs[0:4] + "," + sensor_configs[6:8]
+        if enabled_imu :
+            sensor_configs = sensor_configs + set_imu_config(ser, flag)
+            sensor_configs_csv = sensor_configs_csv + "," + sensor_configs[12:14]
+            sensor_configs_csv = sensor_configs_csv + "," + sensor_configs[22:24]
+        write_headers_helper(write_files_raw[board], write_files_processed[board], sensor_configs, sensor_configs_csv,
+            enabled_imu, enabled_temperature, enabled_binary)
+
+    mags_enabled = 0b1111 #all mags are enabled by default
+    disable_mags = input("\nDo you want to disable any mags on every board (Y/n)? ")
+    if disable_mags == 'Y' :
+        mags_to_disable = input("\nEnter the mag numbers you would like to disable as a single string eg. 1234\n")
+        for me in range(0, 4) :
+            if mags_to_disable.find(str(me + 1)) != -1 :
+                mags_enabled = mags_enabled & ~(1 << me)
+
+    measurement_length = input(
+        "\nEnter how long to take measurements for in seconds (leave blank or enter 0 for custom period): ")
+    if measurement_length == '' or measurement_length == '0' :
+        measurement_length = 4294967295 #stop control (Ctrl-C, control file, socket) will cut off measurement
+    command = b'\x06' + b'\x00\x00' + (mags_enabled).to_bytes(1, byteorder='big') + (int(measurement_length)).to_bytes(6, byteorder='big')
+
+    writes = [lambda packet_flag, packets, decoded_columns, raw=raw, processed=processed:
+              write_packets_helper(raw, processed, packet_flag, packets, enabled_binary, decoded_columns)
+              for raw, processed in zip(write_files_raw, write_files_processed)]
+    acquisition = dal.multi_board_acquisition(sers, writes).start()
+    measurement_stop = stop_control_helper()
+    for ser in sers:
+        ser.write(command)
+
+    if enabled_debug:
+        print("\nDEBUG: THIS IS THE COMMAND YOU JUST SENT TO EVERY BOARD\n" + str(command) + "\n")
+
+    stop_sent = False
+    last_print = 0
+    while acquisition.alive():
+        acquisition.join(0.2)
+        if enabled_verbose and acquisition.elapsed() - last_print >= 1:
+            last_print = acquisition.elapsed()
+            print(", ".join(board.name + ": " + str(board.packets) for board in acquisition.boards) + " measurements received")
+        if measurement_stop.requested and not stop_sent:
+            for ser, board in zip(sers, acquisition.boards):
+                board.framer.stopping = True
+                ser.write(stop_command) # the '0a' that confirms the stop ends that board's reader
+            stop_sent = True
+    elapsed = acquisition.elapsed()
+    measurement_stop.close()
+
+    for raw, processed in zip(write_files_raw, write_files_processed):
+        raw.close()
+        processed.close()
+        if enabled_verbose:
+            writer_stats_helper(raw)
+    indexed = acquisition.write_merged_index(file_path + write_file_name + '_merged_index.txt')
+
+    print("\n******Finished a multi-board measurement******\n")
+    total_bytes = 0
+    all_completed = True
+    for name, board_stats in acquisition.stats().items():
+        print(name + ": " + str(board_stats['packets']) + " measurements, " + str(board_stats['skipped']) + " bytes skipped resynchronizing, clock offset " +
+              "%.6f" % board_stats['offset'] + " sec, drift " + "%.2f" % (board_stats['drift'] * 1e6) + " ppm")
+        if board_stats['error'] is not None:
+            print(name + " acquisition error: " + str(board_stats['error']))
+        total_bytes = total_bytes + board_stats['bytes_read']
+        all_completed = all_completed and board_stats['completed']
+    print("\nAggregate Throughput: " + "%.1f" % (total_bytes / max(elapsed, 1e-9) / 1024) + " KiB/s over " + str(len(sers)) + " boards")
+    print("\nMerged Index Entries: " + str(indexed) + "\n")
+
+    if stop_sent:
+        return '\nYou have manually forced this measurement session to end (' + str(measurement_stop.reason) + '), multi-board measurement completed successfully!'
+    if all_completed:
+        return "\nMulti-board measurement completed successfully!"
+    return "\nMulti-board measurement ended before every quad-mag reported completion!"
+
+
 def send_data(ser, flag):
     # Function Definition: Send any data we have available
     # Input: Serial object, Flag that contains options for function eg. verbose (v), debug (d)
@@ -596,7 +829,7 @@ def stop_all_operations(ser, flag):
     # Function Definition: Stops all sensors and puts controller in ulp mode
     # Input: serial object, Flag that contains options for function eg. verbose (v), debug (d)
     # Output: String confirming whether the command was successfully executed
-    command = b'\x08\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+    command = stop_command
     ser.write(command)
     returned_bytes_string = get_response_helper(ser)
     if returned_bytes_string[1] == "COMPLETE":
@@ -615,38 +848,14 @@ def get_response_helper(ser):
     # operations....
     if packet_flag == "0a":
         return ['', "COMPLETE"]
-    # Debug Flag
-    elif packet_flag == '01':
-        returned_bytes = ser.read(17)
-        if len(returned_bytes) == 17:
-            if ddl.valid_checksum(returned_bytes, packet_flag):
-                dc = ddl.decode_serial_byte_stream_quad(returned_bytes, packet_flag)
-                dc[0] = packet_flag + dc[0]
-                dc[1] = packet_flag + "," + dc[1]
-                return dc
-            else:
-                return ""
-    # Mag Config Flag
-    elif packet_flag == '02':
-        return (ser.read(8).hex())
-    # IMU Config Flag
-    elif packet_flag == '03':
-        return (ser.read(9).hex())
-    # Mag Data Only Flag
-    elif packet_flag == '04':
-        returned_bytes = ser.read(44)
-        if len(returned_bytes) == 44:
-            if ddl.valid_checksum(returned_bytes, packet_flag):
-                dc = ddl.decode_serial_byte_stream_quad(returned_bytes, packet_flag)
-                dc[0] = packet_flag + dc[0]
-                dc[1] = packet_flag + "," + dc[1]
-                return dc
-            else:
-                return ""
-    # All Sensors Data Flag
-    elif packet_flag == '05':
-        returned_bytes = ser.read(58)
-        if len(returned_bytes) == 58:
+    # Mag/IMU Config Flags
+    elif packet_flag in ddl.config_lengths:
+        return (ser.read(ddl.config_lengths[packet_flag]).hex())
+    # Debug and Data Flags, lengths and checksums come from the packet layouts in data_decoding_lib
+    elif packet_flag in ddl.packet_lengths:
+        packet_length = ddl.packet_lengths[packet_flag]
+        returned_bytes = ser.read(packet_length)
+        if len(returned_bytes) == packet_length:
             if ddl.valid_checksum(returned_bytes, packet_flag):
                 dc = ddl.decode_serial_byte_stream_quad(returned_bytes, packet_flag)
                 dc[0] = packet_flag + dc[0]
@@ -654,32 +863,259 @@ def get_response_helper(ser):
                 return dc
             else:
                 return ""
-    # Mag and TMP data flag
-    elif packet_flag == '06':
-        returned_bytes = ser.read(46)
-        if len(returned_bytes) == 46:
-            if ddl.valid_checksum(returned_bytes, packet_flag):
-                dc = ddl.decode_serial_byte_stream_quad(returned_bytes, packet_flag)
-                dc[0] = packet_flag + dc[0]
-                dc[1] = packet_flag + "," + dc[1]
-                return dc
-            else:
-                return ""
-    # Mag and IMU data flag
-    elif packet_flag == '07':
-        returned_bytes = ser.read(56)
-        if len(returned_bytes) == 56:
-            if ddl.valid_checksum(returned_bytes, packet_flag):
-                dc = ddl.decode_serial_byte_stream_quad(returned_bytes, packet_flag)
-                dc[1] = packet_flag + "," + dc[1]
-                return dc
-            else:
-                return ""
     # Invalid Packet
     else:
         return ""
 
 
+def get_response_framed_helper(ser, packet_framer):
+    # Function Definition: Gets the next response through a packet framer, which resynchronizes the stream after dropped or extra bytes
+    # Input: Serial object, packet_framer holding bytes already read
+    # Output: Same as get_response_helper, ['', ''] if the read timed out (unless it leaves a completion, see packet_framer.complete_pending)
+    while 1:
+        packet = packet_framer.next_packet()
+        if packet is not None:
+            break
+        returned_bytes = ser.read(max(1, ser.in_waiting))
+        if len(returned_bytes) == 0:
+            if packet_framer.complete_pending():
+                return ['', "COMPLETE"]
+            return ['', '']
+        packet_framer.feed(returned_bytes)
+    packet_flag = packet[0]
+    if packet_flag == '0a':
+        return ['', "COMPLETE"]
+    dc = ddl.decode_serial_byte_stream_quad(packet[1], packet_flag)
+    dc[0] = packet_flag + dc[0]
+    dc[1] = packet_flag + "," + dc[1]
+    return dc
+
+
+def get_responses_bulk_helper(ser, packet_framer, read_buffer):
+    # Function Definition: Drains everything waiting on the serial port into a reusable buffer and frames every complete packet in it,
+    # a partial packet at the end is carried over to the next call by the packet framer
+    # Input: Serial object, packet_framer, bytearray read_buffer (reused between calls, grows to fit what is waiting)
+    # Output: [int bytes read (0 if the read timed out), list of [packet flag, numpy array of packets] blocks (see packet_framer.next_blocks),
+    # [] when the bytes read only hold part of a packet, a '0a' block when a timed out read leaves a completion (see packet_framer.complete_pending)]
+    waiting = max(1, ser.in_waiting)
+    if waiting > len(read_buffer):
+        read_buffer.extend(bytes(waiting - len(read_buffer)))
+    read_view = memoryview(read_buffer)
+    read_count = ser.readinto(read_view[0:waiting])
+    if read_count:
+        packet_framer.feed(read_view[0:read_count])
+    del read_view
+    if not read_count:
+        return [0, [['0a', np.zeros((0, 0), dtype=np.uint8)]] if packet_framer.complete_pending() else []]
+    return [read_count, packet_framer.next_blocks()]
+
+
+def bulk_read_helper(ser, packet_framer, read_buffer, write_file_raw, write_file_processed, enabled_binary, live_stats=None):
+    # Function Definition: One pass of the bulk loop of continuous_measurement, reads everything waiting on the serial port and decodes
+    # and writes every block framed from it
+    # Input: Serial object, packet_framer, bytearray read_buffer (see get_responses_bulk_helper), raw file object, processed file object,
+    # bool binary raw file, dict from live_stats_open_helper (or None)
+    # Output: [int bytes read, int invalid packets (a timed out read, checksum failures and dropped/extra bytes show up as framer resyncs),
+    # list of the processed rows written for each block, bool whether the quad-mag reported completion]
+    resyncs = packet_framer.resyncs
+    read_count, blocks = get_responses_bulk_helper(ser, packet_framer, read_buffer)
+    invalid_packets = packet_framer.resyncs - resyncs
+    if read_count == 0 and len(blocks) == 0: # timed out, a read holding only part of a packet is not an invalid packet
+        invalid_packets = invalid_packets + 1
+    written = []
+    for packet_flag, packets in blocks:
+        if packet_flag == '0a':
+            return [read_count, invalid_packets, written, True]
+        decoded_columns = ddl.decode_packet_array_quad(packets, packet_flag)
+        written.append(write_packets_helper(write_file_raw, write_file_processed, packet_flag, packets, enabled_binary, decoded_columns))
+        live_stats_update_helper(live_stats, decoded_columns)
+    return [read_count, invalid_packets, written, False]
+
+
+def write_packets_helper(write_file_raw, write_file_processed, packet_flag, packets, enabled_binary, decoded_columns=None):
+    # Function Definition: Decodes a block of packets in bulk and writes the raw and processed data
+    # Input: raw file object, processed file object, String packet flag, numpy array of packets (N, packet length), bool binary raw file,
+    # dict of columns if the block was already decoded (see decode_packet_array_quad)
+    # Output: List of processed rows that were written
+    records = np.empty((len(packets), packets.shape[1] + 1), dtype=np.uint8)
+    records[:, 0] = int(packet_flag, 16)
+    records[:, 1:] = packets
+    if enabled_binary:
+        write_file_raw.write(records.tobytes())
+    else:
+        raw_hex = records.tobytes().hex()
+        record_width = 2 * records.shape[1]
+        write_file_raw.write("\n".join(raw_hex[i:i+record_width] for i in range(0, len(raw_hex), record_width)) + "\n")
+    if decoded_columns is None:
+        decoded_columns = ddl.decode_packet_array_quad(packets, packet_flag)
+    rows = ddl.format_columns_quad(decoded_columns, packet_flag)
+    write_file_processed.write("\n".join(rows) + "\n")
+    return rows
+
+
+def write_headers_helper(write_file_raw, write_file_processed, sensor_configs, sensor_configs_csv, enabled_imu, enabled_temperature, enabled_binary):
+    # Function Definition: Writes the config and column headers of a continuous measurement's raw and processed files
+    # Input: raw file object, processed file object, String sensor configs (hex), String sensor configs csv, bool imu enabled,
+    # bool temperature enabled, bool binary raw file
+    # Output: None
+    if enabled_binary :
+        ddl.write_raw_binary_header(write_file_raw, int(sensor_configs[0:4], 16), int(sensor_configs[6:8], 16),
+            packet_flag_helper(enabled_imu, enabled_temperature),
+            int(sensor_configs[12:14], 16) if enabled_imu else 0, int(sensor_configs[22:24], 16) if enabled_imu else 0)
+
+    if enabled_imu :
+        if not enabled_binary :
+            write_file_raw.write(
+                "Mag Cycle Count, Mag Number of Oversamples, Accel Gain, Gyro Gain (readings are raw)\n")
+        write_file_processed.write(
+            "Mag Cycle Count, Mag Number of Oversamples, Accel Gain, Gyro Gain (readings are in lsb form)\n")
+    else:
+        if not enabled_binary :
+            write_file_raw.write(
+                "Mag Cycle Count, Mag Number of Oversamples (readings are raw)\n")
+        write_file_processed.write("Mag Cycle Count, Mag Number of Oversamples (readings are in lsb form)\n")
+
+    if not enabled_binary :
+        write_file_raw.write(sensor_configs_csv + '\n\n')
+    write_file_processed.write(str(int(sensor_configs_csv[0:4], 16)) + ',' + str(int(sensor_configs_csv[5:7], 16)) + '\n\n')
+
+    if enabled_temperature  and enabled_imu :
+        write_file_processed.write(
+            "Packet Flag, System Time (sec), B1-X , B1-Y, B1-Z, B2-X, B2-Y, B2-Z, B3-X, B3-Y, B3-Z, B4-X, B4-Y, B4-Z, Acc-X, Acc-Y, Acc-Z, Gyr-X, Gyr-Y, Gyr-Z, Temp\n")
+    elif not enabled_temperature and not enabled_imu :
+        write_file_processed.write(
+            "Packet Flag, System Time (sec), B1-X , B1-Y, B1-Z, B2-X, B2-Y, B2-Z, B3-X, B3-Y, B3-Z, B4-X, B4-Y, B4-Z\n")
+    elif enabled_imu :
+        write_file_processed.write(
+            "Packet Flag, System Time (sec), B1-X , B1-Y, B1-Z, B2-X, B2-Y, B2-Z, B3-X, B3-Y, B3-Z, B4-X, B4-Y, B4-Z, Acc-X, Acc-Y, Acc-Z, Gyr-X, Gyr-Y, Gyr-Z\n")
+    else:
+        write_file_processed.write(
+            "Packet Flag, System Time (sec), B1-X , B1-Y, B1-Z, B2-X, B2-Y, B2-Z, B3-X, B3-Y, B3-Z, B4-X, B4-Y, B4-Z, Temp\n")
+
+
+def capture_writer_helper(write_file):
+    # Function Definition: Wraps a capture file in a write-behind capture writer using the capture_ settings above
+    # Input: file object
+    # Output: capture_writer (used exactly like the file object)
+    return dal.capture_writer(write_file, capture_flush_bytes, capture_flush_interval, capture_fsync_interval, capture_background_flush)
+
+
+def live_stats_open_helper(sensor_configs, file_name, sample_rate):
+    # Function Definition: Starts the running statistics and noise density of a continuous measurement using the live_ settings above
+    # Input: String sensor configs (hex, cycle count and oversamples are used for the nT scale), String file name without extension,
+    # float expected sample rate (sizes the welch segments)
+    # Output: dict holding the running_stats, streaming_welch and when to report next, None if live statistics are disabled
+    if live_stats_interval <= 0:
+        return None
+    live_stats = {'stats': dml.running_stats(int(sensor_configs[0:4], 16), int(sensor_configs[6:8], 16)), 'file': None,
+                  'psd': None, 'psd_file': None, 'start': time.monotonic(), 'due': time.monotonic() + live_stats_interval, 'pending': []}
+    if live_psd_segment > 0:
+        live_stats['psd'] = dml.streaming_welch(max(16, int(live_psd_segment * sample_rate)), fs=sample_rate)
+    if live_stats_export:
+        live_stats['file'] = open(file_name + '_live_stats.txt', 'w+')
+        live_stats['file'].write(live_stats['stats'].export_header() + "\n")
+        if live_stats['psd'] is not None:
+            live_stats['psd_file'] = open(file_name + '_live_psd.txt', 'w+')
+            live_stats['psd_file'].write("Elapsed (sec), Segments, Frequency (Hz), " +
+                                         ", ".join(label + " (nT/sqrt(Hz))" for label in live_stats['psd'].labels) + "\n")
+    return live_stats
+
+
+def live_stats_block_helper(live_stats, decoded_columns):
+    live_stats['stats'].update_columns(decoded_columns)
+    if live_stats['psd'] is not None:
+        live_stats['psd'].update_columns(decoded_columns, live_stats['stats'].sf)
+
+
+def live_stats_update_helper(live_stats, decoded_columns):
+    # Function Definition: Adds a decoded block to the running statistics, prints/exports them when a report is due
+    # Input: dict from live_stats_open_helper (or None), dict of columns (see decode_packet_array_quad)
+    # Output: None
+    if live_stats is None:
+        return
+    live_stats_block_helper(live_stats, decoded_columns)
+    if time.monotonic() >= live_stats['due']:
+        live_stats_report_helper(live_stats)
+
+
+def live_stats_packet_helper(live_stats, raw_packet):
+    # Function Definition: Adds one packet from the per-packet loop, packets are decoded in blocks of 256
+    # Input: dict from live_stats_open_helper (or None), String raw packet hex (flag first)
+    # Output: None
+    if live_stats is None:
+        return
+    live_stats['pending'].append([raw_packet[0:2], bytes.fromhex(raw_packet[2:])])
+    if len(live_stats['pending']) >= 256 or time.monotonic() >= live_stats['due']:
+        for decoded_columns in ddl.decode_packets_quad(live_stats['pending']).values():
+            live_stats_block_helper(live_stats, decoded_columns)
+        live_stats['pending'] = []
+        if time.monotonic() >= live_stats['due']:
+            live_stats_report_helper(live_stats)
+
+
+def live_stats_report_helper(live_stats):
+    live_stats['due'] = time.monotonic() + live_stats_interval
+    elapsed = time.monotonic() - live_stats['start']
+    print(live_stats['stats'].report())
+    if live_stats['file'] is not None:
+        live_stats['file'].write(live_stats['stats'].export_row(elapsed) + "\n")
+        live_stats['file'].flush()
+    if live_stats['psd'] is not None and live_stats['psd'].segments > 0:
+        print(live_stats['psd'].report(live_psd_band))
+        if live_stats['psd_file'] is not None:
+            frequency, noise_density = live_stats['psd'].noise_density(live_psd_band)
+            live_stats['psd_file'].write("%.3f,%d,%.6f," % (elapsed, live_stats['psd'].segments, frequency) +
+                                         ",".join("%.6f" % nd for nd in noise_density) + "\n")
+            live_stats['psd_file'].flush()
+
+
+def live_stats_close_helper(live_stats):
+    # Function Definition: Reports the final statistics and closes the export file
+    if live_stats is None:
+        return
+    if len(live_stats['pending']) > 0:
+        for decoded_columns in ddl.decode_packets_quad(live_stats['pending']).values():
+            live_stats_block_helper(live_stats, decoded_columns)
+        live_stats['pending'] = []
+    if live_stats['stats'].n > 0:
+        live_stats_report_helper(live_stats)
+    if live_stats['file'] is not None:
+        live_stats['file'].close()
+    if live_stats['psd_file'] is not None:
+        live_stats['psd_file'].close()
+
+
+def stop_control_helper():
+    # Function Definition: Starts the out-of-band stop sources for a measurement using the stop_ settings above
+    # Output: stop_control, the measurement loops only check its requested flag
+    measurement_stop = dal.stop_control(True, stop_control_file, stop_control_port, stop_hotkey).start()
+    print("\nStop the measurement with Ctrl-C" + ((", by creating " + stop_control_file) if stop_control_file is not None else "") +
+          ((", by sending stop to 127.0.0.1:" + str(stop_control_port)) if stop_control_port else "") +
+          ((" or with the '" + stop_hotkey + "' key") if stop_hotkey is not None else "") + "\n")
+    return measurement_stop
+
+
+def writer_stats_helper(write_file):
+    # Function Definition: Prints how long a capture writer's flushes took, used to size the buffers for long captures
+    writer_stats = write_file.stats()
+    print("Capture Writer: " + str(writer_stats['bytes_written']) + " bytes in " + str(writer_stats['flushes']) + " flushes, mean flush " +
+          "%.2f" % (writer_stats['flush_mean'] * 1000) + " ms, slowest flush " + "%.2f" % (writer_stats['flush_max'] * 1000) + " ms, " +
+          str(writer_stats['fsyncs']) + " fsyncs (slowest " + "%.2f" % (writer_stats['fsync_max'] * 1000) + " ms)\n")
+
+
+def packet_flag_helper(enabled_imu, enabled_temperature):
+    # Function Definition: Gets the packet flag the quad-mag streams for the enabled sensors
+    # Input: bool imu enabled, bool temperature enabled
+    # Output: String packet flag eg. '04'
+    if enabled_imu and enabled_temperature:
+        return '05'
+    elif enabled_temperature:
+        return '06'
+    elif enabled_imu:
+        return '07'
+    return '04'
+
+
 def get_command(ser, f):
     # Function Definition: Gets the command to be run during this loop iteration based on user input
     # Input: None
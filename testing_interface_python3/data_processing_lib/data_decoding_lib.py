@@ -1,29 +1,235 @@
 import numpy as np
 import csv
 import os
+import struct
+import json
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+###Packet Layouts###
+#
+# Each packet flag the quad-mag sends is described by one entry, everything else is generated from this table at import
+# (packet lengths, checksums, scalar and batch decoders, binary capture dtypes, processed file headers)
+#
+# fields -> (name, offset, width, signed, count, scale)
+#   name   -> decoded column, 'sec' and 'tick' make up the timestamp and 'cks' is the checksum
+#   offset -> bytes after the packet flag, width -> bytes per value (big endian), count -> number of consecutive values
+#   scale  -> converts the value to units, 1 keeps the lsb value
+# check -> the checksum (sum of every byte before it) is verified
+#
+packet_layouts = {
+    '01': { #debug, can be anything really, right now setup for one mag
+        'fields': [('sec', 0, 4, False, 1, 1), ('tick', 4, 2, False, 1, 1.00/32768.00), ('b', 6, 3, True, 3, 1), ('cks', 15, 2, False, 1, 1)],
+        'check': False,
+    },
+    '04': { #mag data only
+        'fields': [('sec', 0, 4, False, 1, 1), ('tick', 4, 2, False, 1, 1.00/32768.00), ('b', 6, 3, True, 12, 1), ('cks', 42, 2, False, 1, 1)],
+        'check': True,
+    },
+    '05': { #all sensors
+        'fields': [('sec', 0, 4, False, 1, 1), ('tick', 4, 2, False, 1, 1.00/32768.00), ('b', 6, 3, True, 12, 1), ('imu', 42, 2, True, 6, 1),
+                   ('temp', 54, 2, False, 1, 1), ('cks', 56, 2, False, 1, 1)],
+        'check': True,
+    },
+    '06': { #mag and temperature
+        'fields': [('sec', 0, 4, False, 1, 1), ('tick', 4, 2, False, 1, 1.00/32768.00), ('b', 6, 3, True, 12, 1), ('temp', 42, 2, False, 1, 1),
+                   ('cks', 44, 2, False, 1, 1)],
+        'check': True,
+    },
+    '07': { #mag and imu
+        'fields': [('sec', 0, 4, False, 1, 1), ('tick', 4, 2, False, 1, 1.00/32768.00), ('b', 6, 3, True, 12, 1), ('imu', 42, 2, True, 6, 1),
+                   ('cks', 54, 2, False, 1, 1)],
+        'check': True,
+    },
+}
+
+#processed data file column labels of each field
+field_labels = {
+    'b': ['B1-X ', 'B1-Y', 'B1-Z', 'B2-X', 'B2-Y', 'B2-Z', 'B3-X', 'B3-Y', 'B3-Z', 'B4-X', 'B4-Y', 'B4-Z'],
+    'imu': ['Acc-X', 'Acc-Y', 'Acc-Z', 'Gyr-X', 'Gyr-Y', 'Gyr-Z'],
+    'temp': ['Temp'],
+}
+
+#number of bytes in the config responses (no checksum)
+config_lengths = {
+    '02': 8, #mag config
+    '03': 9, #imu config
+}
+
+def packet_spec_helper(flag, layout) :
+    #def: precompiles everything the decoders need for one packet layout
+    #in: string flag (packet flag), dict layout (entry of packet_layouts)
+    #out: dict packet spec
+    fs = layout['fields']
+    fd = dict((f[0], f) for f in fs)
+    df = [f for f in fs if f[0] not in ('sec', 'tick', 'cks')] #data fields, in processed row order
+    sp = {}
+    sp['length'] = max(f[1] + f[2] * f[4] for f in fs)
+    sp['check'] = layout['check']
+    sp['cks'] = fd['cks'][1]
+    sp['sec'] = fd['sec']
+    sp['tick'] = fd['tick']
+    sp['tps'] = int(round(fd['sec'][5] / fd['tick'][5])) #ticks per second
+    sp['fields'] = fs
+    sp['data'] = df
+    sp['header'] = ', '.join(['Packet Flag', 'Syst-Time (sec)'] + [l for f in df for l in field_labels[f[0]][0:f[4]]]) + '\n'
+    #legacy row format, every value is followed by a comma except an unsigned value at the end of the row
+    sp['row'] = ','.join(['{}'] * (1 + sum(f[4] for f in df))) + (',' if df[-1][3] else '')
+
+    #numpy dtype of a binary capture record (flag byte + packet), 24 bit values stay as raw bytes
+    dt = [('flag', 'u1')]
+    for name, o, w, s, c, sc in fs :
+        if w == 3 :
+            dt.append((name, 'u1', (c, 3)))
+        else :
+            dt.append((name, ('>i' if s else '>u') + str(w)) + (((c,),) if c > 1 else ()))
+    sp['dtype'] = np.dtype(dt)
+
+    #scalar decoder specialized for this layout
+    so, sw = fd['sec'][1], fd['sec'][2]
+    to, tw = fd['tick'][1], fd['tick'][2]
+    ss, tsc = fd['sec'][5], fd['tick'][5]
+    vl = [(o + k*w, o + (k+1)*w, s) for name, o, w, s, c, sc in df for k in range(0, c)]
+    def decode(pb) :
+        return [float(int.from_bytes(pb[so:so+sw], 'big')) * ss + float(int.from_bytes(pb[to:to+tw], 'big')) * tsc] + \
+            [int.from_bytes(pb[a:b], 'big', signed=s) for a, b, s in vl]
+    sp['decode'] = decode
+    return sp
+
+packet_specs = dict((flag, packet_spec_helper(flag, layout)) for flag, layout in packet_layouts.items())
+
+#number of bytes that follow each packet flag (checksum included)
+packet_lengths = dict((flag, sp['length']) for flag, sp in packet_specs.items())
+
+#column header of a processed data file for each packet flag
+processed_headers = dict((flag, sp['header']) for flag, sp in packet_specs.items())
+
+#packet flags that carry a checksum
+valid_checksum_flags = tuple(flag for flag, sp in packet_specs.items() if sp['check'])
+
+###End Packet Layouts###
+
+raw_chunk_size = 1 << 22 #bytes of raw data file read at a time when converting
+tail_state_hash_bytes = 1 << 16 #bytes at the start of a capture hashed into a raw_tail_decoder state to tell a replaced capture from a grown one
+
+#binary raw capture -> fixed header followed by fixed size records (packet flag byte + packet)
+#header: magic, version, packet flag, cycle count, oversamples, accel gain, gyro gain, record size, padding
+raw_binary_magic = b'QMAGRAW\x00'
+raw_binary_version = 1
+raw_binary_format = '>8sBBHHBBH10x'
+raw_binary_header_size = struct.calcsize(raw_binary_format) #32 bytes
+
+class packet_framer :
+    #frames packets out of a serial byte stream
+    #a packet is accepted when it starts with a known flag, is complete and passes its checksum, otherwise one byte is skipped
+    #and the search continues, so the stream resynchronizes within one packet after dropped or extra bytes
+    def __init__(self, config=False) :
+        #in: bool config (also frame the '02'/'03' config responses, they have no checksum so only while aligned)
+        self.config = config
+        self.buf = bytearray()
+        self.pos = 0 #start of unframed bytes in buf
+        self.aligned = True #False while searching for the next valid packet
+        self.skipped = 0 #total bytes skipped while resynchronizing
+        self.resyncs = 0 #number of times the stream lost alignment
+        self.stopping = False #set once a completion is due (the stop command was sent, a command or single measurement is waiting
+        #on its '0a'), a '0a' then ends it right away even while resynchronizing, otherwise only once a read times out after it
+
+    def feed(self, bs) :
+        #adds bytes read from the serial port to the buffer
+        if self.pos > 0 and self.pos >= len(self.buf) // 2 :
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf += bs
+
+    def next_packet(self) :
+        #returns [string flag, bytes packet] for the next framed packet ('0a' has an empty packet), None if more bytes are needed
+        buf = self.buf
+        while self.pos < len(buf) :
+            p = self.pos
+            flag = '{:02x}'.format(buf[p])
+            if flag == '0a' and self.stopping :
+                self.aligned = True
+                self.pos = p + 1
+                return [flag, b'']
+            if flag == '0a' and p == len(buf) - 1 :
+                return None #kept until more bytes arrive or the read times out (see complete_pending)
+            #the quad-mag sends nothing after a completion, a '0a' with bytes after it is a stray byte and skipped below
+            if self.config and flag in config_lengths and self.aligned :
+                if len(buf) - p - 1 < config_lengths[flag] :
+                    return None
+                self.pos = p + 1 + config_lengths[flag]
+                return [flag, bytes(buf[p+1:self.pos])]
+            if flag in packet_lengths and (self.aligned or flag in valid_checksum_flags) :
+                pl = packet_lengths[flag]
+                if len(buf) - p - 1 < pl :
+                    return self.wait_helper()
+                if flag not in valid_checksum_flags or sum(buf[p+1:p+pl-1]) == ((buf[p+pl-1] << 8) | buf[p+pl]) :
+                    self.pos = p + 1 + pl
+                    self.aligned = True
+                    return [flag, bytes(buf[p+1:p+1+pl])]
+            if self.aligned :
+                self.resyncs = self.resyncs + 1
+                self.aligned = False
+            self.pos = p + 1
+            self.skipped = self.skipped + 1
+        return None
+
+    def wait_helper(self) :
+        #more bytes are needed, unless the stop was sent and the buffer ends on its completion
+        if self.stopping and self.complete_pending() :
+            return ['0a', b'']
+        return None
+
+    def complete_pending(self) :
+        #call when a read timed out, a '0a' waiting at a packet boundary or, while resynchronizing, at the end of the buffer is
+        #then the completion (the bytes around it can't be completed into a packet any more)
+        #out: bool (the rest of the buffer is consumed)
+        if self.pos < len(self.buf) and (self.buf[self.pos] == 0x0a if self.aligned else self.buf[-1] == 0x0a) :
+            self.skipped = self.skipped + len(self.buf) - 1 - self.pos
+            self.pos = len(self.buf)
+            self.aligned = True
+            return True
+        return False
+
+    def next_blocks(self) :
+        #frames every complete packet in the buffer in one pass, the partial packet at the end stays for the next feed
+        #runs of aligned packets with the same flag are checked with numpy and returned as one block
+        #out: list of [string flag, numpy uint8 array (N, packet length)], '0a' blocks have N = 0
+        bl = []
+        while 1 :
+            p = self.pos
+            if self.aligned and p < len(self.buf) :
+                flag = '{:02x}'.format(self.buf[p])
+                if flag in valid_checksum_flags :
+                    rs = packet_lengths[flag] + 1
+                    n = (len(self.buf) - p) // rs
+                    if n > 1 :
+                        ra = np.frombuffer(bytes(self.buf[p:p + n*rs]), dtype=np.uint8).reshape(n, rs)
+                        ok = (ra[:, 0] == self.buf[p]) & valid_checksum_array(ra[:, 1:], flag)
+                        k = n if ok.all() else int(np.argmin(ok)) #packets before the first bad one
+                        if k > 0 :
+                            bl.append([flag, ra[0:k, 1:]])
+                            self.pos = p + k*rs
+                            continue
+            pk = self.next_packet()
+            if pk is None :
+                return bl
+            if pk[0] in config_lengths :
+                bl.append([pk[0], np.frombuffer(pk[1], dtype=np.uint8).reshape(1, len(pk[1]))])
+            elif len(bl) > 0 and bl[-1][0] == pk[0] and pk[0] != '0a' :
+                bl[-1][1] = np.vstack((bl[-1][1], np.frombuffer(pk[1], dtype=np.uint8)[None, :]))
+            else :
+                bl.append([pk[0], np.frombuffer(pk[1], dtype=np.uint8).reshape(1 if len(pk[1]) > 0 else 0, len(pk[1]))])
 
 def valid_checksum(byte_object_in, flag):
-    packetSum = 0
-    cks = 0
-    if flag == '04':
-        cks = int(byte_object_in[42:44].hex(), 16)
-        for index in range(0, 42):
-            packetSum = packetSum + byte_object_in[index]
-    elif flag == '05':
-        cks = int(byte_object_in[56:58].hex(), 16)
-        for index in range(0, 56):
-            packetSum = packetSum + byte_object_in[index]
-    elif flag == '06':
-        cks = int(byte_object_in[44:46].hex(), 16)
-        for index in range(0, 44):
-            packetSum = packetSum + byte_object_in[index]
-    elif flag == '07':
-        cks = int(byte_object_in[54:56].hex(), 16)
-        for index in range(0, 54):
-            packetSum = packetSum + byte_object_in[index]
-    if packetSum == cks:
+    #def: checks the checksum of a packet, packets without a checked checksum are always valid
+    #in: bytes byte_object_in (packet without its flag), string flag (packet flag)
+    #out: bool
+    if flag not in valid_checksum_flags:
         return True
-    return False
+    co = packet_specs[flag]['cks']
+    return sum(byte_object_in[0:co]) == int.from_bytes(byte_object_in[co:co+2], 'big')
 
 
 def decode_serial_byte_stream_quad(byte_object_in, flag):
@@ -33,87 +239,545 @@ def decode_serial_byte_stream_quad(byte_object_in, flag):
     sss = byte_object_in.hex()
     return decode_raw_data_helper(sss, flag)
 
-def decode_raw_data_file_quad(fn, flag):
-    #def:
-    #in:
-    #out:
+def decode_raw_data_file_quad(fn, flag, chunk_size=raw_chunk_size, progress=None, workers=1):
+    #def: converts a raw data file into a processed data file, streaming it chunk by chunk so memory stays bounded
+    #in: string fn (file name without the _raw_data.txt suffix), string flag (packet flag used for the column header if the file holds no packets),
+    #    int chunk_size (bytes of raw file read per chunk), function progress (called as progress(bytes_read, packets_processed) after each chunk),
+    #    int workers (number of processes decoding in parallel, 1 decodes in this process), output is identical for any number of workers
+    #out: [int packets written, int invalid lines/packets skipped]
     fnr = fn + '_raw_data.txt'
-    fr = open(fnr, 'r')
-    ls = fr.readlines()
     fnw = fn + '_processed_data.txt'
-    fw = open(fnw, 'w')
-    for i,j in enumerate(ls) :
-        j = j.strip() #remove newline
-        if i < 2 :
-            if i == 1 :
-                fw.write(str(int(j[0:4],16)) + '\n')
-                et = True if (ls[i+1][0:2] == '05' or ls[i+1][0:2] == '06') else False 
-                ei = True if (ls[i+1][0:2] == '05' or ls[i+1][0:2] == '07') else False 
-                if et and ei :
-                    fw.write(
-                        "\nPacket Flag, Syst-Time (sec), B1-X , B1-Y, B1-Z, B2-X, B2-Y, B2-Z, B3-X, B3-Y, B3-Z, B4-X, B4-Y, B4-Z, Acc-X, Acc-Y, Acc-Z, Gyr-X, Gyr-Y, Gyr-Z, Temp\n")
-                elif not et and not ei :
-                    fw.write(
-                        "\nPacket Flag, Syst-Time (sec), B1-X , B1-Y, B1-Z, B2-X, B2-Y, B2-Z, B3-X, B3-Y, B3-Z, B4-X, B4-Y, B4-Z\n")
-                elif ei :
-                    fw.write(
-                        "\nPacket Flag, Syst-Time (sec), B1-X , B1-Y, B1-Z, B2-X, B2-Y, B2-Z, B3-X, B3-Y, B3-Z, B4-X, B4-Y, B4-Z, Acc-X, Acc-Y, Acc-Z, Gyr-X, Gyr-Y, Gyr-Z\n")
-                else:
-                    fw.write(
-                        "\nPacket Flag, Syst-Time (sec), B1-X , B1-Y, B1-Z, B2-X, B2-Y, B2-Z, B3-X, B3-Y, B3-Z, B4-X, B4-Y, B4-Z, Temp\n")
-            else :
-                fw.write(j + '\n')
+    npk = 0
+    ni = 0
+    with open(fnr, 'rb') as fr, open(fnw, 'w') as fw :
+        hl = raw_data_header_helper(fr)
+        nb = fr.tell()
+        fw.write(hl[0] + '\n')
+        fw.write(processed_config_helper(hl[1]) + '\n')
+        hw = False
+        if workers > 1 :
+            dr = decode_raw_data_parallel(fnr, raw_data_ranges(fr, nb, chunk_size), chunk_size, workers)
         else :
-            ws = decode_raw_data_helper(j[2:], j[0:2])
-            fw.write(j[0:2] + ',' + ws[1] + '\n')
+            dr = (decode_raw_data_text(ls) + [cb] for ls, cb in raw_data_chunks(fr, chunk_size))
+        for ws, hf, n, nbad, cb in dr :
+            nb = nb + cb
+            if not hw and hf != '' :
+                fw.write('\n' + processed_headers[hf])
+                hw = True
+            fw.write(ws)
+            npk = npk + n
+            ni = ni + nbad
+            if progress is not None :
+                progress(nb, npk)
+        if not hw :
+            fw.write('\n' + processed_headers[flag if flag in processed_headers else '04'])
+    return [npk, ni]
+
+def raw_data_ranges(fr, start, rl) :
+    #def: splits the packet lines of a raw data file into byte ranges that start and end on line boundaries
+    #in: binary file object fr, int start (offset of the first packet line), int rl (approximate bytes per range)
+    #out: list of [int start offset, int end offset]
+    fs = os.fstat(fr.fileno()).st_size
+    rs = []
+    while start < fs :
+        fr.seek(min(start + rl, fs))
+        if start + rl < fs :
+            fr.readline() #move to the start of the next line
+        end = min(fr.tell(), fs)
+        rs.append([start, end])
+        start = end
+    return rs
+
+def decode_raw_data_range(fnr, start, end, chunk_size=raw_chunk_size) :
+    #def: decodes the packet lines in one byte range of a raw data file, runs in a worker process
+    #in: string fnr (raw data file name), int start/end (byte range from raw_data_ranges), int chunk_size (bytes read at a time)
+    #out: [string processed rows, string flag of the first valid packet ('' if none), int packets decoded, int invalid lines/packets skipped, int bytes in range]
+    ws = []
+    hf = ''
+    npk = 0
+    ni = 0
+    with open(fnr, 'rb') as fr :
+        fr.seek(start)
+        for ls, cb in raw_data_chunks(fr, chunk_size, end) :
+            s, f, n, nbad = decode_raw_data_text(ls)
+            ws.append(s)
+            hf = f if hf == '' else hf
+            npk = npk + n
+            ni = ni + nbad
+    return [''.join(ws), hf, npk, ni, end - start]
+
+def decode_raw_data_parallel(fnr, rs, chunk_size=raw_chunk_size, workers=None) :
+    #def: decodes the byte ranges of a raw data file in a pool of processes and yields the results in file order
+    #in: string fnr (raw data file name), list rs (byte ranges from raw_data_ranges), int chunk_size (bytes read at a time), int workers (number of processes, None for one per cpu)
+    #out: generator of the decode_raw_data_range results, in the same order as rs
+    workers = workers if workers is not None else os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as ex :
+        fq = deque()
+        for start, end in rs :
+            fq.append(ex.submit(decode_raw_data_range, fnr, start, end, chunk_size))
+            if len(fq) >= 2 * workers : #bound how many decoded ranges are held in memory
+                yield fq.popleft().result()
+        while len(fq) > 0 :
+            yield fq.popleft().result()
+
+def decode_raw_data_text(ls) :
+    #def: decodes a list of raw packet lines into processed data text
+    #in: list of strings ls (raw packet lines)
+    #out: [string processed rows each ending in a newline, string flag of the first valid packet ('' if none), int packets decoded, int invalid lines/packets skipped]
+    rows, hf, nbad = decode_raw_data_lines(ls)
+    return [('\n'.join(rows) + '\n') if len(rows) > 0 else '', hf, len(rows), nbad]
+
+def raw_data_header_helper(fr) :
+    #def: reads the header of a raw data file i.e. the description line, the config line and the blank line after it
+    #in: binary file object fr positioned at the start of the file
+    #out: [string description line, string config line], fr is left at the first packet line
+    hl = [fr.readline().decode('ascii').strip(), fr.readline().decode('ascii').strip()]
+    p = fr.tell()
+    if fr.readline().strip() != b'' : #older files have no blank line before the packets
+        fr.seek(p)
+    return hl
+
+def processed_config_helper(cl) :
+    #def: converts the hex config line of a raw file into the decimal config line of a processed file
+    #in: string cl (cycle count and oversamples in hex eg. 0320,01)
+    #out: string decimal config line eg. 800,1
+    cs = cl.split(',')
+    if len(cs) < 2 :
+        return str(int(cs[0][0:4], 16))
+    return str(int(cs[0], 16)) + ',' + str(int(cs[1], 16))
+
+def raw_data_chunks(fr, chunk_size=raw_chunk_size, end=-1) :
+    #def: reads a raw data file in fixed size chunks and yields the complete lines of each chunk, a partial last line is carried to the next chunk
+    #in: binary file object fr, int chunk_size (bytes per read), int end (file offset to stop at, -1 for end of file)
+    #out: generator of [list of string lines, int bytes consumed]
+    tail = b''
+    while 1 :
+        rs = chunk_size if end < 0 else min(chunk_size, end - fr.tell())
+        cb = fr.read(rs) if rs > 0 else b''
+        if len(cb) == 0 :
+            if len(tail) > 0 :
+                yield [[tail.decode('ascii', 'replace')], len(tail)]
+            return
+        cb = tail + cb
+        li = cb.rfind(b'\n')
+        if li == -1 :
+            tail = cb
+            continue
+        tail = cb[li+1:]
+        yield [cb[:li].decode('ascii', 'replace').split('\n'), li + 1]
+
+def decode_raw_data_lines(ls, fmt=True) :
+    #def: decodes a list of raw packet lines in bulk, consecutive lines of the same packet flag are decoded together
+    #in: list of strings ls (raw packet lines, flag byte first, in hex), bool fmt (format processed rows, otherwise keep the columns)
+    #out: [list of string processed rows (list of [flag, dict of columns] if not fmt), string flag of the first valid packet ('' if none), int invalid lines/packets skipped]
+    rows = []
+    hf = ''
+    nbad = 0
+    rf = ''
+    run = []
+    for j in ls :
+        j = j.strip()
+        if j == '' :
+            continue
+        f = j[0:2]
+        if f not in packet_lengths or len(j) != 2 * (packet_lengths[f] + 1) :
+            nbad = nbad + 1
+            continue
+        if f != rf :
+            nbad = nbad + decode_raw_data_run(run, rf, rows, fmt)
+            rf = f
+            run = []
+            hf = f if hf == '' else hf
+        run.append(j)
+    nbad = nbad + decode_raw_data_run(run, rf, rows, fmt)
+    return [rows, hf, nbad]
+
+def decode_raw_data_run(run, flag, rows, fmt=True) :
+    #def: decodes a run of raw packet lines that share a packet flag and appends the processed rows
+    #in: list of strings run (raw packet lines), string flag (packet flag), list rows (processed rows are appended here), bool fmt (append [flag, columns] instead of rows)
+    #out: int number of lines skipped because they were not valid hex or failed the checksum
+    if len(run) == 0 :
+        return 0
+    nbad = 0
+    try :
+        pb = bytes.fromhex(''.join(run))
+    except ValueError :
+        gr = []
+        for j in run :
+            try :
+                gr.append(bytes.fromhex(j))
+            except ValueError :
+                nbad = nbad + 1
+        pb = b''.join(gr)
+    dc = decode_packet_array_quad(pb, flag, flagged=True, check=True)
+    if fmt :
+        rows.extend(format_columns_quad(dc, flag))
+    elif len(dc['t']) > 0 :
+        rows.append([flag, dc])
+    return nbad + dc['nf']
+
+def format_columns_quad(dc, flag) :
+    #def: formats decoded columns into processed data rows, the same text decode_raw_data_helper produces
+    #in: dict dc (columns from decode_packet_array_quad), string flag (packet flag)
+    #out: list of strings, one row per packet, flag first, no newline
+    sp = packet_specs[flag]
+    cols = [dc['t'].tolist()]
+    for f in sp['data'] :
+        cols = cols + (dc[f[0]].T.tolist() if dc[f[0]].ndim > 1 else [dc[f[0]].tolist()])
+    fs = flag + ',' + sp['row']
+    return [fs.format(*r) for r in zip(*cols)]
 
 
 def decode_raw_data_helper(sss, flag) :
-    #def:
-    #in:
-    #out:
-    i = 0
-    rsc = str(float(int(sss[i:i+8],16)) + (float(int(sss[i+8:i+12], 16)) * (1.00/32768.00))) + ","
-    i = i + 12
-    if flag == '01': #debug can be anything really, right now setup for one mag
-        while i < 30:
-            rsc = rsc + \
-                str(decode_twos_comp(int(sss[i:i+6], 16), 24)) + ","
-            i = i + 6
-    elif flag == '04':
-        while i < 84:
-            rsc = rsc + \
-                str(decode_twos_comp(int(sss[i:i+6], 16), 24)) + ","
-            i = i + 6
-    elif flag == '05':
-        while i < 84:
-            rsc = rsc + \
-                str(decode_twos_comp(int(sss[i:i+6], 16), 24)) + ","
-            i = i + 6
-        while i < 108:
-            rsc = rsc + \
-                str(decode_twos_comp(int(sss[i:i+4], 16), 16)) + ","
-            i = i + 4
-        rsc = rsc + \
-            str(int(sss[i:i+4], 16))
-    elif flag == '06':
-        while i < 84:
-            rsc = rsc + \
-                str(decode_twos_comp(int(sss[i:i+6], 16), 24)) + ","
-            i = i + 6
-        rsc = rsc + \
-            str(int(sss[i:i+4], 16))
-    elif flag == '07':
-        while i < 84:
-            rsc = rsc + \
-                str(decode_twos_comp(int(sss[i:i+6], 16), 24)) + ","
-            i = i + 6
-        while i < 108:
-            rsc = rsc + \
-                str(decode_twos_comp(int(sss[i:i+4], 16), 16)) + ","
-            i = i + 4
-    # We discard the checksum
-    return [sss, rsc]
+    #def: decodes a single packet into a processed data row
+    #in: string sss (packet without its flag, in hex), string flag (packet flag)
+    #out: [string sss, string comma separated row without the flag]
+    sp = packet_specs[flag]
+    return [sss, sp['row'].format(*sp['decode'](bytes.fromhex(sss[0:2*sp['length']])))]
+
+def packet_array_helper(pb, flag, flagged=False) :
+    #def: views a buffer of fixed length packets as a 2d array, one packet per row
+    #in: bytes/bytearray/numpy array pb (packets back to back), string flag (packet flag), bool flagged (each packet starts with its flag byte)
+    #out: numpy uint8 array with shape (N, packet length)
+    if isinstance(pb, np.ndarray) and pb.dtype.names is not None : #binary raw capture records, flag byte included
+        pb = pb.view(np.uint8).reshape(len(pb), pb.dtype.itemsize)
+        flagged = True
+    pl = packet_lengths[flag] + (1 if flagged else 0)
+    pa = np.frombuffer(pb, dtype=np.uint8) if not isinstance(pb, np.ndarray) else pb.astype(np.uint8, copy=False)
+    if pa.ndim == 1 :
+        if pa.size % pl != 0 :
+            raise ValueError('Buffer of ' + str(pa.size) + ' bytes is not a whole number of ' + str(pl) + ' byte packets')
+        pa = pa.reshape(-1, pl)
+    elif pa.shape[1] != pl :
+        raise ValueError('Expected packets of ' + str(pl) + ' bytes for flag ' + flag + ', got ' + str(pa.shape[1]))
+    return pa[:, 1:] if flagged else pa
+
+def valid_checksum_array(pb, flag, flagged=False) :
+    #def: bulk version of valid_checksum, checks every packet in one pass
+    #in: bytes/bytearray/numpy array pb (packets back to back or (N, packet length)), string flag (packet flag), bool flagged (each packet starts with its flag byte)
+    #out: numpy bool array, True where the packet checksum is valid
+    pa = packet_array_helper(pb, flag, flagged)
+    if flag not in valid_checksum_flags :
+        return np.ones(len(pa), dtype=bool) #matches valid_checksum, no checksum on these packets
+    cl = packet_specs[flag]['cks']
+    ps = pa[:, 0:cl].sum(axis=1, dtype=np.uint32)
+    cks = (pa[:, cl].astype(np.uint32) << 8) | pa[:, cl+1]
+    return ps == cks
+
+def valid_checksum_arrays(pad, flagged=False) :
+    #def: checks the packets of several flags at once and counts the failures of each flag
+    #in: dict pad (packet flag -> packet buffer/array), bool flagged (each packet starts with its flag byte)
+    #out: [dict packet flag -> numpy bool validity mask, dict packet flag -> int number of checksum failures]
+    vm = {}
+    nf = {}
+    for flag, pb in pad.items() :
+        vm[flag] = valid_checksum_array(pb, flag, flagged)
+        nf[flag] = int(vm[flag].size - np.count_nonzero(vm[flag]))
+    return [vm, nf]
+
+def decode_packet_array_quad(pb, flag, flagged=False, check=False) :
+    #def: decodes many packets of the same flag at once, the bulk equivalent of decode_raw_data_helper
+    #in: bytes/bytearray/numpy array pb (packets back to back or (N, packet length)), string flag (packet flag), bool flagged (each packet starts with its flag byte)
+    #out: dict of numpy columns
+    #   'sec' uint32 seconds, 'tick' uint16 1/32768 sec ticks, 't' float64 seconds,
+    #   'b' int32 (N, 12) mag readings (N, 3 for debug packets), 'imu' int16 (N, 6) acc/gyr readings,
+    #   'temp' uint16 temperature readings, 'cks' uint16 checksums, 'ticks' int64 timestamp as a whole number of ticks
+    #   when check is True packets with a bad checksum are dropped and 'nf' holds how many were dropped
+    pa = packet_array_helper(pb, flag, flagged)
+    nf = 0
+    if check :
+        vm = valid_checksum_array(pa, flag)
+        nf = int(vm.size - np.count_nonzero(vm))
+        if nf > 0 :
+            pa = pa[vm]
+    sp = packet_specs[flag]
+    dc = {}
+    for name, o, w, s, c, sc in sp['fields'] :
+        dc[name] = field_array_helper(pa, o, w, s, c)
+    dc['t'] = dc['sec'].astype(np.float64) * sp['sec'][5] + dc['tick'].astype(np.float64) * sp['tick'][5]
+    dc['ticks'] = dc['sec'].astype(np.int64) * sp['tps'] + dc['tick'].astype(np.int64)
+    if check :
+        dc['nf'] = nf
+    return dc
+
+def encode_packet_array_quad(dc, flag) :
+    #def: inverse of decode_packet_array_quad, packs integer columns into packets and fills in the checksum (eg. for emulating the quad-mag)
+    #in: dict of columns ('sec', 'tick' and the data fields of the flag in lsb, see decode_packet_array_quad), string flag (packet flag)
+    #out: numpy uint8 array of packets (N, packet length) without the flag byte
+    sp = packet_specs[flag]
+    n = len(dc['sec'])
+    pa = np.zeros((n, sp['length']), dtype=np.uint8)
+    for name, o, w, s, c, sc in sp['fields'] :
+        if name == 'cks' :
+            continue
+        v = np.asarray(dc[name], dtype=np.int64).reshape(n, c) & ((1 << (8*w)) - 1) #two's complement for signed fields
+        for k in range(0, w) :
+            pa[:, o+k:o+w*c:w] = (v >> (8*(w-1-k))) & 0xff
+    cl = sp['cks']
+    cs = pa[:, 0:cl].sum(axis=1, dtype=np.uint32)
+    pa[:, cl] = (cs >> 8) & 0xff
+    pa[:, cl+1] = cs & 0xff
+    return pa
+
+def decode_packets_quad(pl) :
+    #def: decodes framed packets (eg. from packet_framer) into typed columns, packets are grouped by flag keeping their order
+    #in: list of [string flag, bytes packet]
+    #out: dict packet flag -> dict of columns (see decode_packet_array_quad)
+    pg = {}
+    for flag, pb in pl :
+        if flag in packet_specs :
+            pg.setdefault(flag, []).append(pb)
+    return dict((flag, decode_packet_array_quad(b''.join(pbs), flag)) for flag, pbs in pg.items())
+
+def concat_columns_quad(dcl) :
+    #def: joins the columns of several decoded blocks of the same packet flag
+    #in: list of dicts of columns
+    #out: dict of columns
+    if len(dcl) == 1 :
+        return dcl[0]
+    return dict((k, np.concatenate([dc[k] for dc in dcl])) for k in dcl[0] if k != 'nf')
+
+def write_columns_quad(fn, dc, cc, ovs, flag) :
+    #def: saves decoded columns with the capture config as an uncompressed numpy .npz file, no text round trip
+    #in: string fn (file to write, .npz is added if missing), dict dc (columns), int cc (cycle count), int ovs (oversamples), string flag (packet flag)
+    #out: none
+    cols = dict((k, v) for k, v in dc.items() if k != 'nf')
+    np.savez(fn, cc=np.int64(cc), os=np.int64(ovs), flag=np.array(flag), **cols)
+
+def read_columns_quad(fn) :
+    #def: loads columns saved by write_columns_quad
+    #in: string fn (.npz file to read from)
+    #out: [dict with 'cc', 'os' and 'flag', dict of columns]
+    with np.load(fn) as nf :
+        hd = {'cc': int(nf['cc']), 'os': int(nf['os']), 'flag': str(nf['flag'])}
+        dc = dict((k, nf[k]) for k in nf.files if k not in hd)
+    return [hd, dc]
+
+def is_columns_file(fn) :
+    #def: checks whether a file was written by write_columns_quad
+    #in: string fn (file name)
+    #out: bool
+    return fn.endswith('.npz') and os.path.isfile(fn)
+
+def repair_timestamps_quad(sec, tick, unwrap=True, gap_factor=1.5, tps=32768, sec_bits=32) :
+    #def: builds an exact monotonic time base from decoded timestamps in one vectorized pass
+    #in: numpy arrays sec/tick (timestamp seconds and ticks), bool unwrap (unwrap seconds counter wraps, otherwise they are masked like any backwards jump),
+    #    float gap_factor (a step longer than gap_factor times the median step is reported as a gap), int tps (ticks per second), int sec_bits (width of the seconds counter)
+    #out: [numpy int64 ticks (unwrapped if unwrap), numpy bool mask (True where the sample keeps the time base strictly increasing), dict report]
+    #   report -> 'wraps' (net counter wraps), 'backwards' (backwards steps left after unwrapping), 'duplicates', 'masked' counts, 'period' median step in ticks,
+    #   'gaps' indices (into the input) of samples that follow a gap, 'gap_ticks' length of each gap in ticks
+    tk = np.asarray(sec).astype(np.int64) * tps + np.asarray(tick).astype(np.int64)
+    rp = {'wraps': 0, 'backwards': 0, 'duplicates': 0, 'masked': 0, 'period': 0, 'gaps': np.zeros(0, dtype=np.int64), 'gap_ticks': np.zeros(0, dtype=np.int64)}
+    if tk.size == 0 :
+        return [tk, np.ones(0, dtype=bool), rp]
+    pr = np.int64(1 << sec_bits) * tps #ticks before the counter wraps
+    d = np.diff(tk)
+    #a wrap looks like a jump back by most of the counter range, a jump forward by most of it is a stray sample from before the wrap
+    wr = (d < -(pr // 2)).astype(np.int64) - (d > (pr // 2)).astype(np.int64)
+    rp['wraps'] = int(wr.sum())
+    if unwrap and np.count_nonzero(wr) > 0 :
+        tk = tk + np.concatenate(([0], np.cumsum(wr))) * pr
+        d = np.diff(tk)
+    rp['backwards'] = int(np.count_nonzero(d < 0))
+    rp['duplicates'] = int(np.count_nonzero(d == 0))
+
+    #keep a sample only if it is later than every sample before it
+    pm = np.maximum.accumulate(tk)
+    m = np.ones(tk.size, dtype=bool)
+    m[1:] = tk[1:] > pm[:-1]
+    rp['masked'] = int(tk.size - np.count_nonzero(m))
+
+    kd = np.diff(tk[m])
+    if kd.size > 0 :
+        rp['period'] = int(np.median(kd))
+        gi = np.nonzero(kd > gap_factor * rp['period'])[0]
+        rp['gaps'] = np.nonzero(m)[0][gi + 1]
+        rp['gap_ticks'] = kd[gi]
+    return [tk, m, rp]
+
+def field_array_helper(pa, o, w, s, c) :
+    #def: decodes one field of every packet in a packet array
+    #in: numpy uint8 array pa (N, packet length), int o (offset), int w (width in bytes), bool s (signed), int c (count)
+    #out: numpy array (N,) if c is 1 else (N, c), native int type of the field width (int32/uint32 for 24 bit)
+    n = len(pa)
+    if w == 3 :
+        fb = pa[:, o:o + 3*c].reshape(n, c, 3).astype(np.int32)
+        v = (fb[:, :, 0] << 16) | (fb[:, :, 1] << 8) | fb[:, :, 2]
+        v = v - ((v & 0x800000) << 1) if s else v.astype(np.uint32)
+    else :
+        dt = ('>i' if s else '>u') + str(w)
+        v = np.ascontiguousarray(pa[:, o:o + w*c]).view(dt).astype(np.dtype(dt).newbyteorder('='))
+    return v.reshape(n) if c == 1 else v
+
+def raw_binary_dtype(flag) :
+    #def: numpy structured dtype of one binary raw capture record
+    #in: string flag (packet flag)
+    #out: numpy dtype, 24 bit mag fields are kept as raw bytes (decode with decode_packet_array_quad)
+    return packet_specs[flag]['dtype']
+
+def write_raw_binary_header(fw, cc, ovs, flag, ag=0, gg=0) :
+    #def: writes the header of a binary raw capture
+    #in: binary file object fw, int cc (cycle count), int ovs (oversamples), string flag (packet flag of every record), int ag (accel gain), int gg (gyro gain)
+    #out: none
+    fw.write(struct.pack(raw_binary_format, raw_binary_magic, raw_binary_version, int(flag, 16), cc, ovs, ag, gg, packet_lengths[flag] + 1))
+
+def read_raw_binary_header(fr) :
+    #def: reads and checks the header of a binary raw capture
+    #in: binary file object fr positioned at the start of the file
+    #out: dict with 'flag', 'cc', 'os', 'ag', 'gg' and 'rs' (record size)
+    hb = fr.read(raw_binary_header_size)
+    if len(hb) != raw_binary_header_size :
+        raise ValueError('File is too short to be a binary raw capture')
+    mg, vr, pf, cc, ovs, ag, gg, rs = struct.unpack(raw_binary_format, hb)
+    if mg != raw_binary_magic :
+        raise ValueError('File is not a binary raw capture')
+    if vr != raw_binary_version :
+        raise ValueError('Unsupported binary raw capture version ' + str(vr))
+    flag = '{:02x}'.format(pf)
+    if flag not in packet_lengths or rs != packet_lengths[flag] + 1 :
+        raise ValueError('Binary raw capture has an unknown packet flag or record size')
+    return {'flag': flag, 'cc': cc, 'os': ovs, 'ag': ag, 'gg': gg, 'rs': rs}
+
+def read_raw_binary_quad(fn) :
+    #def: opens a binary raw capture without reading its records into memory
+    #in: string fn (file to read from)
+    #out: [dict header (see read_raw_binary_header), numpy memmap structured array of records (see raw_binary_dtype)]
+    with open(fn, 'rb') as fr :
+        hd = read_raw_binary_header(fr)
+    dt = raw_binary_dtype(hd['flag'])
+    nr = (os.path.getsize(fn) - raw_binary_header_size) // dt.itemsize #a partial last record is ignored
+    if nr <= 0 :
+        return [hd, np.zeros(0, dtype=dt)]
+    return [hd, np.memmap(fn, dtype=dt, mode='r', offset=raw_binary_header_size, shape=(nr,))]
+
+def is_raw_binary_file(fn) :
+    #def: checks whether a file is a binary raw capture
+    #in: string fn (file name)
+    #out: bool
+    try :
+        with open(fn, 'rb') as fr :
+            return fr.read(len(raw_binary_magic)) == raw_binary_magic
+    except OSError :
+        return False
+
+class raw_tail_decoder :
+    #decodes a raw capture that is still being written, each update only decodes the complete packets appended since the last one
+    #works with _raw_data.txt and binary _raw_data.bin captures, the offset can be kept in a state file so a periodic job can resume
+    def __init__(self, fn, fnw=None, state_fn=None) :
+        #in: string fn (raw capture file), string fnw (processed data file rows are appended to, None to skip), string state_fn (json file holding the offset, None to keep it in memory)
+        self.fn = fn
+        self.fnw = fnw
+        self.state_fn = state_fn
+        self.binary = None #unknown until the header has been read
+        self.offset = 0 #bytes of the capture already decoded (header included)
+        self.packets = 0 #packets decoded so far
+        self.invalid = 0 #invalid lines/packets skipped so far
+        self.hd = None #capture header, {'flag', 'cc', 'os'} for binary captures, [description, config] for text captures
+        self.hw = False #processed column header written
+        if state_fn is not None and os.path.isfile(state_fn) :
+            with open(state_fn, 'r') as fs :
+                st = json.load(fs)
+            if st.get('fn') == fn and os.path.isfile(fn) and self.same_capture_helper(st.get('id'), st['offset']) : #capture was not replaced
+                self.offset = st['offset']
+                self.packets = st['packets']
+                self.invalid = st['invalid']
+                self.hw = st['hw']
+            elif fnw is not None and os.path.isfile(fnw) : #rows decoded from a capture that is gone, start the processed file over
+                open(fnw, 'w').close()
+
+    def identity_helper(self, offset) :
+        #identifies the capture the offset belongs to, inode, mtime and a hash of the bytes already decoded (the first
+        #tail_state_hash_bytes of them)
+        #in: int offset (bytes decoded)
+        #out: dict
+        st = os.stat(self.fn)
+        with open(self.fn, 'rb') as fr :
+            hb = fr.read(min(offset, tail_state_hash_bytes))
+        return {'inode': st.st_ino, 'mtime': st.st_mtime_ns, 'size': st.st_size, 'head': hashlib.blake2b(hb, digest_size=16).hexdigest()}
+
+    def same_capture_helper(self, sid, offset) :
+        #checks a saved identity against the capture, a capture that has only been appended to since keeps its inode and the
+        #bytes before the offset, its size and mtime can only have grown
+        #in: dict sid (identity saved with the state, None for states saved without one), int offset
+        #out: bool
+        if sid is None :
+            return False
+        cid = self.identity_helper(offset)
+        return cid['inode'] == sid['inode'] and cid['head'] == sid['head'] and cid['size'] >= offset and cid['mtime'] >= sid['mtime']
+
+    def update(self) :
+        #decodes the packets appended since the last update
+        #out: dict packet flag -> dict of columns (see decode_packet_array_quad), empty if nothing new
+        if not os.path.isfile(self.fn) :
+            return {}
+        with open(self.fn, 'rb') as fr :
+            if self.hd is None and not self.header_helper(fr) :
+                return {}
+            fr.seek(self.offset)
+            if self.binary :
+                rs = self.hd['rs']
+                nr = (os.fstat(fr.fileno()).st_size - self.offset) // rs #complete records only
+                if nr <= 0 :
+                    return {}
+                rec = np.frombuffer(fr.read(nr * rs), dtype=raw_binary_dtype(self.hd['flag']))
+                self.offset = self.offset + nr * rs
+                bl = [[self.hd['flag'], decode_packet_array_quad(rec, self.hd['flag'])]]
+            else :
+                cb = fr.read()
+                li = cb.rfind(b'\n') #complete lines only
+                if li == -1 :
+                    return {}
+                self.offset = self.offset + li + 1
+                bl, hf, nbad = decode_raw_data_lines(cb[:li].decode('ascii', 'replace').split('\n'), False)
+                self.invalid = self.invalid + nbad
+        dcs = {}
+        for flag, dc in bl :
+            dcs.setdefault(flag, []).append(dc)
+            self.packets = self.packets + len(dc['t'])
+        dcs = dict((flag, concat_columns_quad(dcl)) for flag, dcl in dcs.items())
+        if self.fnw is not None :
+            self.write_helper(bl)
+        if self.state_fn is not None :
+            self.save_state()
+        return dcs
+
+    def header_helper(self, fr) :
+        #reads the capture header, returns False if it has not been completely written yet
+        self.binary = fr.read(len(raw_binary_magic)) == raw_binary_magic
+        fr.seek(0)
+        if self.binary :
+            try :
+                self.hd = read_raw_binary_header(fr)
+            except ValueError :
+                return False
+            self.offset = max(self.offset, raw_binary_header_size)
+            return True
+        hb = fr.read(4096)
+        if hb.count(b'\n') < 3 :
+            return False
+        fr.seek(0)
+        self.hd = raw_data_header_helper(fr)
+        self.offset = max(self.offset, fr.tell())
+        return True
+
+    def write_helper(self, bl) :
+        #appends the processed rows of newly decoded blocks to the processed data file
+        with open(self.fnw, 'a') as fw :
+            if not self.hw and len(bl) > 0 :
+                if self.binary :
+                    fw.write('Mag Cycle Count, Mag Number of Oversamples (readings are in lsb form)\n' + str(self.hd['cc']) + ',' + str(self.hd['os']) + '\n')
+                else :
+                    fw.write(self.hd[0] + '\n' + processed_config_helper(self.hd[1]) + '\n')
+                fw.write('\n' + processed_headers[bl[0][0]])
+                self.hw = True
+            for flag, dc in bl :
+                fw.write('\n'.join(format_columns_quad(dc, flag)) + '\n')
+
+    def save_state(self) :
+        #saves the offset and the identity of the capture so a later raw_tail_decoder can resume where this one stopped
+        with open(self.state_fn, 'w') as fs :
+            json.dump({'fn': self.fn, 'offset': self.offset, 'packets': self.packets, 'invalid': self.invalid, 'hw': self.hw,
+                       'id': self.identity_helper(self.offset)}, fs)
 
 def decode_twos_comp(ntc, nb):
     # Function Definition: Decodes twos complement input into a signed decimal number
@@ -0,0 +1,554 @@
+import os
+import sys
+import tty
+import time
+import queue
+import threading
+import numpy as np
+from . import data_decoding_lib as ddl
+
+###Firmware Emulator###
+#
+# Pretends to be a quad-mag on a linux pseudo-terminal so the command functions, the acquisition loops and the decoders can
+# be run and benchmarked without hardware. The host opens emulator.port like any other serial port.
+#
+# Commands (10 bytes, opcode first):
+# 0x01 set mag config  -> '02' + cc(2) tmrc os + 4 mag status bytes, '0a'
+# 0x02 set imu config  -> '03' + the 9 config bytes, '0a' (the imu is streamed from then on)
+# 0x03 get mag config  -> '02' config, '0a'
+# 0x04 get imu config  -> '03' config, '0a'
+# 0x05 single measurement -> one data packet, '0a'
+# 0x06 continuous measurement (byte 3 enabled mags, bytes 4-9 length in sec) -> data packets at the sample rate, '0a' at the end
+# 0x07 send data       -> one data packet
+# 0x08 stop            -> ends a continuous measurement, '0a'
+# Bytes that don't start a known command are skipped one at a time, like the firmware resynchronizing.
+#
+# Data packets are '04' (mags), '05' (mags, imu, temperature), '06' (mags, temperature) or '07' (mags, imu) with valid checksums
+# unless corruption is injected:
+# flip   -> one byte of the packet is changed (checksum failure)
+# drop   -> some bytes of the packet never make it out (framing loss)
+# insert -> garbage bytes are sent before the packet
+#
+
+corruption_kinds = ('flip', 'drop', 'insert')
+
+
+class quad_mag_emulator :
+
+    def __init__(self, rate=None, corruption=0.0, noise=0.1, field=(20000.0, -5000.0, 45000.0), drift=0.0, temperature=False,
+                 clock_drift=0.0, seed=None, batch_interval=0.01, kinds=corruption_kinds) :
+        # Input: float rate (packets/sec, None uses the rate the firmware gets for the cycle count, 0 sends as fast as the port takes them),
+        # float corruption (probability a packet is corrupted), float noise (white noise std per axis in nT), tuple field (ambient
+        # field every mag sees in nT), float drift (random walk std per sample in nT), bool temperature (stream temperature readings),
+        # float clock_drift (device clock error, eg. 20e-6), int seed, float batch_interval (sec between writes while streaming),
+        # tuple kinds (which corruption_kinds to inject)
+        self.rate = rate
+        self.corruption = corruption
+        self.noise = noise
+        self.field = np.asarray(field, dtype=np.float64)
+        self.drift = drift
+        self.temperature = temperature
+        self.clock_drift = clock_drift
+        self.batch_interval = batch_interval
+        self.kinds = kinds
+        self.rng = np.random.default_rng(seed)
+        self.mag_config = [800, 0, 1] #cycle count, tmrc, oversamples
+        self.imu_config = None #9 config bytes once the imu has been set up
+        self.offset = np.zeros((4, 3)) #random walk state of each axis
+        self.boot = time.monotonic()
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.loopback = None #loopback_serial the packets go to instead of the pty
+        self.command_buffer = bytearray()
+        self.write_lock = threading.Lock()
+        self.stream_stop = threading.Event()
+        self.stream_thread = None
+        self.command_thread = None
+        self.closed = False
+        self.commands = 0
+        self.packets = 0
+        self.corrupted = 0
+        self.bytes_sent = 0
+
+    def open(self) :
+        # Function Definition: Opens the pty and starts answering commands
+        # Output: self, the host connects to self.port
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave) #the slave end stays open here so the master never sees a hangup between host connections
+        self.port = os.ttyname(self.slave)
+        self.command_thread = threading.Thread(target=self.command_loop, name='quad-mag-emulator', daemon=True)
+        self.command_thread.start()
+        return self
+
+    def open_loopback(self, timeout=3, max_bytes=1 << 22) :
+        # Function Definition: Connects an in-process serial stand-in instead of a pty, so only the host side is measured
+        # Input: float timeout (read timeout in sec like serial.Serial), int max_bytes (bytes buffered before the emulator waits)
+        # Output: loopback_serial
+        self.loopback = loopback_serial(self, timeout, max_bytes)
+        return self.loopback
+
+    def close(self) :
+        self.closed = True
+        self.stream_stop.set()
+        if self.loopback is not None :
+            self.loopback.close()
+        if self.stream_thread is not None :
+            self.stream_thread.join()
+        for fd in (self.master, self.slave) :
+            if fd is not None :
+                os.close(fd)
+        self.master = None
+        self.slave = None
+
+    def __enter__(self) :
+        return self.open()
+
+    def __exit__(self, *exc) :
+        self.close()
+
+    def sample_rate(self) :
+        # Output: float nominal packets/sec, the same fit of the cycle count data_commands_lib uses
+        if self.rate :
+            return float(self.rate)
+        return 457.7786*np.power(0.9966, self.mag_config[0])
+
+    def scale(self) :
+        # Output: float nT per lsb for the current config (same scale factor as data_manipulation_lib)
+        return (1000/(0.3671*self.mag_config[0] + 1.5))/self.mag_config[2]
+
+    def packet_flag(self) :
+        if self.imu_config is not None and self.temperature :
+            return '05'
+        elif self.temperature :
+            return '06'
+        elif self.imu_config is not None :
+            return '07'
+        return '04'
+
+    def write(self, data) :
+        if self.loopback is not None :
+            self.loopback.put(data)
+            self.bytes_sent = self.bytes_sent + len(data)
+            return
+        with self.write_lock :
+            mv = memoryview(data)
+            while len(mv) > 0 : #a full pty blocks the write, the same back pressure a slow host puts on the uart
+                k = os.write(self.master, mv)
+                mv = mv[k:]
+            self.bytes_sent = self.bytes_sent + len(data)
+
+    def command_loop(self) :
+        # Function Definition: Reads commands from the host and answers them
+        while not self.closed :
+            try :
+                data = os.read(self.master, 1024)
+            except OSError : #pty closed
+                break
+            if len(data) == 0 :
+                break
+            try :
+                self.command_bytes_helper(data)
+            except OSError :
+                return
+
+    def command_bytes_helper(self, data) :
+        # Function Definition: Splits the bytes the host sent into commands and answers each complete one
+        buf = self.command_buffer
+        buf.extend(data)
+        while len(buf) > 0 :
+            if buf[0] < 1 or buf[0] > 8 :
+                del buf[0]
+                continue
+            if len(buf) < 10 :
+                break
+            cmd = bytes(buf[0:10])
+            del buf[0:10]
+            if cmd[0] == 5 and len(buf) > 0 and buf[0] == cmd[1] : #data_commands_lib repeats the enabled mags after a single measurement command
+                del buf[0]
+            self.commands = self.commands + 1
+            self.command_helper(cmd)
+
+    def command_helper(self, cmd) :
+        # Function Definition: Answers one command
+        # Input: bytes cmd (10 byte command)
+        op = cmd[0]
+        if op == 1 :
+            self.mag_config = [int.from_bytes(cmd[1:3], 'big'), cmd[3], max(1, cmd[4])]
+            self.write(b'\x02' + self.mag_config_bytes() + b'\x0a')
+        elif op == 2 :
+            self.imu_config = cmd[1:10]
+            self.write(b'\x03' + self.imu_config + b'\x0a')
+        elif op == 3 :
+            self.write(b'\x02' + self.mag_config_bytes() + b'\x0a')
+        elif op == 4 :
+            self.write(b'\x03' + (self.imu_config if self.imu_config is not None else bytes(9)) + b'\x0a')
+        elif op == 5 :
+            self.write(self.packets_helper(1, cmd[1] if cmd[1] != 0 else 0b1111, time.monotonic() - self.boot) + b'\x0a')
+        elif op == 6 :
+            self.stop_stream_helper()
+            self.stream_stop.clear()
+            self.stream_thread = threading.Thread(target=self.stream, args=(int.from_bytes(cmd[4:10], 'big'), cmd[3]),
+                                                  name='quad-mag-emulator-stream', daemon=True)
+            self.stream_thread.start()
+        elif op == 7 :
+            self.write(self.packets_helper(1, 0b1111, time.monotonic() - self.boot))
+        elif op == 8 :
+            if not self.stop_stream_helper() :
+                self.write(b'\x0a') #nothing was streaming, the stream sends its own '0a' otherwise
+
+    def mag_config_bytes(self) :
+        return self.mag_config[0].to_bytes(2, 'big') + bytes([self.mag_config[1], self.mag_config[2], 1, 1, 1, 1])
+
+    def stop_stream_helper(self) :
+        # Output: bool whether a stream was running (it has sent its '0a' by the time this returns)
+        if self.stream_thread is None or not self.stream_thread.is_alive() :
+            return False
+        self.stream_stop.set()
+        self.stream_thread.join()
+        return True
+
+    def stream(self, length, mags_enabled) :
+        # Function Definition: Sends data packets at the sample rate until the measurement length has passed or a stop command
+        # Input: int length (sec), int bit mask of the enabled mags
+        rate = self.sample_rate()
+        total = int(length*rate) if length < 4294967295 else -1
+        realtime = bool(self.rate is None or self.rate > 0)
+        start = time.monotonic()
+        t0 = start - self.boot
+        sent = 0
+        try :
+            while not self.stream_stop.is_set() and (total < 0 or sent < total) :
+                if realtime :
+                    due = int((time.monotonic() - start)*rate) - sent
+                    if due <= 0 :
+                        time.sleep(self.batch_interval)
+                        continue
+                else :
+                    due = 256
+                if total >= 0 :
+                    due = min(due, total - sent)
+                self.write(self.packets_helper(due, mags_enabled, t0 + sent/rate, rate))
+                sent = sent + due
+            self.write(b'\x0a')
+        except OSError : #pty closed
+            pass
+
+    def packets_helper(self, n, mags_enabled, t, rate=None) :
+        # Function Definition: Builds n consecutive data packets, flag bytes included and corruption applied
+        # Input: int n, int bit mask of the enabled mags, float device time of the first packet (sec), float packets/sec
+        # Output: bytes
+        flag = self.packet_flag()
+        rate = self.sample_rate() if rate is None else rate
+        ts = (t + np.arange(n)/rate)*(1 + self.clock_drift)
+        tk = np.rint(ts*32768).astype(np.int64)
+        dc = {'sec': tk//32768, 'tick': tk % 32768}
+        walk = self.rng.normal(0, self.drift, (n, 4, 3)).cumsum(axis=0) + self.offset if self.drift > 0 else np.broadcast_to(self.offset, (n, 4, 3))
+        self.offset = walk[-1].copy()
+        b = self.field + walk + self.rng.normal(0, self.noise, (n, 4, 3))
+        b = b*((np.array([mags_enabled >> i for i in range(0, 4)]) & 1)[None, :, None])
+        dc['b'] = np.clip(np.rint(b/self.scale()), -(1 << 23), (1 << 23) - 1).reshape(n, 12)
+        dc['imu'] = self.rng.integers(-64, 64, (n, 6)) + np.array([0, 0, 16384, 0, 0, 0]) #resting on a table
+        dc['temp'] = np.full(n, 2500) + self.rng.integers(-2, 3, n)
+        pa = ddl.encode_packet_array_quad(dc, flag)
+        records = np.empty((n, pa.shape[1] + 1), dtype=np.uint8)
+        records[:, 0] = int(flag, 16)
+        records[:, 1:] = pa
+        self.packets = self.packets + n
+        if self.corruption <= 0 :
+            return records.tobytes()
+        return self.corrupt_helper(records)
+
+    def corrupt_helper(self, records) :
+        # Function Definition: Corrupts a random selection of packets
+        # Input: numpy array of records (flag byte + packet)
+        # Output: bytes
+        ci = np.nonzero(self.rng.random(len(records)) < self.corruption)[0]
+        if len(ci) == 0 :
+            return records.tobytes()
+        self.corrupted = self.corrupted + len(ci)
+        out = []
+        p = 0
+        for i in ci :
+            out.append(records[p:i].tobytes())
+            r = bytearray(records[i].tobytes())
+            kind = self.kinds[self.rng.integers(0, len(self.kinds))]
+            if kind == 'flip' :
+                k = self.rng.integers(1, len(r))
+                r[k] = r[k] ^ int(self.rng.integers(1, 256))
+            elif kind == 'drop' :
+                k = self.rng.integers(1, len(r))
+                del r[k:k + int(self.rng.integers(1, len(r) - k + 1))]
+            elif kind == 'insert' :
+                r[0:0] = self.rng.integers(0, 256, int(self.rng.integers(1, 9))).astype(np.uint8).tobytes()
+            out.append(bytes(r))
+            p = i + 1
+        out.append(records[p:].tobytes())
+        return b''.join(out)
+
+    def stats(self) :
+        # Output: dict of commands answered, packets built, packets corrupted and bytes sent
+        return {'commands': self.commands, 'packets': self.packets, 'corrupted': self.corrupted, 'bytes_sent': self.bytes_sent}
+
+###End Firmware Emulator###
+
+
+class loopback_serial :
+    #in-process stand-in for a serial.Serial connected to an emulator (read/readinto/in_waiting/write/timeout), no pty in between
+
+    def __init__(self, emulator, timeout=3, max_bytes=1 << 22) :
+        self.emulator = emulator
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.buf = bytearray()
+        self.cv = threading.Condition()
+        self.is_open = True
+        self.command_queue = queue.Queue() #commands are answered on their own thread, a stop must not wait on the host that sent it
+        self.command_thread = threading.Thread(target=self.command_loop, name='quad-mag-loopback', daemon=True)
+        self.command_thread.start()
+
+    def command_loop(self) :
+        while 1 :
+            data = self.command_queue.get()
+            if data is None :
+                break
+            self.emulator.command_bytes_helper(data)
+
+    def put(self, data) :
+        # Function Definition: Emulator side, adds bytes for the host, waits while max_bytes are already buffered
+        with self.cv :
+            while self.is_open and len(self.buf) > 0 and len(self.buf) + len(data) > self.max_bytes :
+                self.cv.wait(0.1)
+            if self.is_open :
+                self.buf.extend(data)
+                self.cv.notify_all()
+
+    @property
+    def in_waiting(self) :
+        return len(self.buf)
+
+    def wait_helper(self, n) :
+        # Function Definition: Waits like serial.Serial until n bytes are buffered or the timeout passes (caller holds cv)
+        end = None if self.timeout is None else time.monotonic() + self.timeout
+        while len(self.buf) < n and self.is_open :
+            rem = None if end is None else end - time.monotonic()
+            if rem is not None and rem <= 0 :
+                break
+            self.cv.wait(rem)
+
+    def read(self, n=1) :
+        with self.cv :
+            self.wait_helper(n)
+            data = bytes(self.buf[0:n])
+            del self.buf[0:n]
+            self.cv.notify_all()
+            return data
+
+    def readinto(self, b) :
+        mv = memoryview(b).cast('B')
+        with self.cv :
+            self.wait_helper(len(mv))
+            k = min(len(mv), len(self.buf))
+            mv[0:k] = self.buf[0:k]
+            del self.buf[0:k]
+            self.cv.notify_all()
+            return k
+
+    def write(self, data) :
+        self.command_queue.put(bytes(data))
+        return len(data)
+
+    def reset_input_buffer(self) :
+        with self.cv :
+            del self.buf[:]
+            self.cv.notify_all()
+
+    def close(self) :
+        if not self.is_open :
+            return
+        self.command_queue.put(None)
+        with self.cv :
+            self.is_open = False
+            self.cv.notify_all()
+
+
+###Capture Replay###
+#
+# Plays a recorded _raw_data.txt or binary _raw_data.bin capture back as the byte stream of a quad-mag, so continuous_measurement,
+# the bulk/threaded acquisition paths and the live analytics can be run against real field data without a board.
+# speed 1 replays in real time by the capture's own timestamps, 10 ten times faster, 0 as fast as the host reads.
+# Only packets that frame and pass their checksum in the capture are replayed, the config responses are the capture's config.
+#
+
+class capture_replay(quad_mag_emulator) :
+
+    def __init__(self, fn, speed=1.0, batch_interval=0.01, max_gap=1.0, chunk_size=1 << 20) :
+        # Input: string fn (raw capture), float speed (1 real time, >1 faster, 0 as fast as possible), float batch_interval (sec between
+        # writes while pacing), float max_gap (longest pause in sec a timestamp jump or wrap in the capture can cause), int chunk_size
+        # (bytes of the capture read at a time)
+        quad_mag_emulator.__init__(self, rate=0, batch_interval=batch_interval)
+        self.fn = fn
+        self.speed = speed
+        self.max_gap = max_gap
+        self.chunk_size = chunk_size
+        self.binary = ddl.is_raw_binary_file(fn)
+        if self.binary :
+            hd, rec = ddl.read_raw_binary_quad(fn)
+            self.mag_config = [hd['cc'], 0, max(1, hd['os'])]
+        else :
+            with open(fn, 'rb') as fr :
+                cs = ddl.raw_data_header_helper(fr)[1].split(',')
+            self.mag_config = [int(cs[0][0:4], 16), 0, max(1, int(cs[1][0:2], 16)) if len(cs) > 1 else 1]
+        self.replays = 0
+        self.elapsed = 0.0 #host sec the last replay took
+
+    def command_helper(self, cmd) :
+        # Function Definition: Answers one command, a set mag config gets the capture's config back (the capture can't be resampled)
+        if cmd[0] == 1 :
+            self.write(b'\x02' + self.mag_config_bytes() + b'\x0a')
+        else :
+            quad_mag_emulator.command_helper(self, cmd)
+
+    def sample_rate(self) :
+        return 457.7786*np.power(0.9966, self.mag_config[0])
+
+    def capture_blocks_helper(self) :
+        # Function Definition: Reads the capture a chunk at a time
+        # Output: generator of [numpy float64 device times (sec), numpy uint8 records (N, flag byte + packet)]
+        if self.binary :
+            hd, rec = ddl.read_raw_binary_quad(self.fn)
+            n = max(1, self.chunk_size // hd['rs'])
+            for i in range(0, len(rec), n) :
+                ra = np.array(rec[i:i + n]).view(np.uint8).reshape(-1, hd['rs'])
+                yield [self.times_helper(ra[:, 1:]), ra]
+            return
+        framer = ddl.packet_framer()
+        with open(self.fn, 'rb') as fr :
+            ddl.raw_data_header_helper(fr)
+            for ls, nb in ddl.raw_data_chunks(fr, self.chunk_size) :
+                try :
+                    framer.feed(bytes.fromhex(' '.join(ls)))
+                except ValueError : #a damaged line, fall back to converting them one at a time
+                    for l in ls :
+                        try :
+                            framer.feed(bytes.fromhex(l.strip()))
+                        except ValueError :
+                            pass
+                for flag, pa in framer.next_blocks() :
+                    if len(pa) == 0 :
+                        continue
+                    ra = np.empty((len(pa), pa.shape[1] + 1), dtype=np.uint8)
+                    ra[:, 0] = int(flag, 16)
+                    ra[:, 1:] = pa
+                    yield [self.times_helper(pa), ra]
+
+    def times_helper(self, pa) :
+        # Output: numpy float64 device time of each packet (4 byte sec + 2 byte tick of 1/32768 sec)
+        sec = ((pa[:, 0].astype(np.int64) << 24) | (pa[:, 1].astype(np.int64) << 16) | (pa[:, 2].astype(np.int64) << 8) | pa[:, 3])
+        return sec + ((pa[:, 4].astype(np.int64) << 8) | pa[:, 5])/32768
+
+    def stream(self, length, mags_enabled) :
+        # Function Definition: Sends the capture's packets paced by their timestamps until the capture ends, the measurement length has
+        # passed (capture time) or a stop command, the enabled mags are whatever the capture recorded
+        # Input: int length (sec), int bit mask of the enabled mags (ignored)
+        start = time.monotonic()
+        ct = 0.0 #capture sec since the first packet, timestamp jumps are limited to max_gap
+        last = None
+        try :
+            for ts, ra in self.capture_blocks_helper() :
+                if self.stream_stop.is_set() :
+                    break
+                dt = np.diff(ts, prepend=ts[0] if last is None else last)
+                last = ts[-1]
+                e = ct + np.cumsum(np.clip(dt, 0, self.max_gap))
+                ct = e[-1]
+                k = len(e) if length >= 4294967295 else int(np.searchsorted(e, length, 'right'))
+                p = 0
+                while p < k and not self.stream_stop.is_set() :
+                    if self.speed > 0 :
+                        q = int(np.searchsorted(e, (time.monotonic() - start)*self.speed, 'right'))
+                        if q <= p :
+                            time.sleep(self.batch_interval)
+                            continue
+                        q = min(q, k)
+                    else :
+                        q = k
+                    self.write(ra[p:q].tobytes())
+                    self.packets = self.packets + q - p
+                    p = q
+                if k < len(e) :
+                    break
+            self.replays = self.replays + 1
+            self.elapsed = time.monotonic() - start
+            self.write(b'\x0a')
+        except OSError : #pty closed
+            pass
+
+    def stats(self) :
+        st = quad_mag_emulator.stats(self)
+        st['replays'] = self.replays
+        st['elapsed'] = self.elapsed
+        return st
+
+
+def replay_decode_rate(fn, read_size=1 << 16, max_bytes=1 << 22, enabled_binary=0) :
+    # Function Definition: Replays a capture as fast as possible through a loopback port into the bulk acquisition loop of
+    # continuous_measurement (data_commands_lib.bulk_read_helper: read, frame, decode, format and write, with the same invalid packet
+    # accounting), the files are written to os.devnull, the maximum rate the host keeps up with
+    # Input: string fn (raw capture), int read_size (initial read buffer size), int max_bytes (bytes the loopback buffers),
+    # bool enabled_binary (write the raw data like a binary capture)
+    # Output: dict of packets written, bytes read, sec, packets/sec, MB/sec, invalid packets and bytes skipped resynchronizing
+    from . import data_commands_lib as dcl #pulls in the plotting libraries, so only when measuring
+    with capture_replay(fn, speed=0) as rp, open(os.devnull, 'wb' if enabled_binary else 'w') as fwr, open(os.devnull, 'w') as fwp :
+        ser = rp.open_loopback(1, max_bytes)
+        framer = ddl.packet_framer()
+        buf = bytearray(read_size)
+        n = 0
+        nb = 0
+        ni = 0
+        start = time.perf_counter()
+        last = start
+        ser.write(b'\x06\x00\x00\x0f' + (4294967295).to_bytes(6, 'big'))
+        while 1 :
+            k, bad, written, done = dcl.bulk_read_helper(ser, framer, buf, fwr, fwp, enabled_binary)
+            nb = nb + k
+            ni = ni + (bad if k > 0 or done else bad - 1) #the read that times out after the last packet isn't an invalid packet
+            if len(written) > 0 :
+                n = n + sum(len(rows) for rows in written)
+                last = time.perf_counter()
+            if done or k == 0 :
+                break
+    el = last - start #the wait for the completion after the last packet isn't decode time
+    return {'packets': n, 'bytes': nb, 'sec': el, 'packets_per_sec': n/el if el > 0 else 0.0, 'mb_per_sec': nb/el/1e6 if el > 0 else 0.0,
+            'invalid': ni, 'skipped': framer.skipped}
+
+###End Capture Replay###
+
+
+def main() :
+    # Function Definition: Runs an emulator until Ctrl-C, eg. python -m data_processing_lib.data_emulation_lib 500 0.001
+    # or replays a capture, eg. python -m data_processing_lib.data_emulation_lib data_storage/run_raw_data.txt 10 (speed, 0 as fast as possible)
+    # or measures the maximum decode rate, eg. python -m data_processing_lib.data_emulation_lib data_storage/run_raw_data.txt rate
+    # Input: command line packet rate (0 as fast as possible) and corruption probability, or a capture and a replay speed
+    if len(sys.argv) > 1 and os.path.isfile(sys.argv[1]) :
+        if len(sys.argv) > 2 and sys.argv[2] == 'rate' :
+            print(replay_decode_rate(sys.argv[1]))
+            return
+        em = capture_replay(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 1.0)
+    else :
+        rate = float(sys.argv[1]) if len(sys.argv) > 1 else None
+        corruption = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+        em = quad_mag_emulator(rate, corruption)
+    with em :
+        print("Quad-mag emulator listening on " + em.port + " (linux: enter the full device path when opening the port)")
+        try :
+            while 1 :
+                time.sleep(5)
+                print(em.stats())
+        except KeyboardInterrupt :
+            pass
+
+
+if __name__ == '__main__' :
+    main()
@@ -1,8 +1,27 @@
 from pickle import TRUE
+import os
+import json
+import time
+import shutil
+import bisect
+import hashlib
 import numpy as np
 import pandas as pd
 from scipy import signal
 
+from . import data_decoding_lib as ddl
+
+repair_time = 0 #set to 1 i.e. TRUE to drop samples that break a monotonic time base when loading a file (loaders also take repair=)
+
+load_timing = 0 #set to 1 i.e. TRUE to print how long each stage of loading a processed data file took
+
+processed_dtypes = dict((i, np.float64) for i in range(1, 14)) #syst-time and the 12 mag readings of a processed data file (24 bit lsb are exact as float64, which parses faster than int32)
+
+cache_enabled = 1 #set to 1 i.e. TRUE to keep parsed captures in cache_path so loading the same file again skips the parse
+cache_path = 'data_storage/cache/'
+cache_max_bytes = 1 << 31 #least recently used entries are removed once the cache holds more than this
+cache_hash_block = 1 << 20 #bytes hashed at the start, middle and end of a capture to detect changes that keep its size and mtime
+
 fix_char = '' #vcoi #TODO fix issue that arises with time array from first data point being removed i.e. set to nan
 
 class quad_data_frame :
@@ -109,33 +128,206 @@ class pni_data_frame :
 
         #self.offset = {0, 0 ,0} #alternative hardcode method
 
+###Compact Dataset###
+#
+# quad_data_frame keeps the timestamps 20 times over (t of the quad and of every mag, 4 identical columns each), the same for td,
+# and every update_self rebuilds DataFrames. quad_dataset keeps one float64 time vector and one contiguous (N, 4 mags, 3 axes)
+# array of scaled readings, everything else (|B|, the offset removed quad average, td, sr) is derived when asked for.
+# p/t/td/sr/c/cc/os/mn give the same read-only views quad_data_frame does (c[i] the same for pni_data_frame), code that
+# modifies a frame in place (fix_self, decimate_helper) works on to_quad_data_frame().
+#
+
+class quad_dataset :
+    __slots__ = ('tv', 'ba', 'cc', 'os', 'mn')
+
+    def __init__(self, tv, ba, cc, os, mn='quad') :
+        # in: numpy tv (N timestamps in sec from 0), numpy ba (N, 4, 3) readings in nT, int cc (cycle count), int os (oversamples), mn (identification)
+        self.tv = np.ascontiguousarray(tv, dtype=np.float64)
+        self.ba = np.ascontiguousarray(ba, dtype=np.float64)
+        self.cc = cc
+        self.os = os
+        self.mn = mn
+
+    def __len__(self) :
+        return len(self.tv)
+
+    def window(self, i, j) :
+        # def: rows i to j as a dataset of views into this one (no copy), timestamps keep the original time base
+        return quad_dataset(self.tv[i:j], self.ba[i:j], self.cc, self.os, self.mn)
+
+    def nbytes(self) :
+        return self.tv.nbytes + self.ba.nbytes
+
+    def bm(self) :
+        # out: numpy (N, 4) |B| of every mag
+        return np.sqrt(np.einsum('ijk,ijk->ij', self.ba, self.ba))
+
+    def offset(self) :
+        # out: numpy (4, 3) mean of every axis of every mag (see pni_data_frame.calc_offset)
+        return self.ba.mean(axis=0)
+
+    def quad(self) :
+        # out: numpy (N, 4) x, y, z averaged over the mags after removing each mag's offset, and their |B| (see quad_data_frame.p)
+        q = np.empty((len(self.tv), 4))
+        np.add(self.ba[:, 0], self.ba[:, 1], out=q[:, 0:3]) #mag by mag, a reduction over the middle axis is several times slower
+        q[:, 0:3] += self.ba[:, 2]
+        q[:, 0:3] += self.ba[:, 3]
+        q[:, 0:3] *= 0.25
+        q[:, 0:3] -= self.offset().mean(axis=0)
+        q[:, 3] = np.sqrt(np.einsum('ij,ij->i', q[:, 0:3], q[:, 0:3]))
+        return q
+
+    def tdv(self) :
+        # out: numpy (N-1) period between each measurement
+        return np.diff(self.tv)
+
+    @property
+    def sr(self) :
+        return 1/(self.tdv().mean())
+
+    @property
+    def p(self) :
+        return pd.DataFrame(self.quad(), columns=['0', '1', '2', '3'], copy=False)
+
+    @property
+    def t(self) :
+        return pd.DataFrame(dict((k, self.tv) for k in ('0', '1', '2', '3')))
+
+    @property
+    def td(self) :
+        return pd.DataFrame(dict((k, self.tdv()) for k in ('0', '1', '2', '3')))
+
+    @property
+    def c(self) :
+        return [quad_dataset_mag(self, i) for i in range(0, 4)]
+
+    def to_quad_data_frame(self) :
+        # def: builds the equivalent quad_data_frame for code that modifies frames in place
+        # out: quad_data_frame (same values quad_data_frame_helper gives for the same readings)
+        po = quad_data_frame()
+        po.c = np.array([pni_data_frame(), pni_data_frame(), pni_data_frame(), pni_data_frame()]) #weird fix for bad python init
+        for i in range(0, 4) :
+            m = self.c[i]
+            po.c[i].t = m.t
+            po.c[i].p = m.p
+            po.c[i].td = m.td
+            po.c[i].sr = m.sr
+            po.c[i].cc = self.cc
+            po.c[i].os = self.os
+            po.c[i].mn = i
+            po.c[i].offset = list(m.offset)
+        po.t = self.t
+        po.p = self.p
+        po.td = self.td
+        po.sr = self.sr
+        po.cc = self.cc
+        po.os = self.os
+        po.mn = self.mn
+        return po
+
+class quad_dataset_mag :
+    #read-only pni_data_frame view of one mag of a quad_dataset
+    __slots__ = ('ds', 'mn')
+
+    def __init__(self, ds, mn) :
+        self.ds = ds
+        self.mn = mn
+
+    @property
+    def cc(self) :
+        return self.ds.cc
+
+    @property
+    def os(self) :
+        return self.ds.os
+
+    @property
+    def offset(self) :
+        return self.ds.ba[:, self.mn, :].mean(axis=0)
+
+    @property
+    def sr(self) :
+        return self.ds.sr
+
+    @property
+    def p(self) :
+        pa = np.empty((len(self.ds.tv), 4))
+        pa[:, 0:3] = self.ds.ba[:, self.mn, :]
+        pa[:, 3] = np.sqrt(np.einsum('ij,ij->i', pa[:, 0:3], pa[:, 0:3]))
+        return pd.DataFrame(pa, columns=['0', '1', '2', '3'], copy=False)
+
+    @property
+    def t(self) :
+        return self.ds.t
+
+    @property
+    def td(self) :
+        return self.ds.td
+
+def as_quad_data_frame(do) :
+    # def: gives a frame that can be modified in place, quad_data_frames are returned as they are
+    # in: quad_dataset or quad_data_frame do
+    # out: quad_data_frame
+    return do.to_quad_data_frame() if isinstance(do, quad_dataset) else do
+
+###End Compact Dataset###
+
 def pni_file_decode_quad(fn) :
     # def: decodes file based on quad mag python code formatting into a data_frame object and returns it
-    # in: string fn (file to read from), int mn (mag identification)
+    # in: string fn (file to read from, processed data file or binary raw capture), int mn (mag identification)
     # out: quad_data_frame populated with file contents 
+    if ddl.is_raw_binary_file(fn) :
+        return pni_binary_decode_quad(fn)
+    if ddl.is_columns_file(fn) :
+        hd, dc = ddl.read_columns_quad(fn)
+        return pni_columns_decode_quad(dc, hd['cc'], hd['os'])
+
     cdf = pd.read_csv(fn, skiprows=1, nrows=1, header=None)
+    pdf = pd.read_csv(fn, skiprows=4, header=None) #read into pd dataframe, skipping file header and blank line
+
+    #fix_corrupted_file(pdf)
+
+    return quad_data_frame_helper(pdf.iloc[:,1], pdf.iloc[:,2:14], cdf.iloc[0,0], cdf.iloc[0,1])
+
+def pni_binary_decode_quad(fn) :
+    # def: decodes a binary raw capture into a data_frame object and returns it
+    # in: string fn (binary raw capture to read from)
+    # out: quad_data_frame populated with file contents
+    hd, rec = ddl.read_raw_binary_quad(fn)
+    dc = ddl.decode_packet_array_quad(rec, hd['flag'])
+    return pni_columns_decode_quad(dc, hd['cc'], hd['os'])
+
+def pni_columns_decode_quad(dc, cc, os) :
+    # def: builds a data_frame object straight from decoded columns, eg. a capture that was just taken
+    # in: dict dc (columns from data_decoding_lib.decode_packet_array_quad), int cc (cycle count), int os (oversamples)
+    # out: quad_data_frame populated with the columns
+    return quad_data_frame_helper(pd.Series(dc['t']), pd.DataFrame(dc['b']), cc, os)
+
+def quad_data_frame_helper(t, bdf, cc, os) :
+    # def: builds a quad_data_frame from raw timestamps and mag readings
+    # in: panda series t (timestamps in seconds), panda dataframe bdf (12 mag readings in lsb, B1-X first), int cc (cycle count), int os (oversamples)
+    # out: quad_data_frame populated with the scaled readings
+    if repair_time :
+        t, bdf = monotonic_time_helper(t, bdf)
+
     po = quad_data_frame()
     po.c = np.array([pni_data_frame(), pni_data_frame(), pni_data_frame(), pni_data_frame()]) #weird fix for bad python init
-    po.cc = cdf.iloc[0,0]
-    po.os = cdf.iloc[0,1]
+    po.cc = cc
+    po.os = os
 
     sf = float((1000/(0.3671 * po.cc + 1.5)) / po.os) #current accepted method
     #sf = float(1000/(0.3671 * cc * os + 1.5)) #alternative
-    pdf = pd.read_csv(fn, skiprows=4, header=None) #read into pd dataframe, skipping file header and blank line
-
-    #fix_corrupted_file(pdf)
 
     xtt = 0
     ytt = 0
     ztt = 0
 
-    t = pdf.iloc[:,1]
     t = t.sub(t.iloc[0]) # start time from zero
-    x = pdf.iloc[:,2].multiply(sf) #xpni readings
+    x = bdf.iloc[:,0].multiply(sf) #xpni readings
     xtt = x
-    y = pdf.iloc[:,3].multiply(sf) #ypni readings
+    y = bdf.iloc[:,1].multiply(sf) #ypni readings
     ytt = y
-    z = pdf.iloc[:,4].multiply(sf) #zpni readings
+    z = bdf.iloc[:,2].multiply(sf) #zpni readings
     ztt = z
     b = x.pow(2)+y.pow(2)+z.pow(2) #bpni readings
     b = b.pow(0.5)
@@ -154,11 +346,11 @@ def pni_file_decode_quad(fn) :
     po.c[0].offset = [0, 0, 0]
     po.c[0].calc_offset()
 
-    x = pdf.iloc[:,5].multiply(sf) #xpni readings
+    x = bdf.iloc[:,3].multiply(sf) #xpni readings
     xtt = xtt.add(x)
-    y = pdf.iloc[:,6].multiply(sf) #ypni readings
+    y = bdf.iloc[:,4].multiply(sf) #ypni readings
     ytt = ytt.add(y)
-    z = pdf.iloc[:,7].multiply(sf) #zpni readings
+    z = bdf.iloc[:,5].multiply(sf) #zpni readings
     ztt = ztt.add(z)
     b = x.pow(2)+y.pow(2)+z.pow(2) #bpni readings
     b = b.pow(0.5)
@@ -173,11 +365,11 @@ def pni_file_decode_quad(fn) :
     po.c[1].offset = [0, 0, 0]
     po.c[1].calc_offset()
 
-    x = pdf.iloc[:,8].multiply(sf) #xpni readings
+    x = bdf.iloc[:,6].multiply(sf) #xpni readings
     xtt = xtt.add(x)
-    y = pdf.iloc[:,9].multiply(sf) #ypni readings
+    y = bdf.iloc[:,7].multiply(sf) #ypni readings
     ytt = ytt.add(y)
-    z = pdf.iloc[:,10].multiply(sf) #zpni readings
+    z = bdf.iloc[:,8].multiply(sf) #zpni readings
     ztt = ztt.add(z)
     b = x.pow(2)+y.pow(2)+z.pow(2) #bpni readings
     b = b.pow(0.5)
@@ -192,11 +384,11 @@ def pni_file_decode_quad(fn) :
     po.c[2].offset = [0, 0, 0]
     po.c[2].calc_offset()
 
-    x = pdf.iloc[:,11].multiply(sf) #xpni readings
+    x = bdf.iloc[:,9].multiply(sf) #xpni readings
     xtt = xtt.add(x)
-    y = pdf.iloc[:,12].multiply(sf) #ypni readings
+    y = bdf.iloc[:,10].multiply(sf) #ypni readings
     ytt = ytt.add(y)
-    z = pdf.iloc[:,13].multiply(sf) #zpni readings
+    z = bdf.iloc[:,11].multiply(sf) #zpni readings
     ztt = ztt.add(z)
     b = x.pow(2)+y.pow(2)+z.pow(2) #bpni readings
     b = b.pow(0.5)
@@ -233,6 +425,109 @@ def pni_file_decode_quad(fn) :
 
     return po
 
+def pni_file_decode_dataset(fn, repair=None) :
+    # def: decodes a file like pni_file_decode_quad into the compact quad_dataset
+    # in: string fn (processed data file, columns file or binary raw capture), bool repair (drop samples that break a monotonic
+    # time base, None uses repair_time)
+    # out: quad_dataset populated with file contents
+    if ddl.is_raw_binary_file(fn) :
+        hd, rec = ddl.read_raw_binary_quad(fn)
+        dc = ddl.decode_packet_array_quad(rec, hd['flag'])
+        return quad_dataset_helper(dc['t'], dc['b'], hd['cc'], hd['os'], repair=repair)
+    if ddl.is_columns_file(fn) :
+        hd, dc = ddl.read_columns_quad(fn)
+        return quad_dataset_helper(dc['t'], dc['b'], hd['cc'], hd['os'], repair=repair)
+
+    return pni_fast_decode_quad(fn, repair)
+
+def pni_fast_decode_quad(fn, repair=None) :
+    # def: loads a processed data file in one pass, the header is read off the same open file the body is parsed from, only the
+    # time and mag columns are parsed and with fixed dtypes (no type inference), all 12 mag channels are scaled in one operation
+    # in: string fn (processed data file), bool repair (see pni_file_decode_dataset)
+    # out: quad_dataset populated with file contents
+    tm = [['open/header', time.perf_counter()]]
+    with open(fn, 'rb') as fr :
+        fr.readline() #description
+        cs = fr.readline().decode('ascii').strip().split(',')
+        cc = int(cs[0])
+        os = int(cs[1]) if len(cs) > 1 else 1
+        fr.readline() #blank line
+        fr.readline() #column header
+        tm.append(['parse', time.perf_counter()])
+        pa = pd.read_csv(fr, header=None, usecols=range(1, 14), dtype=processed_dtypes, engine='c').to_numpy() #one (N, 13) block
+    nr = np.isnan(pa).any(axis=1)
+    if nr.any() : #damaged rows (eg. an empty field)
+        print("Rows Discarded (missing fields): " + str(int(nr.sum())) + "\n")
+        pa = pa[~nr]
+    t = pa[:, 0]
+    b = pa[:, 1:13]
+    tm.append(['build dataset', time.perf_counter()])
+    po = quad_dataset_helper(t, b, cc, os, repair)
+    if load_timing :
+        tm.append(['', time.perf_counter()])
+        print("***Load Timing***")
+        print("Rows: " + str(len(po)))
+        for i in range(0, len(tm) - 1) :
+            print(tm[i][0] + " (s): " + str(round(tm[i+1][1] - tm[i][1], 4)))
+        print("Total (s): " + str(round(tm[-1][1] - tm[0][1], 4)))
+        print("\n")
+    return po
+
+def quad_dataset_helper(t, b, cc, os, repair=None) :
+    # def: builds a quad_dataset from raw timestamps and mag readings
+    # in: numpy t (timestamps in seconds), numpy b (N, 12 mag readings in lsb, B1-X first), int cc (cycle count), int os (oversamples),
+    # bool repair (see pni_file_decode_dataset)
+    # out: quad_dataset populated with the scaled readings
+    t = np.asarray(t, dtype=np.float64)
+    if repair_time if repair is None else repair :
+        m = monotonic_time_array_helper(t)
+        t = m[0]
+        if m[1] is not None :
+            b = b[m[1]]
+
+    sf = float((1000/(0.3671 * cc + 1.5)) / os) #current accepted method
+
+    ba = np.multiply(b, sf, dtype=np.float64).reshape(len(t), 4, 3) #one pass over all 12 channels
+    po = quad_dataset(t - t[0], ba, cc, os)
+
+    pni_describe(po)
+
+    return po
+
+def monotonic_time_array_helper(tv) :
+    # def: array version of monotonic_time_helper
+    # in: numpy tv (timestamps in seconds)
+    # out: [numpy timestamps (counter wraps unwrapped) with the bad samples removed, numpy bool mask of the samples kept or None if all were kept]
+    fm = np.isfinite(tv) #samples without a timestamp (nan) are removed before the times are turned into ticks
+    nt = len(tv) - int(fm.sum())
+    if nt > 0 :
+        tv = tv[fm]
+    tk = np.rint(tv * 32768.0).astype(np.int64) #timestamps are whole 1/32768 sec ticks
+    tk, m, rp = ddl.repair_timestamps_quad(tk // 32768, tk % 32768)
+    if nt > 0 or rp['masked'] > 0 or rp['wraps'] > 0 or len(rp['gaps']) > 0 :
+        print("***Timestamp Report***")
+        print("Counter Wraps: " + str(rp['wraps']) + "\nBackwards Jumps: " + str(rp['backwards']) + "\nDuplicates: " + str(rp['duplicates']))
+        print("Missing Timestamps: " + str(nt))
+        print("Samples Removed: " + str(rp['masked'] + nt) + "\nGaps: " + str(len(rp['gaps'])))
+        print("\n")
+    if rp['wraps'] > 0 :
+        tv = tk / 32768.0
+    if rp['masked'] > 0 :
+        tv = tv[m]
+        fm[fm] = m
+    if nt == 0 and rp['masked'] == 0 :
+        return [tv, None]
+    return [tv, fm]
+
+def monotonic_time_helper(t, bdf) :
+    # def: drops samples that would make the time base go backwards or repeat, prints what was found
+    # in: panda series t (timestamps in seconds), panda dataframe bdf (mag readings)
+    # out: [t, bdf] with the bad samples removed and the index reset
+    tv, m = monotonic_time_array_helper(t.to_numpy(dtype=np.float64))
+    if m is None :
+        return [pd.Series(tv, index=t.index), bdf]
+    return [pd.Series(tv), bdf[m].reset_index(drop=True)]
+
 def pni_file_decode_sean(fn, os, cc, mn) :
     # def: decodes file based on seans python code formatting into a data_frame object and returns it
     # in: string fn (file to read from), int os (number of oversamples), int cc (cycle count), int mn (mag identification)
@@ -406,35 +701,40 @@ def pni_describe(pdf) :
     print("Mag Identification Number: " +  str(pdf.mn))
     print("Cycle Count: " + str(pdf.cc) + "\nNumber of Oversamples: " + str(pdf.os))
     print("Sampling Rate (Hz): " + str(round(pdf.sr, 3)))
-    print('X Component Stdev (nT): ' + str(round(pdf.p.iloc[:, 0].std(), 3)))
-    print('Y Component Stdev (nT): ' + str(round(pdf.p.iloc[:, 1].std(), 3)))
-    print('Z Component Stdev (nT): ' + str(round(pdf.p.iloc[:, 2].std(), 3)))
-    print('|B|-field Stdev (nT): ' + str(round(pdf.p.iloc[:, 3].std(), 3)))
+    p = pdf.p #built once for a quad_dataset
+    print('X Component Stdev (nT): ' + str(round(p.iloc[:, 0].std(), 3)))
+    print('Y Component Stdev (nT): ' + str(round(p.iloc[:, 1].std(), 3)))
+    print('Z Component Stdev (nT): ' + str(round(p.iloc[:, 2].std(), 3)))
+    print('|B|-field Stdev (nT): ' + str(round(p.iloc[:, 3].std(), 3)))
     print("\n") 
 
 def find_best_window(pdf, wl, f, n=1) :
     # def: finds the |B| field lowest stdev for a wl window length in a pni_data_frame
-    # in: pdf pni_data_frame (data), wl int window length 
-    # out: pdf pni_data_frame containing data from best wl length window
+    # in: pdf pni_data_frame (data, quad_data_frame or quad_dataset with 'a'), wl int window length, int n (number of windows with 'a')
+    # out: pdf pni_data_frame containing data from best wl length window, a list of the n best windows (lowest stdev first, they
+    # don't overlap) if n > 1
 
     # window average the data and update lowest stdev
     # note -> assumes that stdev at some point will be less than 1000000
     aod = True if f.find('a') != -1 else False
 
-    mpdf = pdf
-
     if aod :
 
         por = []
 
-        for j in range(0, n) :
+        wr = best_windows(pdf.p.iloc[:,3].to_numpy(), wl, n) #every window is scored once, the windows index the original data
+        if len(wr) == 0 :
+            wr = [[0, wl]]
+        if len(wr) < n :
+            print('***Only ' + str(len(wr)) + ' of ' + str(n) + ' best windows of ' + str(wl) + ' points fit in the data***\n')
+
+        for j in range(0, len(wr)) :
 
-            istd = 0
-            lstd = 1000000
-            for i in range(0, (len(mpdf.p.iloc[:,3]) - wl)) :
-                s = mpdf.p.iloc[i:i+wl,3].std()
-                istd = i if s < lstd else istd
-                lstd = s if s < lstd else lstd 
+            mpdf = pdf
+            istd = wr[j][0]
+            if isinstance(pdf, quad_dataset) : #only the window is turned into frames
+                mpdf = pdf.window(wr[j][0], wr[j][1])
+                istd = 0
             
             po = quad_data_frame()
             po.c = np.array([pni_data_frame(), pni_data_frame(), pni_data_frame(), pni_data_frame()]) #weird fix for bad python init
@@ -471,17 +771,6 @@ def find_best_window(pdf, wl, f, n=1) :
             if n == 1 :
                 return po
 
-            for k in range(0,4) :
-                x = pd.Series(np.delete(mpdf.c[k].p.iloc[:,0].to_numpy(), slice(istd, istd+wl)))
-                y = pd.Series(np.delete(mpdf.c[k].p.iloc[:,1].to_numpy(), slice(istd, istd+wl)))
-                z = pd.Series(np.delete(mpdf.c[k].p.iloc[:,2].to_numpy(), slice(istd, istd+wl)))
-                t = pd.Series(np.delete(mpdf.c[k].t.iloc[:,0].to_numpy(), slice(istd, istd+wl)))
-
-                mpdf.c[k].t = pd.DataFrame({'0': t, '1':t, '2':t, '3':t})
-                mpdf.c[k].p = pd.DataFrame({'0': x,'1':y,'2': z,'3': z})
-                
-            mpdf.update_self()
-
             por.append(po)
 
             print('Found Best Window ' + str(j) + '!\n')
@@ -491,12 +780,7 @@ def find_best_window(pdf, wl, f, n=1) :
 
     else :
 
-        istd = 0
-        lstd = 1000000
-        for i in range(0, (len(pdf.p.iloc[:,3]) - wl)) :
-            s = pdf.p.iloc[i:i+wl,3].std()
-            istd = i if s < lstd else istd
-            lstd = s if s < lstd else lstd
+        istd = best_window_helper(pdf.p.iloc[:,3].to_numpy(), wl)
         
         po = pni_data_frame()
 
@@ -524,6 +808,74 @@ def find_best_window(pdf, wl, f, n=1) :
         return po
 
 
+def rolling_std(x, wl, ddof=1) :
+    # def: stdev of every wl long window of x in O(N) from cumulative sums, x has its mean removed first so the sums stay small
+    # and subtracting them doesn't lose the precision a plain sum of squares would
+    # in: numpy x (data), int wl (window length), int ddof (delta degrees of freedom, 1 like pandas .std())
+    # out: numpy array of len(x)-wl+1 stdevs, entry i is the stdev of x[i:i+wl]
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x) - wl + 1
+    if n <= 0 :
+        return np.zeros(0)
+    if wl <= ddof :
+        return np.full(n, np.nan)
+    xs = x - x.mean()
+    c1 = np.zeros(len(x) + 1)
+    np.cumsum(xs, out=c1[1:])
+    c2 = np.zeros(len(x) + 1)
+    np.cumsum(xs*xs, out=c2[1:])
+    s1 = c1[wl:] - c1[:n]
+    v = (c2[wl:] - c2[:n] - s1*s1/wl)/(wl - ddof)
+    return np.sqrt(np.maximum(v, 0.0)) #rounding can leave a flat window slightly negative
+
+def best_window_helper(b, wl) :
+    # def: start of the lowest stdev wl window of b, windows start at 0 to len(b)-wl-1 and the first of equal stdevs wins (same as
+    # the original search loop, which also ignored stdevs of 1000000 or more)
+    # in: numpy b (|B| field), int wl (window length)
+    # out: int start index of the best window
+    wr = best_windows(b, wl, 1)
+    return wr[0][0] if len(wr) > 0 else 0
+
+def best_windows(b, wl, k=1) :
+    # def: the k lowest stdev wl windows of b that don't overlap, every window is scored once (see rolling_std) and windows are
+    # taken best first, ties go to the earlier window, a window is skipped if it overlaps one already taken or would leave too
+    # little room for the windows still needed (so k windows are found whenever k fit in the data)
+    # in: numpy b (|B| field), int wl (window length), int k (number of windows)
+    # out: list of [int start, int end] index ranges into b, lowest stdev first (fewer than k only if k windows don't fit)
+    rs = rolling_std(b, wl)[0:max(0, len(b) - wl)]
+    ok = np.nonzero(~np.isnan(rs) & (rs < 1000000))[0]
+    dl = len(rs) - 1 + wl #data the candidate windows can cover, windows start at 0 to len(b)-wl-1
+    ws = [] #starts taken so far, sorted
+    cap = max(0, dl // wl) #windows that still fit in the free gaps
+    kt = min(k, cap) #windows that can be found
+    wr = []
+    for i in ok[np.argsort(rs[ok], kind='stable')] :
+        if len(wr) == kt :
+            break
+        p = bisect.bisect(ws, i)
+        lo = ws[p - 1] + wl if p > 0 else 0 #free gap [lo, hi) around i
+        hi = ws[p] if p < len(ws) else dl
+        if i < lo or i + wl > hi : #overlaps a window already taken
+            continue
+        nc = cap - (hi - lo) // wl + (i - lo) // wl + (hi - i - wl) // wl
+        if nc < kt - len(wr) - 1 : #taking it would leave no room for the rest
+            continue
+        ws.insert(p, int(i))
+        cap = nc
+        wr.append([int(i), int(i) + wl])
+    return wr
+
+def best_window_views(pdf, wl, k=1) :
+    # def: the k best windows of a data set without copying it
+    # in: quad_dataset pdf (a quad_data_frame gets its windows built by find_best_window), int wl (window length), int k (number of windows)
+    # out: list of quad_dataset views into pdf, lowest stdev first
+    if not isinstance(pdf, quad_dataset) :
+        return find_best_window(pdf, wl, 'a', k) if k > 1 else [find_best_window(pdf, wl, 'a')]
+    wr = best_windows(pdf.quad()[:, 3], wl, k)
+    if len(wr) < k :
+        print('***Only ' + str(len(wr)) + ' of ' + str(k) + ' best windows of ' + str(wl) + ' points fit in the data***\n')
+    return [pdf.window(i, j) for i, j in wr]
+
 def fix_corrupted_file(pdf) :
     #
     #
@@ -534,4 +886,354 @@ def fix_corrupted_file(pdf) :
             pdf.drop(labels=i, axis=0, inplace=True)
             print("Found corrupted data at line " + str(i) + '\n' + 'with value')
 
-    return pdf
\ No newline at end of file
+    return pdf
+
+###Capture Cache###
+#
+# A parsed capture is kept as raw .npy arrays (tv, ba) plus a meta.json in cache_path/<hash of the absolute path>/. The entry
+# is only used while the capture's size, mtime and sampled content hash (and the settings that change the parse) still match,
+# otherwise it is removed and rebuilt. Arrays are loaded memory mapped so a hit costs almost nothing until the data is used.
+# Loading an entry marks it used, entries used longest ago are removed once the cache is larger than cache_max_bytes.
+#
+
+cache_version = 1 #bump when the layout of an entry changes
+
+def pni_cached_decode_dataset(fn, repair=None) :
+    # def: pni_file_decode_dataset through the capture cache
+    # in: string fn (processed data file, columns file or binary raw capture), bool repair (see pni_file_decode_dataset)
+    # out: quad_dataset (memory mapped read-only arrays when it came from the cache)
+    repair = bool(repair_time if repair is None else repair)
+    if not cache_enabled :
+        return pni_file_decode_dataset(fn, repair)
+    name, ident = cache_key_helper(fn, repair)
+    ed = os.path.join(cache_path, name)
+    po = cache_load_helper(ed, ident)
+    if po is not None :
+        print("Loaded " + fn + " from the cache (" + ed + ")\n")
+        pni_describe(po)
+        return po
+    po = pni_file_decode_dataset(fn, repair)
+    try :
+        cache_store_helper(ed, ident, po)
+        cache_evict_helper(ed)
+    except OSError as e :
+        print("Could not cache " + fn + ": " + str(e) + "\n")
+    return po
+
+def cache_key_helper(fn, repair) :
+    # def: identifies a capture for the cache
+    # in: string fn (capture), bool repair (entries loaded with and without the time repair differ)
+    # out: [string entry directory name, dict identity the entry has to match]
+    ap = os.path.abspath(fn)
+    st = os.stat(ap)
+    h = hashlib.blake2b(digest_size=16)
+    with open(ap, 'rb') as fr :
+        for p in sorted(set([0, max(0, st.st_size // 2 - cache_hash_block // 2), max(0, st.st_size - cache_hash_block)])) :
+            fr.seek(p)
+            h.update(fr.read(cache_hash_block))
+    ident = {'path': ap, 'size': st.st_size, 'mtime': st.st_mtime_ns, 'hash': h.hexdigest(), 'version': cache_version, 'repair': int(repair)}
+    return [hashlib.blake2b(ap.encode('utf-8'), digest_size=8).hexdigest(), ident]
+
+def cache_load_helper(ed, ident) :
+    # def: loads a cache entry if it still matches the capture, a stale or damaged entry is removed
+    # in: string ed (entry directory), dict ident (see cache_key_helper)
+    # out: quad_dataset or None
+    mf = os.path.join(ed, 'meta.json')
+    if not os.path.isfile(mf) :
+        return None
+    try :
+        with open(mf, 'r') as fm :
+            md = json.load(fm)
+        if md['id'] != ident :
+            raise ValueError('stale')
+        tv = np.load(os.path.join(ed, 'tv.npy'), mmap_mode='r')
+        ba = np.load(os.path.join(ed, 'ba.npy'), mmap_mode='r')
+        if len(tv) != md['rows'] or ba.shape != (md['rows'], 4, 3) :
+            raise ValueError('damaged')
+    except (OSError, ValueError, KeyError) :
+        shutil.rmtree(ed, ignore_errors=True)
+        return None
+    os.utime(mf) #marks the entry used for the lru eviction
+    return quad_dataset(tv, ba, md['cc'], md['os'], md['mn'])
+
+def cache_store_helper(ed, ident, po) :
+    # def: writes a cache entry, into a temporary directory that is renamed into place so a reader never sees half an entry
+    # in: string ed (entry directory), dict ident (see cache_key_helper), quad_dataset po
+    os.makedirs(os.path.dirname(ed), exist_ok=True)
+    td = ed + '.' + str(os.getpid()) + '.tmp'
+    shutil.rmtree(td, ignore_errors=True)
+    os.makedirs(td)
+    np.save(os.path.join(td, 'tv.npy'), po.tv)
+    np.save(os.path.join(td, 'ba.npy'), po.ba)
+    with open(os.path.join(td, 'meta.json'), 'w') as fm :
+        json.dump({'id': ident, 'rows': len(po), 'cc': int(po.cc), 'os': int(po.os), 'mn': po.mn}, fm)
+    shutil.rmtree(ed, ignore_errors=True)
+    os.rename(td, ed)
+
+def cache_evict_helper(keep=None) :
+    # def: removes the least recently used entries until the cache holds at most cache_max_bytes
+    # in: string keep (entry directory that is never removed, eg. the one just written)
+    # out: int bytes removed
+    es = []
+    for name in os.listdir(cache_path) :
+        ed = os.path.join(cache_path, name)
+        mf = os.path.join(ed, 'meta.json')
+        if not os.path.isdir(ed) or not os.path.isfile(mf) :
+            continue
+        sz = sum(os.path.getsize(os.path.join(ed, f)) for f in os.listdir(ed))
+        es.append([os.path.getmtime(mf), sz, ed])
+    es.sort()
+    total = sum(e[1] for e in es)
+    removed = 0
+    for used, sz, ed in es :
+        if total <= cache_max_bytes :
+            break
+        if keep is not None and os.path.abspath(ed) == os.path.abspath(keep) :
+            continue
+        shutil.rmtree(ed, ignore_errors=True)
+        total = total - sz
+        removed = removed + sz
+    return removed
+
+###End Capture Cache###
+
+###Running Statistics###
+#
+# Single pass statistics of a capture while it is being taken. Each decoded block is reduced to its own count, mean and
+# central moments and merged into the running totals with the pairwise (Chan/Pebay) update, so every sample is touched once
+# and the totals are O(1) in memory no matter how long the capture runs. The results match pandas (std with ddof=1, kurt is
+# the sample excess kurtosis) to rounding.
+#
+
+stat_labels = ['B1-X', 'B1-Y', 'B1-Z', 'B2-X', 'B2-Y', 'B2-Z', 'B3-X', 'B3-Y', 'B3-Z', 'B4-X', 'B4-Y', 'B4-Z',
+               'B1', 'B2', 'B3', 'B4', 'Quad-X', 'Quad-Y', 'Quad-Z', 'Quad-B']
+
+def stat_channels_helper(b, sf) :
+    # def: builds the tracked channels from a block of mag readings
+    # in: numpy array b (N, 12) mag readings in lsb B1-X first, float sf (lsb to nT)
+    # out: numpy array (N, 20) in nT, columns as in stat_labels (per axis, per mag |B|, quad average axes and its |B|)
+    bs = b.astype(np.float64) * sf
+    m = bs.reshape(len(bs), 4, 3)
+    q = m.mean(axis=1) #same quad average as quad_data_frame.update_self
+    return np.hstack((bs, np.sqrt((m*m).sum(axis=2)), q, np.sqrt((q*q).sum(axis=1))[:, None]))
+
+class running_stats :
+    def __init__(self, cc, os, labels=stat_labels) :
+        # in: int cc (cycle count), int os (oversamples), list labels (one per channel)
+        self.sf = float((1000/(0.3671 * cc + 1.5)) / os) #same scale factor as quad_data_frame_helper
+        self.labels = labels
+        nc = len(labels)
+        self.n = 0
+        self.mean = np.zeros(nc)
+        self.m2 = np.zeros(nc) #sums of 2nd, 3rd and 4th powers of the deviations from the mean
+        self.m3 = np.zeros(nc)
+        self.m4 = np.zeros(nc)
+        self.mn = np.full(nc, np.inf)
+        self.mx = np.full(nc, -np.inf)
+        self.t0 = None #device time of the first and latest sample
+        self.t1 = None
+        self.rn = 0 #sample count and device time at the last report, for the recent rate
+        self.rt = None
+
+    def update_columns(self, dc) :
+        # def: adds a block decoded by data_decoding_lib.decode_packet_array_quad, blocks without all 12 mag axes are ignored
+        # in: dict of columns
+        # out: none
+        if dc['b'].ndim == 2 and dc['b'].shape[1] == 12 and len(dc['b']) > 0 :
+            self.update(stat_channels_helper(dc['b'], self.sf), dc['t'])
+
+    def update(self, x, t=None) :
+        # def: merges a block of samples into the running totals
+        # in: numpy array x (N, channels), numpy array t (N device times in sec) or None
+        # out: none
+        nb = len(x)
+        if nb == 0 :
+            return
+        mb = x.mean(axis=0)
+        d = x - mb
+        d2 = d*d
+        m2b = d2.sum(axis=0)
+        m3b = (d2*d).sum(axis=0)
+        m4b = (d2*d2).sum(axis=0)
+        na = self.n
+        n = na + nb
+        dl = mb - self.mean
+        self.mean = self.mean + dl*(nb/n)
+        self.m4 = self.m4 + m4b + dl**4*(na*nb*(na*na - na*nb + nb*nb)/n**3) + 6*dl*dl*(na*na*m2b + nb*nb*self.m2)/(n*n) \
+            + 4*dl*(na*m3b - nb*self.m3)/n
+        self.m3 = self.m3 + m3b + dl**3*(na*nb*(na - nb)/(n*n)) + 3*dl*(na*m2b - nb*self.m2)/n
+        self.m2 = self.m2 + m2b + dl*dl*(na*nb/n)
+        self.n = n
+        self.mn = np.minimum(self.mn, x.min(axis=0))
+        self.mx = np.maximum(self.mx, x.max(axis=0))
+        if t is not None and len(t) > 0 :
+            self.t0 = t[0] if self.t0 is None else self.t0
+            self.rt = self.t0 if self.rt is None else self.rt
+            self.t1 = t[-1]
+
+    def var(self) :
+        return self.m2/(self.n - 1) if self.n > 1 else np.full(len(self.labels), np.nan)
+
+    def std(self) :
+        return np.sqrt(self.var())
+
+    def kurtosis(self) :
+        # out: numpy array of the sample excess kurtosis (pandas kurt), nan until there are 4 samples
+        n = self.n
+        if n < 4 :
+            return np.full(len(self.labels), np.nan)
+        with np.errstate(divide='ignore', invalid='ignore') :
+            g = n*self.m4/(self.m2*self.m2) #population kurtosis
+            return ((n + 1)*g - 3*(n - 1))*(n - 1)/((n - 2)*(n - 3))
+
+    def rate(self) :
+        # out: float effective sample rate (Hz) over the whole capture, from the device clock
+        if self.n < 2 or self.t1 is None or self.t1 <= self.t0 :
+            return 0.0
+        return (self.n - 1)/(self.t1 - self.t0)
+
+    def recent_rate(self) :
+        # def: sample rate since the last call, for spotting dropouts while the capture runs
+        # out: float rate (Hz)
+        r = 0.0
+        if self.rt is not None and self.t1 is not None and self.t1 > self.rt :
+            r = (self.n - self.rn)/(self.t1 - self.rt)
+        self.rn = self.n
+        self.rt = self.t1
+        return r
+
+    def report(self) :
+        # def: formats the current statistics for the console
+        # out: string
+        sd = self.std()
+        ku = self.kurtosis()
+        rs = "***Live Statistics*** " + str(self.n) + " samples, " + str(round(self.rate(), 3)) + " Hz (recent " + \
+            str(round(self.recent_rate(), 3)) + " Hz)\n"
+        rs = rs + "%-7s %14s %10s %14s %14s %8s\n" % ('', 'Mean (nT)', 'Std (nT)', 'Min (nT)', 'Max (nT)', 'Kurt')
+        for i in range(0, len(self.labels)) :
+            rs = rs + "%-7s %14.3f %10.3f %14.3f %14.3f %8.3f\n" % (self.labels[i], self.mean[i], sd[i], self.mn[i], self.mx[i], ku[i])
+        return rs
+
+    def export_header(self) :
+        return "Elapsed (sec), Samples, Rate (Hz), " + ", ".join(l + ' Mean, ' + l + ' Std, ' + l + ' Min, ' + l + ' Max, ' + l + ' Kurt'
+                                                               for l in self.labels)
+
+    def export_row(self, el) :
+        # def: one csv line of the current statistics
+        # in: float el (seconds since the capture started)
+        # out: string
+        sd = self.std()
+        ku = self.kurtosis()
+        return ("%.3f,%d,%.6f," % (el, self.n, self.rate())) + ",".join("%.6f,%.6f,%.6f,%.6f,%.6f" % (self.mean[i], sd[i], self.mn[i], self.mx[i], ku[i])
+                                                                   for i in range(0, len(self.labels)))
+
+###End Running Statistics###
+
+
+###Streaming PSD###
+#
+# Welch PSD built up while a capture runs, same estimate as signal.welch(x, fs, 'hamming', nperseg) with its defaults
+# (50% overlap, constant detrend, density scaling, one sided) that plot_magnetometer_psd uses. Only the samples of the
+# segment still being filled are kept, every finished segment is added to a running sum of periodograms, so memory is
+# bounded by the segment length instead of the capture length. The sample rate comes from the device clock when the PSD is
+# read, the same way pni_data_frame.sr does.
+#
+
+class streaming_welch :
+    def __init__(self, nperseg, labels=stat_labels, fs=0, window='hamming', max_segments=8) :
+        # in: int nperseg (segment length), list labels (one per channel), float fs (sample rate used until timestamps arrive),
+        # string window (scipy window name), int max_segments (segments transformed at once, bounds the temporary memory)
+        self.nperseg = int(nperseg)
+        self.step = self.nperseg - self.nperseg//2 #scipy's default noverlap is nperseg//2
+        self.labels = labels
+        self.fs = fs
+        self.max_segments = max_segments
+        self.w = signal.get_window(window, self.nperseg)
+        self.buf = np.zeros((0, len(labels)))
+        self.acc = np.zeros((len(labels), self.nperseg//2 + 1)) #sum of |fft|^2 of every finished segment
+        self.segments = 0
+        self.n = 0 #samples seen and their device time span, for the sample rate
+        self.t0 = None
+        self.t1 = None
+
+    def update_columns(self, dc, sf) :
+        # def: adds a block decoded by data_decoding_lib.decode_packet_array_quad, blocks without all 12 mag axes are ignored
+        # in: dict of columns, float sf (lsb to nT)
+        # out: none
+        if dc['b'].ndim == 2 and dc['b'].shape[1] == 12 and len(dc['b']) > 0 :
+            self.update(stat_channels_helper(dc['b'], sf), dc['t'])
+
+    def update(self, x, t=None) :
+        # def: appends samples and adds every segment they complete to the running average
+        # in: numpy array x (N, channels), numpy array t (N device times in sec) or None
+        # out: none
+        if len(x) == 0 :
+            return
+        self.n = self.n + len(x)
+        if t is not None and len(t) > 0 :
+            self.t0 = t[0] if self.t0 is None else self.t0
+            self.t1 = t[-1]
+        self.buf = np.concatenate((self.buf, x)) if len(self.buf) > 0 else np.asarray(x, dtype=np.float64)
+        k = (len(self.buf) - self.nperseg)//self.step + 1 if len(self.buf) >= self.nperseg else 0
+        for i in range(0, k, self.max_segments) :
+            kb = min(self.max_segments, k - i)
+            sg = np.lib.stride_tricks.sliding_window_view(self.buf[i*self.step:(i + kb - 1)*self.step + self.nperseg], self.nperseg, axis=0)[::self.step]
+            sg = (sg - sg.mean(axis=2, keepdims=True)) * self.w #(kb, channels, nperseg)
+            sp = np.fft.rfft(sg, axis=2)
+            self.acc = self.acc + (sp.real**2 + sp.imag**2).sum(axis=0)
+        self.segments = self.segments + k
+        self.buf = self.buf[k*self.step:].copy()
+
+    def rate(self) :
+        if self.n > 1 and self.t1 is not None and self.t1 > self.t0 :
+            return (self.n - 1)/(self.t1 - self.t0)
+        return self.fs
+
+    def psd(self, fs=None) :
+        # def: the current averaged PSD
+        # in: float fs (sample rate, defaults to the device clock rate)
+        # out: [numpy array frequencies (Hz), numpy array psd (channels, frequencies) in nT^2/Hz], psd is nan before the first segment
+        fs = self.rate() if fs is None else fs
+        fx = np.fft.rfftfreq(self.nperseg, 1.0/fs) if fs > 0 else np.arange(self.nperseg//2 + 1, dtype=np.float64)
+        if self.segments == 0 or fs <= 0 :
+            return [fx, np.full(self.acc.shape, np.nan)]
+        p = self.acc/self.segments/(fs*(self.w*self.w).sum())
+        p[:, 1:] = p[:, 1:]*2
+        if self.nperseg % 2 == 0 :
+            p[:, -1] = p[:, -1]/2
+        return [fx, p]
+
+    def noise_density(self, band=None) :
+        # def: noise density per channel, by default at the first frequency above 1 Hz like plot_magnetometer_psd
+        # in: [float low, float high] band (Hz) to average the amplitude spectral density over instead, or None
+        # out: [float frequency (Hz, centre of the band), numpy array nT/sqrt(Hz) per channel]
+        fx, p = self.psd()
+        asd = np.sqrt(p)
+        if band is None :
+            ix = np.nonzero(fx > 1)[0]
+            if len(ix) == 0 :
+                return [np.nan, np.full(len(self.labels), np.nan)]
+            return [fx[ix[0]], asd[:, ix[0]]]
+        m = (fx >= band[0]) & (fx <= band[1])
+        if not m.any() :
+            return [np.nan, np.full(len(self.labels), np.nan)]
+        return [(band[0] + band[1])/2.0, asd[:, m].mean(axis=1)]
+
+    def report(self, band=None) :
+        # def: formats the current noise densities for the console
+        # out: string
+        fq, nd = self.noise_density(band)
+        rs = "***Live Noise Density*** " + str(self.segments) + " segments of " + str(self.nperseg) + " samples, at " + \
+            str(round(fq, 3)) + " Hz (nT/sqrt(Hz))\n"
+        if self.labels is not stat_labels :
+            for i in range(0, len(self.labels)) :
+                rs = rs + "%-7s %10.3f\n" % (self.labels[i], nd[i])
+            return rs
+        rs = rs + "%-7s %10s %10s %10s\n" % ('', 'X', 'Y', 'Z')
+        for i in range(0, 4) :
+            rs = rs + "%-7s %10.3f %10.3f %10.3f\n" % ('B' + str(i+1), nd[3*i], nd[3*i+1], nd[3*i+2])
+        rs = rs + "%-7s %10.3f %10.3f %10.3f\n" % ('Quad', nd[16], nd[17], nd[18])
+        rs = rs + "|B|     " + " ".join("%s %.3f" % (self.labels[i], nd[i]) for i in [12, 13, 14, 15, 19]) + "\n"
+        return rs
+
+###End Streaming PSD###
@@ -8,6 +8,7 @@ import math
 
 
 from . import data_manipulation_lib as dml
+from . import data_decoding_lib as ddl
 
 center_on_zero = 0 #set to 1 i.e. TRUE if you want the data to be centered around 0
 
@@ -51,23 +52,36 @@ plt.rcParams.update(params)
 default_fig_path = 'data_storage/fig/'
 default_data_path = 'data_storage/'
 
+def convert_raw_data(f, workers=1):
+    # def: converts a raw data file (hex text) into a processed data file that can be plotted
+    # in: string f (flags), int workers (processes decoding in parallel, 1 decodes in this process)
+    # out: string saying how the conversion went
+    rf = input("What is the name of the raw data file you want to convert (don't include _raw_data.txt)? ")
+    try:
+        npk, ni = ddl.decode_raw_data_file_quad(default_data_path + rf, '04', workers=workers)
+    except Exception as e:
+        print(e)
+        return '\nThe raw data file ' + default_data_path + rf + '_raw_data.txt could not be converted!'
+    return '\nConverted ' + str(npk) + ' packets (' + str(ni) + ' invalid lines skipped) into ' + default_data_path + rf + '_processed_data.txt'
+
 def plot_data(f, filename=''):
     # def:
     # in:
     # out:
     gf = True if f.find('f') == -1 else False
+    rp = True if f.find('r') != -1 else None #drop samples that break a monotonic time base while loading (None leaves it to dml.repair_time)
     while 1:
         if not gf :
             rf = input("What is the name of the file you want to analyze (processed_data_only)? ")
             try:
-                do = dml.pni_file_decode_quad(default_data_path + rf)
+                do = dml.pni_cached_decode_dataset(default_data_path + rf, rp)
                 break
             except Exception as e:
                 print(e)
                 print('\nThe file following file could not be found:\n' +  default_data_path + rf + '\n\nTry Again!\n')
         else :
             try:
-                do = dml.pni_file_decode_quad(default_data_path + filename)
+                do = dml.pni_cached_decode_dataset(default_data_path + filename, rp)
                 break
             except Exception as e:
                 print(e)
@@ -120,6 +134,8 @@ def plot_all_magnetometers_time_series(do, sfn, f) :
     if choose_best_window and toh :
         do = dml.find_best_window(do, best_window_length, 'a')
 
+    do = dml.as_quad_data_frame(do) #the mags are fixed/decimated in place
+
     if aoh : #downsample to 1hz using scipy decimation feature
 
         f = f + 'd' #for ylims in plotting
@@ -157,6 +173,8 @@ def plot_single_magnetometer_time_series(do, sfn, f) :
 
     aoh = True if input("Do you want to downsample to 1Hz (Y/n)? ") == 'Y' else False
 
+    do = dml.as_quad_data_frame(do) #the mags are fixed/decimated in place
+
     if aoh : #downsample to 1hz using scipy decimation feature
 
         if n != -1 :
@@ -327,13 +345,13 @@ def plot_magnetometer_psd(do, sfn, f) :
     wlaon = 5 if (n == -1 and choose_best_window) else 1
 
     if wlaon == 1 :
-        do = [do]
+        do = [dml.as_quad_data_frame(do)] #the mags are fixed/decimated in place
 
     if choose_best_window :
         if n != -1:
             do.c[n] = dml.find_best_window(do, best_window_length, '')
         else :
-            do = dml.find_best_window(do, best_window_length, 'a', wlaon)
+            do = [dml.as_quad_data_frame(w) for w in dml.best_window_views(do, best_window_length, wlaon)] #zero-copy windows, only they become frames
 
     if aoh : #downsample to 1hz using scipy decimation feature
 
@@ -341,7 +359,7 @@ def plot_magnetometer_psd(do, sfn, f) :
             do.c[n] = dml.decimate_helper(do.c[n], 1)
             dml.pni_describe(do.c[n])
         else :
-            for j in range(0, wlaon) :
+            for j in range(0, len(do)) :
                 for i in range(0,4) :
                     do[j].c[i] = dml.decimate_helper(do[j].c[i], 1)
                 dml.pni_describe(do[j])
@@ -353,7 +371,7 @@ def plot_magnetometer_psd(do, sfn, f) :
         dml.pni_describe(do.c[n])
     else :
         #fix individual mag dataset
-        for j in range (0,wlaon) :
+        for j in range (0,len(do)) :
             for i in range(0,4) :
                 do[j].c[i].fix_self()
             do[j].update_self()
@@ -371,7 +389,7 @@ def plot_magnetometer_psd(do, sfn, f) :
         #ic_axs[j].set_ylabel('\\textbf{Power Spectrum ($nT$ RMS)}')
         ic_axs[j].set_xlabel('\\textbf{Frequency ($Hz$)}')
         ohr = 0
-        for i in range (0,wlaon) : #plot for each axis
+        for i in range (0,len(do)) : #plot for each window
             #title = titles[i]
             #stdsum = 0
             py = do[i].p.iloc[:, j]
@@ -398,7 +416,7 @@ def plot_magnetometer_psd(do, sfn, f) :
             ic_axs[j].loglog(fx, psdx)
 
 
-        ohr = ohr / float(wlaon)
+        ohr = ohr / float(len(do)) #fewer windows than asked for if they didn't fit
 
         ic_axs[j].set_title(title + str(np.round(ohr, 3)) + ' $nT$/$\\sqrt{Hz}$')
         #ic_axs[j].legend(loc='upper right')
@@ -440,6 +458,8 @@ def plot_best_magnetometer_window(do, sfn, f) :
 
     if aoh : #downsample to 1hz using scipy decimation feature
 
+        do = dml.as_quad_data_frame(do)
+
         if n != -1 :
             do.c[n] = dml.decimate_helper(do.c[n], 1)
         else :
@@ -463,6 +483,8 @@ def plot_magnetometer_hist(do, sfn, f) :
 
     aoh = True if input("Do you want to downsample to 1Hz (Y/n)? ") == 'Y' else False
 
+    do = dml.as_quad_data_frame(do) #the mags are fixed/decimated in place
+
     if aoh : #downsample to 1hz using scipy decimation feature
 
         if n != -1 :
@@ -492,6 +514,8 @@ def plot_magnetometer_downsampled_noise(do, sfn, f) :
 
     if choose_best_window :
         do = dml.find_best_window(do, best_window_length, 'a')
+    else :
+        do = dml.as_quad_data_frame(do) #the mags are decimated in place
 
     #create array of sample rates
     srx = [float(np.floor(do.sr))]
@@ -6,6 +6,11 @@ import data_processing_lib.data_plotting_lib as dpl
 #### Config Options ####
 imu_enabled = 0
 temperature_enabled = 0
+binary_raw_enabled = 0 #write raw packets to a binary _raw_data.bin capture instead of hex text
+bulk_read_enabled = 0 #read everything waiting on the serial port and decode it in bulk during continuous measurements
+threaded_acquisition_enabled = 0 #read the serial port on its own thread so slow writes/printing can't stall it
+time_repair_enabled = 0 #drop samples that break a monotonic time base when loading a file to plot
+decode_workers = 1 #processes converting a raw data file in parallel, 1 converts in this process
 
 #### Serial Port ####
 
@@ -15,19 +20,36 @@ def openSerialPort():
     # Input: Port to open
     # Output: Serial object
 
-    # See python serial library for more documentation
-    baudrate = 115200  # Pre-Defined
-    timeout = 3  # Pre-Defined
-    tries = 5  # Arbitrary number of times we try to open serial port before giving up
     linux = input('\nAre you running this program in linux (Y/n): ')
     portNum = input(
         "\nEnter the port number you wish to establish a serial connection with (0,1,2,etc.): ")
-    port = ""
+    return openSerialPortHelper(portNameHelper(linux, portNum))
+
+
+def openSerialPorts():
+    # Function Definition: Attempt to open serial connections to several quad-mags
+    # Input: Ports to open
+    # Output: List of Serial objects
+    linux = input('\nAre you running this program in linux (Y/n): ')
+    portNums = input(
+        "\nEnter the port numbers you wish to establish serial connections with separated by commas (0,1,2,etc.): ")
+    return [openSerialPortHelper(portNameHelper(linux, portNum.strip())) for portNum in portNums.split(',') if portNum.strip() != '']
+
+
+def portNameHelper(linux, portNum):
+    if portNum.startswith('/'):  # full device path eg. the pty of data_emulation_lib
+        return portNum
     if linux == 'Y':
-        #port = '/dev/ttyS' + portNum
-        port = '/dev/ttyACM' + portNum
-    else:
-        port = 'COM' + portNum
+        #return '/dev/ttyS' + portNum
+        return '/dev/ttyACM' + portNum
+    return 'COM' + portNum
+
+
+def openSerialPortHelper(port):
+    # See python serial library for more documentation
+    baudrate = 115200  # Pre-Defined
+    timeout = 3  # Pre-Defined
+    tries = 5  # Arbitrary number of times we try to open serial port before giving up
     while tries > 0:  # Attempt to establish serial port connection
         try:
             ser = serial.Serial(
@@ -44,6 +66,16 @@ def openSerialPort():
     return ser  # Return the serial object created
 #### End Serial Port ####
 
+
+def flagHelper():
+    # Function Definition: Builds the command flag from the config options
+    f = 'i' if imu_enabled else ''
+    f = (f + 't') if temperature_enabled else f 
+    f = (f + 'b') if binary_raw_enabled else f
+    f = (f + 'k') if bulk_read_enabled else f
+    f = (f + 'w') if threaded_acquisition_enabled else f
+    return f
+
 #### Main ####
 
 
@@ -51,25 +83,33 @@ def main():
     # Loop that runs tests until user ends the program
     run_switcher = {
         '1': dcl.get_command,
-        '2': dpl.plot_data
+        '2': dpl.plot_data,
+        '3': dcl.multi_board_measurement,
+        '4': dpl.convert_raw_data
     }
     while 1:
         # Retrieve the function the user wants to run
         run_num = input(
-            "Would you like to send a command, or plot previously collected data?\n1:Send Command\n2:Plot Previous Data\n\nEnter a number here (1-2): ")
+            "Would you like to send a command, or plot previously collected data?\n1:Send Command\n2:Plot Previous Data\n3:Multi-Board Measurement\n4:Convert Raw Data File\n\nEnter a number here (1-4): ")
         run = run_switcher.get(
             run_num, lambda ser: "The function you selected failed!")
-        if run_num != '1' and run_num != '2' :
+        if run_num != '1' and run_num != '2' and run_num != '3' and run_num != '4' :
             print("\nInvalid number", run_num, "try again\n")
         # Run the test and print its output
         if run_num == '2':
-            print(run('uf'))
+            print(run('uf' + ('r' if time_repair_enabled else '')))
+        elif run_num == '4':
+            print(run('u', decode_workers))
+        elif run_num == '3':
+            # Open every board's serial port
+            sers = openSerialPorts()
+            print(run(sers, flagHelper()))
+            for ser in sers:
+                ser.close()
         else:
             # Open the serial port
             ser = openSerialPort()
-            f = 'i' if imu_enabled else ''
-            f = (f + 't') if temperature_enabled else f 
-            print(run(ser, f))
+            print(run(ser, flagHelper()))
             ser.close()
         # Continue to run tests until the user ends the program
         cont = input("Do you want to run another this program again (Y/n)? \n")
@@ -80,5 +120,6 @@ def main():
 
 
 #### Run ####
-main()
+if __name__ == '__main__': # worker processes of a parallel raw data conversion import this file again
+    main()
 #### End Run ####